@@ -0,0 +1,60 @@
+"""
+Compares marker detection against the full dictionary with detection against a subset dictionary of
+the active marker ids (aruco_detection.active_ids), on synthetic scenes (see scenes.py) where only
+some of the markers on the table are active.
+
+Reports the detect time and the false positives: detections that are not active markers, i.e.
+inactive markers on the table or misdecoded ids. With the full dictionary they all get broadcast.
+
+    python -m service.bench.active_ids [--active 8] [--seeds 5] [--frames 10]
+"""
+from service.bench.pipeline import SCENARIOS
+from service.bench.scenes import render_scene
+from service.utils.file_utils import load_config
+from service.vision.aruco import ArucoMarkerDetector
+import argparse
+import time
+import cv2 as cv
+
+
+def run(detector, gray, active: set, frames: int) -> tuple:
+    """Returns (ms per frame, active markers found, false positives)."""
+    detector.detect(gray)  # Warm up
+    t0 = time.perf_counter()
+    for _ in range(frames):
+        _, ids = detector.detect(gray)
+    ms = (time.perf_counter() - t0) / frames * 1e3
+    ids = [] if ids is None else ids.ravel().tolist()
+    found = sum(1 for i in ids if i in active)
+    return ms, found, len(ids) - found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Full vs. active-id subset dictionary")
+    parser.add_argument("--active", type=int, default=8, help="Active markers out of the 16 on the table")
+    parser.add_argument("--seeds", type=int, default=5, help="Scenes per scenario")
+    parser.add_argument("--frames", type=int, default=10, help="Timed detections per scene")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="Only run these scenarios")
+    args = parser.parse_args()
+
+    cfg = load_config("service/config.json")["aruco_detection"]
+    print(f"{'scenario':<12} | {'dictionary':<10} | {'ms/frame':>8} | {'found':>7} | {'false pos.':>10}")
+    print("-" * 60)
+    for name in args.scenario or SCENARIOS:
+        totals = {"full": [0.0, 0, 0], "active": [0.0, 0, 0]}
+        expected = 0
+        for seed in range(args.seeds):
+            scene = render_scene(**SCENARIOS[name], seed=seed)
+            gray = cv.cvtColor(scene.undistorter.remap(scene.frame), cv.COLOR_BGR2GRAY)
+            active_ids = scene.truth.ids[:args.active].tolist()
+            expected += len(active_ids)
+            detectors = {
+                "full": ArucoMarkerDetector(cfg["physical_marker_dict"], cfg["detector_parameters"]),
+                "active": ArucoMarkerDetector(cfg["physical_marker_dict"], cfg["detector_parameters"], active_ids),
+            }
+            for label, detector in detectors.items():
+                for k, value in enumerate(run(detector, gray, set(active_ids), args.frames)):
+                    totals[label][k] += value
+        for label, (ms, found, false_positives) in totals.items():
+            print(f"{name:<12} | {label:<10} | {ms / args.seeds:>8.1f} | {found:>3}/{expected:<3} | "
+                  f"{false_positives / args.seeds:>6.1f}/frame")
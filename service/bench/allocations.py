@@ -0,0 +1,80 @@
+"""
+Compares the per-frame memory allocations and latency jitter of frame preparation (remap and
+preprocessing, see prepare_frame) with newly allocated images per frame against preallocated
+buffers (BufferPool), on synthetic scenes (see scenes.py).
+
+Reports the memory newly allocated per frame (traced in a separate pass, as tracing slows every
+allocation down) and the p50 / p99 / max latency and its standard deviation, for preparation alone
+and for the whole frame including detection.
+
+    python -m service.bench.allocations [--frames 200] [--scenario 4k]
+"""
+from service.bench.pipeline import SCENARIOS
+from service.bench.scenes import render_scene
+from service.tasks.detection import prepare_frame, SEQUENTIAL_BUFFER_SLOTS
+from service.utils.buffers import BufferPool
+from service.utils.file_utils import load_config
+from service.vision.aruco import ArucoMarkerDetector
+from service.vision.camera import Preprocessor
+import argparse
+import time
+import tracemalloc
+import numpy as np
+
+
+def run(scene, detector, pool, frames: int) -> dict:
+    """Returns the prepare / frame latencies in ms."""
+    preprocessor = Preprocessor(pool) if pool is not None else None
+    prepare, total = [], []
+    for _ in range(frames):
+        t0 = time.perf_counter()
+        _, detection_frame = prepare_frame(scene.frame, scene.undistorter, preprocess=True, pool=pool,
+                                           preprocessor=preprocessor)
+        t1 = time.perf_counter()
+        detector.detect(detection_frame)
+        t2 = time.perf_counter()
+        prepare.append((t1 - t0) * 1e3)
+        total.append((t2 - t0) * 1e3)
+    return {"prepare": prepare, "frame": total}
+
+
+def allocated_per_frame(scene, pool, frames: int) -> float:
+    """Peak memory in MB that one preparation allocates on top of what is already held."""
+    preprocessor = Preprocessor(pool) if pool is not None else None
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(frames):
+            held, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            prepare_frame(scene.frame, scene.undistorter, preprocess=True, pool=pool, preprocessor=preprocessor)
+            peaks.append(tracemalloc.get_traced_memory()[1] - held)
+    finally:
+        tracemalloc.stop()
+    return float(np.median(peaks)) / 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Allocating vs. preallocated frame buffers")
+    parser.add_argument("--frames", type=int, default=200, help="Timed frames per scenario and mode")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="Only run these scenarios")
+    args = parser.parse_args()
+
+    cfg = load_config("service/config.json")["aruco_detection"]
+    detector = ArucoMarkerDetector(cfg["physical_marker_dict"], cfg["detector_parameters"], cfg.get("active_ids"))
+
+    header = (f"{'scenario':<12} | {'buffers':<10} | {'MB/frame':>8} | {'stage':<7} | "
+              f"{'p50':>8} | {'p99':>8} | {'max':>8} | {'std':>6}")
+    print(header)
+    print("-" * len(header))
+    for name in args.scenario or SCENARIOS:
+        scene = render_scene(**SCENARIOS[name])
+        for label in ("allocating", "pooled"):
+            # A fresh pool per mode - the pooled run allocates its buffers during warm-up
+            pool = BufferPool(SEQUENTIAL_BUFFER_SLOTS) if label == "pooled" else None
+            run(scene, detector, pool, 5)  # Warm up (remap tables, buffers)
+            mb = allocated_per_frame(scene, pool, 10)
+            for stage, ms in run(scene, detector, pool, args.frames).items():
+                p50, p99 = np.percentile(ms, [50, 99])
+                print(f"{name:<12} | {label:<10} | {mb:>8.1f} | {stage:<7} | "
+                      f"{p50:>6.1f}ms | {p99:>6.1f}ms | {max(ms):>6.1f}ms | {np.std(ms):>6.2f}")
@@ -0,0 +1,37 @@
+"""
+Compares size and encoding cost of the WebSocket payload formats.
+
+    python -m service.bench.payload_encoding
+"""
+from service.vision.aruco import MarkerBatch
+from service.ws.codec import encode_binary, decode_binary
+import json
+import timeit
+import numpy as np
+
+
+def random_batch(n, rng):
+    corners = rng.uniform(0, 3840, size=(n, 1, 4, 2)).astype(np.float32)
+    ids = rng.choice(250, size=(n, 1), replace=False).astype(np.int32)
+    return MarkerBatch.from_cv(ids, tuple(corners))
+
+
+def bench(fn, repeat=2000):
+    return min(timeit.repeat(fn, number=repeat, repeat=5)) / repeat * 1e6  # us per call
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    print(f"{'markers':>8} | {'format':<16} | {'bytes':>6} | {'encode us':>9} | {'decode us':>9}")
+    print("-" * 62)
+    for n in (5, 20, 100):
+        batch = random_batch(n, rng)
+        variants = [
+            ("json (dicts)", lambda: json.dumps(batch.to_payload()), json.loads),
+            ("json (direct)", batch.to_json, json.loads),
+            ("binary", lambda: encode_binary(batch, 0), decode_binary),
+        ]
+        for name, encode, decode in variants:
+            message = encode()
+            print(f"{n:>8} | {name:<16} | {len(message):>6} | {bench(encode):>9.1f} | {bench(lambda: decode(message)):>9.1f}")
+        print("-" * 62)
@@ -0,0 +1,169 @@
+"""
+Benchmark suite for the detection pipeline on synthetic scenes (see scenes.py).
+
+Measures the latency of every stage (remap, preprocess, detect, transform, serialize), the
+end-to-end throughput and the localization error, and compares them against a stored baseline.
+Detector and preprocessing follow service/config.json.
+
+    python -m service.bench.pipeline --update-baseline   # store the current results as the baseline
+    python -m service.bench.pipeline                     # compare against it
+
+Exits with status 1 if a stage got slower than the baseline by more than --tolerance, or if
+detection got less accurate. The baseline is machine-specific and not checked in: record it on
+the target hardware. Against a baseline of another machine only the share of every stage in the
+frame time is compared, not the absolute timings.
+"""
+from service.bench.scenes import render_scene, localization_error
+from service.tasks.detection import build_detector, preprocess_mode
+from service.utils.file_utils import load_config
+from service.vision.aruco import MarkerBatch
+from service.vision.camera import preprocess_img
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+SCENARIOS = {
+    "1080p": dict(resolution="1080p"),
+    "4k": dict(resolution="4k"),
+    "4k_degraded": dict(resolution="4k", blur_sigma=2.0, noise_sigma=10.0),
+}
+STAGES = ("remap", "preprocess", "detect", "transform", "serialize")
+
+# Differences below these are noise, not regressions
+MIN_SLOWDOWN_MS = 0.2
+MAX_ERROR_INCREASE_PX = 0.1
+
+
+def run_scenario(scene, detector, preprocess: bool, frames: int) -> dict:
+    timings = {stage: [] for stage in STAGES}
+    totals = []
+    batch = MarkerBatch()
+    t_start = time.perf_counter()
+    for _ in range(frames):
+        t0 = time.perf_counter()
+        frame = scene.undistorter.remap(scene.frame) if scene.undistorter is not None else scene.frame
+        t1 = time.perf_counter()
+        detection_frame = preprocess_img(frame) if preprocess else frame
+        t2 = time.perf_counter()
+        corners, ids = detector.detect(detection_frame)
+        t3 = time.perf_counter()
+        batch = MarkerBatch.from_cv(ids, corners).transform(scene.H)
+        t4 = time.perf_counter()
+        batch.to_json()
+        t5 = time.perf_counter()
+        for stage, dt in zip(STAGES, np.diff([t0, t1, t2, t3, t4, t5])):
+            timings[stage].append(dt * 1e3)
+        totals.append((t5 - t0) * 1e3)
+    elapsed = time.perf_counter() - t_start
+
+    return {
+        "stages": {stage: {"p50_ms": float(np.percentile(ms, 50)), "p95_ms": float(np.percentile(ms, 95))}
+                   for stage, ms in timings.items()},
+        "end_to_end": {"p50_ms": float(np.percentile(totals, 50)), "fps": frames / elapsed},
+        "accuracy": localization_error(batch, scene.truth),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float, relative: bool = False) -> list:
+    """
+    Returns a description of every regression of `results` against `baseline`. With `relative`, the
+    baseline timings are rescaled to the current frame time first (for baselines of another machine).
+    """
+    regressions = []
+    for name, result in results["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if base is None:
+            continue
+        scale = 1.0
+        if relative:
+            scale = sum(t["p50_ms"] for t in result["stages"].values()) \
+                / sum(t["p50_ms"] for t in base["stages"].values())
+        for stage, timing in result["stages"].items():
+            now, before = timing["p50_ms"], base["stages"][stage]["p50_ms"] * scale
+            if now > before * (1 + tolerance) and now - before > MIN_SLOWDOWN_MS:
+                regressions.append(f"{name}/{stage}: {before:.2f}ms -> {now:.2f}ms")
+
+        acc, base_acc = result["accuracy"], base["accuracy"]
+        if acc["detected"] < base_acc["detected"]:
+            regressions.append(f"{name}: detected {base_acc['detected']} -> {acc['detected']} markers")
+        if acc["false_positives"] > base_acc["false_positives"]:
+            regressions.append(f"{name}: false positives {base_acc['false_positives']} -> {acc['false_positives']}")
+        if acc["mean_error_px"] is not None and base_acc["mean_error_px"] is not None \
+                and acc["mean_error_px"] > base_acc["mean_error_px"] + MAX_ERROR_INCREASE_PX:
+            regressions.append(f"{name}: mean error {base_acc['mean_error_px']:.3f}px -> {acc['mean_error_px']:.3f}px")
+    return regressions
+
+
+def print_results(results: dict, baseline: dict = None) -> None:
+    header = f"{'scenario':<12} | " + " | ".join(f"{s:>10}" for s in STAGES) + f" | {'total':>8} | {'fps':>6} | {'found':>5} | {'err px':>6}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results["scenarios"].items():
+        rows = [(name, result)]
+        if baseline is not None and name in baseline["scenarios"]:
+            rows.append(("  baseline", baseline["scenarios"][name]))
+        for label, r in rows:
+            acc = r["accuracy"]
+            err = f"{acc['mean_error_px']:.3f}" if acc["mean_error_px"] is not None else "-"
+            print(f"{label:<12} | " + " | ".join(f"{r['stages'][s]['p50_ms']:>8.2f}ms" for s in STAGES)
+                  + f" | {r['end_to_end']['p50_ms']:>6.1f}ms | {r['end_to_end']['fps']:>6.1f}"
+                  + f" | {acc['detected']:>2}/{acc['expected']:<2} | {err:>6}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detection pipeline benchmark")
+    parser.add_argument("--frames", type=int, default=20, help="Frames per scenario")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="Only run these scenarios")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative slowdown per stage")
+    args = parser.parse_args()
+
+    cfg = load_config("service/config.json")
+    mode = preprocess_mode(cfg["detection"])
+    preprocess = mode == "always"
+    detector = build_detector(cfg["aruco_detection"], cfg["detection"])
+
+    results = {
+        "machine": {"platform": platform.platform(), "processor": platform.processor(), "cpus": os.cpu_count()},
+        "preprocess": mode,
+        "scenarios": {},
+    }
+    try:
+        for name in args.scenario or SCENARIOS:
+            scene = render_scene(**SCENARIOS[name])
+            run_scenario(scene, detector, preprocess, 2)  # Warm up (remap tables, detector state)
+            results["scenarios"][name] = run_scenario(scene, detector, preprocess, args.frames)
+    finally:
+        if hasattr(detector, "close"):
+            detector.close()
+
+    if args.update_baseline:
+        print_results(results)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Baseline written to {args.baseline}")
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print_results(results)
+        print(f"No baseline at {args.baseline}, run with --update-baseline to create one.")
+        sys.exit(0)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    print_results(results, baseline)
+    relative = baseline["machine"] != results["machine"]
+    if relative:
+        print("Note: the baseline was recorded on a different machine, only the share of every stage "
+              "in the frame time is compared.")
+    regressions = compare(results, baseline, args.tolerance, relative)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if regressions else 0)
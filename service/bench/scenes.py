@@ -0,0 +1,97 @@
+"""
+Synthetic camera frames with known ground truth, for benchmarks.
+
+A table image (text-test-4k.png with DICT_4X4_250 markers on it, in projector coordinates) is
+warped into the camera by a known homography, distorted with the real lens calibration, blurred,
+made noisy and scaled to the camera resolution.
+"""
+from service.utils.transform_utils import Undistorter
+from service.vision.aruco import MarkerBatch
+import os
+import cv2 as cv
+import numpy as np
+
+TABLE_SIZE = (3840, 2160)  # Projector / table space
+CALIBRATION_DIR = "service/calibration"
+RESOLUTIONS = {"1080p": (1920, 1080), "4k": (3840, 2160)}
+
+# Where the table corners end up in the undistorted 4K camera image (slightly oblique view)
+CAMERA_QUAD = np.float32([[260, 180], [3580, 240], [3700, 2010], [140, 1960]])
+
+
+class Scene:
+    """A rendered camera frame plus everything needed to run and score the detection pipeline on it."""
+    def __init__(self, frame, truth: MarkerBatch, H: np.ndarray, undistorter: Undistorter) -> None:
+        self.frame = frame              # Distorted camera frame (BGR)
+        self.truth = truth              # Marker corners in projector space
+        self.H = H                      # Undistorted camera -> projector homography at the frame's resolution
+        self.undistorter = undistorter  # Lens model at the frame's resolution (None without distortion)
+
+
+def render_scene(resolution: str = "4k", count: int = 16, marker_size: int = 160, blur_sigma: float = 1.0,
+                 noise_sigma: float = 4.0, distortion: bool = True, seed: int = 0) -> Scene:
+    """Renders `count` markers of `marker_size` table pixels. Same seed, same scene."""
+    rng = np.random.default_rng(seed)
+    w, h = TABLE_SIZE
+    table = cv.resize(cv.imread("text-test-4k.png"), TABLE_SIZE)
+    dictionary = cv.aruco.getPredefinedDictionary(cv.aruco.DICT_4X4_250)
+
+    # One marker per grid cell (random position inside the cell), so markers never overlap
+    cols = int(np.ceil(np.sqrt(count * w / h)))
+    rows = int(np.ceil(count / cols))
+    cell_w, cell_h = (w - 400) // cols, (h - 400) // rows
+    quiet = marker_size // 4
+    span = marker_size + 2 * quiet
+    cells = rng.permutation(cols * rows)[:count]
+    ids = rng.choice(250, size=count, replace=False)
+    corners = np.empty((count, 4, 2), dtype=np.float32)
+    for k, (cell, marker_id) in enumerate(zip(cells, ids)):
+        x = 200 + (cell % cols) * cell_w + int(rng.integers(0, max(1, cell_w - span)))
+        y = 200 + (cell // cols) * cell_h + int(rng.integers(0, max(1, cell_h - span)))
+        marker = cv.aruco.generateImageMarker(dictionary, int(marker_id), marker_size)
+        marker = cv.copyMakeBorder(marker, quiet, quiet, quiet, quiet, cv.BORDER_CONSTANT, value=255)
+        table[y:y + span, x:x + span] = marker[..., np.newaxis]
+        # Outer marker edges in pixel-center coordinates
+        x0, y0 = x + quiet - 0.5, y + quiet - 0.5
+        corners[k] = [[x0, y0], [x0 + marker_size, y0], [x0 + marker_size, y0 + marker_size], [x0, y0 + marker_size]]
+    truth = MarkerBatch.from_cv(ids.reshape(-1, 1), tuple(corners.reshape(-1, 1, 4, 2)))
+
+    # Table -> undistorted camera
+    H_table_to_cam = cv.getPerspectiveTransform(np.float32([[0, 0], [w, 0], [w, h], [0, h]]) - 0.5, CAMERA_QUAD - 0.5)
+    cam_w, cam_h = RESOLUTIONS["4k"]
+    frame = cv.warpPerspective(table, H_table_to_cam, (cam_w, cam_h), flags=cv.INTER_LINEAR, borderValue=(90, 90, 90))
+
+    undistorter = Undistorter.load(os.path.join(CALIBRATION_DIR, "undistortion_args.npz"), cam_w, cam_h)
+    if distortion:
+        # Every distorted pixel samples the undistorted image at its undistorted location
+        xs, ys = np.meshgrid(np.arange(cam_w, dtype=np.float32), np.arange(cam_h, dtype=np.float32))
+        src = undistorter.points(np.stack([xs, ys], axis=-1))
+        frame = cv.remap(frame, src[..., 0], src[..., 1], interpolation=cv.INTER_LINEAR)
+
+    if blur_sigma > 0:
+        frame = cv.GaussianBlur(frame, (0, 0), blur_sigma)
+    if noise_sigma > 0:
+        noise = rng.normal(0, noise_sigma, frame.shape)
+        frame = np.clip(frame + noise, 0, 255).astype(np.uint8)
+
+    out_w, out_h = RESOLUTIONS[resolution]
+    scale = out_w / cam_w
+    H = np.linalg.inv(H_table_to_cam)
+    if scale != 1:
+        frame = cv.resize(frame, (out_w, out_h), interpolation=cv.INTER_AREA)
+        H = H @ np.diag([1 / scale, 1 / scale, 1.0])
+        undistorter = undistorter.scaled(scale)
+    return Scene(frame, truth, H, undistorter if distortion else None)
+
+
+def localization_error(detected: MarkerBatch, truth: MarkerBatch) -> dict:
+    """Matches markers by ID and returns detection counts and center errors (projector pixels)."""
+    reference = dict(zip(truth.ids.tolist(), truth.centers))
+    errors = [np.linalg.norm(c - reference[i]) for i, c in zip(detected.ids.tolist(), detected.centers) if i in reference]
+    return {
+        "expected": len(truth),
+        "detected": len(errors),
+        "false_positives": len(detected) - len(errors),
+        "mean_error_px": float(np.mean(errors)) if errors else None,
+        "max_error_px": float(np.max(errors)) if errors else None,
+    }
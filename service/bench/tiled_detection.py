@@ -0,0 +1,41 @@
+"""
+Measures how the tiled detector backend scales with the number of worker processes on a 4K frame,
+compared to the single-threaded ArucoMarkerDetector.
+
+    python -m service.bench.tiled_detection [--tiles 3 2] [--overlap 220]
+"""
+from service.vision.aruco import ArucoMarkerDetector
+from service.vision.tiled import TiledMarkerDetector, _synthetic_scene
+import argparse
+import os
+import time
+import cv2 as cv
+
+
+def bench(detector, img, repeat=10):
+    detector.detect(img)  # Warm up (allocates the shared frame, starts the workers)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        detector.detect(img)
+    return (time.perf_counter() - t0) / repeat * 1e3  # ms per frame
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tiles", type=int, nargs=2, default=(3, 2), metavar=("COLS", "ROWS"))
+    parser.add_argument("--overlap", type=int, default=220)
+    args = parser.parse_args()
+
+    gray = cv.cvtColor(_synthetic_scene(), cv.COLOR_BGR2GRAY)
+    single = bench(ArucoMarkerDetector("DICT_4X4_250"), gray)
+    print(f"{os.cpu_count()} cores, tiles {args.tiles[0]}x{args.tiles[1]}, overlap {args.overlap}px")
+    print(f"{'backend':<18} | {'ms/frame':>8} | {'speedup':>7}")
+    print("-" * 40)
+    print(f"{'single':<18} | {single:>8.1f} | {1.0:>7.2f}")
+    for workers in range(1, min(os.cpu_count(), args.tiles[0] * args.tiles[1]) + 1):
+        detector = TiledMarkerDetector("DICT_4X4_250", tiles=args.tiles, overlap_px=args.overlap, workers=workers)
+        try:
+            ms = bench(detector, gray)
+        finally:
+            detector.close()
+        print(f"{f'tiled ({workers} workers)':<18} | {ms:>8.1f} | {single / ms:>7.2f}")
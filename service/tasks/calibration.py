@@ -1,49 +1,78 @@
-from service.utils.file_utils import load_config
-from service.vision.camera import init_video_capture
-from service.utils.transform_utils import dist_to_map
+from service.utils.file_utils import load_config, camera_configs
+from service.vision.frame_source import open_frame_source
+from service.utils.calibration_bundle import CalibrationBundle
 from service.vision.aruco import ArucoMarkerDetector
+from service.vision.camera import FrameGrabber
+from service.utils.pipeline import QueueClosed
+import argparse
 import time
 import cv2 as cv
 import numpy as np
 import os
 
 
-def _detect_markers_with_attempts(
+def _collect_detections(
         detector: ArucoMarkerDetector,
-        expected_count: int = None) -> tuple:
+        not_before: float,
+        expected_count: int = None) -> list:
     """
     @public
-    Try capturing markers up to MAX_NR_OF_ATTEMPTS times.
-    Return detected corners and ids; exit if markers cannot be detected reliably.
+    Detect markers in NUM_FRAMES frames captured after `not_before` (time.time()), using up to
+    MAX_NR_OF_ATTEMPTS additional frames for failed detections.
+    Return a list of (corners, ids) per frame; exit if markers cannot be detected reliably.
     """
-    
-    for attempt in range(1, MAX_NR_OF_ATTEMPTS + 1):
-        frame = _get_most_recent_frame()
+    detections = []
+    for attempt in range(1, NUM_FRAMES + MAX_NR_OF_ATTEMPTS + 1):
+        frame = _get_most_recent_frame(not_before)
         if frame is None or np.mean(frame) < 5:
             print("Captured image is black, skipping frame.")
             continue
-        
-        corners, ids = detector.detect(frame, DEBUG)
-        if ids is not None:
-            num_ids = len(ids)
-            if expected_count:
-                if num_ids > expected_count:
-                    print(
-                        f"Detected {num_ids} markers, expected {expected_count}. Assume setup or settings are wrong; exiting."
-                    )
-                    os._exit(0)
-                elif num_ids == expected_count:
-                    print(f"Detected {expected_count} markers on attempt {attempt}.")
-                    return corners, ids
-            else:
-                return corners, ids
 
+        corners, ids = detector.detect(frame, DEBUG and not detections)
+        if ids is None:
+            continue
+        num_ids = len(ids)
+        if expected_count:
+            if num_ids > expected_count:
+                print(
+                    f"Detected {num_ids} markers, expected {expected_count}. Assume setup or settings are wrong; exiting."
+                )
+                os._exit(0)
+            elif num_ids < expected_count:
+                continue
+        detections.append((corners, ids))
+        if len(detections) == NUM_FRAMES:
+            print(f"Detected markers in {NUM_FRAMES} frames ({attempt} attempts).")
+            return detections
+
+    if detections:
+        print(f"Detected markers in only {len(detections)} of {NUM_FRAMES} frames, continuing.")
+        return detections
     print(
-        f"Failed to detect expected markers in {MAX_NR_OF_ATTEMPTS} attempts. Assume setup or settings are wrong; exiting."
+        f"Failed to detect expected markers in {attempt} attempts. Assume setup or settings are wrong; exiting."
     )
     os._exit(0)
 
 
+def _solve_homography(src_pts: np.ndarray, dst_pts: np.ndarray, name: str) -> np.ndarray:
+    """
+    @public
+    Fit a homography to the correspondences accumulated over all frames with RANSAC and
+    report the reprojection error of the inliers (in destination pixels).
+    """
+    src_pts = np.asarray(src_pts, np.float32).reshape(-1, 1, 2)
+    dst_pts = np.asarray(dst_pts, np.float32).reshape(-1, 1, 2)
+    H, mask = cv.findHomography(src_pts, dst_pts, cv.RANSAC, RANSAC_THRESHOLD)
+    if H is None:
+        print(f"Could not compute the {name} homography. Exiting.")
+        os._exit(0)
+    inliers = mask.ravel().astype(bool)
+    errors = np.linalg.norm(cv.perspectiveTransform(src_pts[inliers], H) - dst_pts[inliers], axis=2).ravel()
+    print(f"{name}: {inliers.sum()}/{len(inliers)} inliers, "
+          f"reprojection error RMS {np.sqrt(np.mean(errors ** 2)):.2f}px, max {errors.max():.2f}px")
+    return H
+
+
 def _extract_common_corners(
     corners_a: np.ndarray,
     ids_a: np.ndarray,
@@ -119,10 +148,8 @@ def _calibrate_camera_to_projector(flip_projector_M):
 
     cv.imshow(WNAME, aruco_grid_flipped)
     cv.waitKey(1)
-    time.sleep(1)
+    detections = _collect_detections(DETECTOR_PROJ, time.time() + SETTLE_TIME)
 
-    aruco_corners_camera, aruco_ids_camera = _detect_markers_with_attempts(DETECTOR_PROJ)
-    
     # Convert to projector coordinate system (potentially flipped canonical coordinate frame)
     # corners: list of arrays of shape (1, 4, 2)
     aruco_corners_projector = []
@@ -132,12 +159,16 @@ def _calibrate_camera_to_projector(flip_projector_M):
     aruco_corners_projector = tuple(aruco_corners_projector)
     aruco_ids_projector = aruco_ids_canonical  # For sake of completeness
 
-    common_corners_projector, common_corners_camera, _ = _extract_common_corners(
-        aruco_corners_projector, aruco_ids_projector, aruco_corners_camera, aruco_ids_camera
-    )
+    # Correspondences of all frames, so noise in single detections averages out
+    src_pts, dst_pts = [], []
+    for aruco_corners_camera, aruco_ids_camera in detections:
+        common_corners_projector, common_corners_camera, _ = _extract_common_corners(
+            aruco_corners_projector, aruco_ids_projector, aruco_corners_camera, aruco_ids_camera
+        )
+        src_pts.append(common_corners_camera)
+        dst_pts.append(common_corners_projector)
 
-    camera_to_projector_H, _ = cv.findHomography(np.array(common_corners_camera), np.array(common_corners_projector))
-    return camera_to_projector_H
+    return _solve_homography(np.concatenate(src_pts), np.concatenate(dst_pts), "Camera to projector")
 
 
 def _draw_aruco_correspondences(img_a, aruco_corners_a, img_b, aruco_corners_b):
@@ -234,13 +265,8 @@ def _calibrate_bounding_box(camera_to_projector_H: np.ndarray, flip_M) -> tuple:
     Detect physical ArUco markers at table corners and compute bounding box homography.
     """
     cv.imshow(WNAME, WHITE_IMG)
-    cv.waitKey(1)   
-    time.sleep(1) # Ensure white image is being displayed
-
-    aruco_corners_camera, _ = _detect_markers_with_attempts(DETECTOR_PHYS, expected_count=4)
-
-    outermost_corners_camera = _get_outermost_corners(aruco_corners_camera)
-    dst_pts_projector = cv.perspectiveTransform(outermost_corners_camera, camera_to_projector_H)
+    cv.waitKey(1)
+    detections = _collect_detections(DETECTOR_PHYS, time.time() + SETTLE_TIME, expected_count=4)
 
     # Height and width minus 1, as the camera_to_projector_H was also computed in pixel coordinates 
     w = CFG["projector"]["width"]
@@ -254,8 +280,13 @@ def _calibrate_bounding_box(camera_to_projector_H: np.ndarray, flip_M) -> tuple:
 
     src_pts_projector = cv.perspectiveTransform(src_pts_canonical, flip_M)
 
-    bounding_box_H, _ = cv.findHomography(src_pts_projector, dst_pts_projector)
-    return bounding_box_H
+    # The same four table corners, measured once per frame
+    dst_pts_projector = [
+        cv.perspectiveTransform(_get_outermost_corners(aruco_corners_camera), camera_to_projector_H)
+        for aruco_corners_camera, _ in detections
+    ]
+    src_pts = np.concatenate([src_pts_projector] * len(dst_pts_projector), axis=1)
+    return _solve_homography(src_pts, np.concatenate(dst_pts_projector, axis=1), "Bounding box")
 
 
 def _build_flip_matrix(width, height, flip_h: bool, flip_v: bool):
@@ -280,14 +311,28 @@ def _build_flip_matrix(width, height, flip_h: bool, flip_v: bool):
     return M
 
 
-def _get_most_recent_frame():
-    # Cant rely on setting buffersize to 1, so we have to do this s***
-    cap = init_video_capture(CFG["camera"]["index"],
-                             CFG["camera"]["width"],
-                             CFG["camera"]["height"],
-                             CFG["camera"]["fps"])
-    _, frame = cap.read()
-    cap.release()
+def _get_most_recent_frame(not_before: float = 0.0):
+    """
+    @public
+    Return the newest undistorted frame captured after `not_before` (time.time()), or None.
+    A live camera is drained continuously by the FRAME_GRABBER thread, so a frame is never stale.
+    """
+    if FRAME_GRABBER is None:
+        # Unbuffered source, e.g. the replay of a recorded calibration run: read in order
+        _, frame = FRAME_SOURCE.read()
+    else:
+        frame = None
+        while frame is None:
+            try:
+                packet = FRAME_GRABBER.frames.get(timeout=5.0)
+            except QueueClosed:
+                return None
+            if packet is None:
+                return None
+            if packet.t_capture >= not_before:
+                frame = packet.frame
+    if frame is None:
+        return None
     frame = cv.remap(
                     frame.copy(),
                     MAP_A,
@@ -300,21 +345,29 @@ def _get_most_recent_frame():
 if __name__ == "__main__":
     DEBUG = True
     CFG = load_config(r"service/config.json")
+    CAMERAS = {camera_cfg["name"]: camera_cfg for camera_cfg in camera_configs(CFG)}
 
-    # Load calibration
-    ud = np.load(os.path.join('service/calibration', 'undistortion_args.npz'))
-    camMtx = ud["camMtx"]
-    distCoeffs = ud["distCoeff"]
-    camMtxNew = ud["camMtxNew"]
-    
-    # TODO: add to camera class
-    MAP_A, MAP_B = dist_to_map(camMtx,
-                               distCoeffs,
-                               camMtxNew,
-                               CFG["camera"]["width"],
-                               CFG["camera"]["height"])
+    parser = argparse.ArgumentParser(description="Camera-to-projector calibration")
+    parser.add_argument("--camera", choices=list(CAMERAS), default=next(iter(CAMERAS)),
+                        help="Camera to calibrate (an entry of \"cameras\" in multi-camera setups)")
+    CAMERA_CFG = CAMERAS[parser.parse_args().camera]
+
+    # Load calibration (remap tables are memory-mapped from the calibration bundle)
+    CALIBRATION_DIR = CAMERA_CFG["calibration_dir"]
+    CALIBRATION = CalibrationBundle(CALIBRATION_DIR)
+    MAP_A, MAP_B = CALIBRATION.undistorter(CAMERA_CFG["width"], CAMERA_CFG["height"]).maps()
+
+    # One capture for the whole calibration. A live camera is drained by a grabber thread that only
+    # keeps the newest frame, a replay is read in order.
+    FRAME_SOURCE = open_frame_source(CAMERA_CFG)
+    FRAME_GRABBER = FrameGrabber(FRAME_SOURCE) if FRAME_SOURCE.buffered else None
+    if FRAME_GRABBER is not None:
+        FRAME_GRABBER.start()
 
     MAX_NR_OF_ATTEMPTS = 10
+    NUM_FRAMES = CFG["calibration"]["frames"]
+    RANSAC_THRESHOLD = CFG["calibration"]["ransac_threshold_px"]
+    SETTLE_TIME = CFG["calibration"]["settle_time"]  # Until the projector shows a new image
     WNAME = "MAIN"
     WINDOW = cv.namedWindow(WNAME, cv.WINDOW_NORMAL)
     cv.moveWindow(WNAME, 
@@ -342,12 +395,15 @@ if __name__ == "__main__":
     print("Calibration was successful.")
 
     # Save calibration
-    CALIBRATION_DIR = 'service/calibration'
-    os.makedirs(CALIBRATION_DIR, exist_ok=True)
-    np.save(os.path.join(CALIBRATION_DIR, 'cam_to_proj_H.npy'), camera_to_projector_H)
-    np.save(os.path.join(CALIBRATION_DIR, 'bounding_box_H.npy'), bounding_box_H)
+    CALIBRATION.save_homography('cam_to_proj_H', camera_to_projector_H)
+    CALIBRATION.save_homography('bounding_box_H', bounding_box_H)
     print(f"Calibration was saved to {CALIBRATION_DIR}.")
 
+    if FRAME_GRABBER is not None:
+        FRAME_GRABBER.stop()
+        FRAME_GRABBER.join(timeout=1)
+    FRAME_SOURCE.release()
+
 
     if DEBUG:
         print("Displaying calibration bounding box in white.")
@@ -1,109 +1,448 @@
 import os
-from service.utils.transform_utils import dist_to_map
-from service.utils.file_utils import load_config
-from service.vision.camera import init_video_capture, preprocess_img
-from service.vision.aruco import ArucoMarkerDetector, Marker
+from service.utils.transform_utils import Undistorter
+from service.utils.calibration_bundle import CalibrationBundle
+from service.utils.file_utils import load_config, camera_configs
+from service.vision.camera import Preprocessor, FrameGrabber, MjpegGrayCapture, capture_time
+from service.vision.frame_source import open_frame_source
+from service.vision.aruco import ArucoMarkerDetector, MarkerBatch
+from service.vision.tracking import TrackingMarkerDetector
+from service.vision.multiscale import MultiScaleMarkerDetector
+from service.vision.tiled import TiledMarkerDetector
+from service.vision.filtering import MarkerFilter
+from service.vision.motion import MotionGate
+from service.vision.adaptive import AdaptivePreprocessDetector
+from service.utils.pipeline import FramePacket, LatestQueue, PipelineStage, QueueClosed, raise_stage_error
 from service.ws.server import WebSocketServer
+from service.ws.delta import DeltaStream
+from service.ws.ipc import FramePublisher
+from service.vision.preview import WindowPreview, MjpegPreview
+from service.utils.http_server import LocalHttpServer
+from service.utils.metrics import METRICS, stage_histogram
+from service.utils.buffers import BufferPool
 
+import time
 import cv2 as cv
 import numpy as np
 
 
-def marker_payload(marker_id, x, y):
-    return {
-            "Id": int(marker_id),
-            "MessageType": "CONTROLHOVER",
-            "Data": {
-                "X": float(x),
-                "Y": float(y),
-            },
-        }
+CAPTURE_TIME = stage_histogram("capture")
+DECODE_TIME = stage_histogram("decode")
+REMAP_TIME = stage_histogram("remap")
+PREPROCESS_TIME = stage_histogram("preprocess")
+DETECT_TIME = stage_histogram("detect")
+TRANSFORM_TIME = stage_histogram("transform")
+FILTER_TIME = stage_histogram("filter")
+BROADCAST_TIME = stage_histogram("broadcast")
+PREVIEW_TIME = stage_histogram("preview")
+MOTION_TIME = stage_histogram("motion")
+GATED_FRAMES = {result: METRICS.counter("motion_gate_frames_total", "Frames by motion gate decision", {"result": result})
+                for result in ("skipped", "regional", "full")}
+FRAME_LATENCY = METRICS.histogram("frame_latency_seconds", "Time from frame capture until its markers are queued for the clients")
+FRAMES = METRICS.counter("frames_total", "Frames processed by the detection loop")
 
-def markers_payload(markers):
-    return {
-        "markers": [marker_payload(m.id, m.center.X, m.center.Y) for m in markers]
-    }
+# Frames handed out by prepare_frame stay valid for slots - 1 further frames (see BufferPool). Sequential: the
+# current frame, the one the preview thread renders and a spare. Pipelined: additionally the frames waiting in
+# the undistorted / detected queues and in the detect stage.
+SEQUENTIAL_BUFFER_SLOTS = 3
+PIPELINED_BUFFER_SLOTS = 7
 
 
-def run_service(detector, cap, ws, H, preprocess=False):
+def preprocess_mode(detection_cfg):
+    """"off", "always" or "adaptive" (detection.preprocess, true / false are accepted for "always" / "off")."""
+    mode = detection_cfg["preprocess"]
+    if isinstance(mode, bool):
+        return "always" if mode else "off"
+    return mode
+
+
+def build_detector(aruco_cfg, detection_cfg=None):
+    active_ids = aruco_cfg.get("active_ids")
+    base_detector = ArucoMarkerDetector(aruco_cfg["physical_marker_dict"],
+                                        aruco_cfg["detector_parameters"],
+                                        active_ids)
+    detector = base_detector
+
+    if aruco_cfg.get("backend", "single") == "tiled":
+        tiled_cfg = aruco_cfg["tiled"]
+        detector = TiledMarkerDetector(aruco_cfg["physical_marker_dict"],
+                                       aruco_cfg["detector_parameters"],
+                                       tiled_cfg["tiles"],
+                                       tiled_cfg["overlap_px"],
+                                       tiled_cfg["workers"],
+                                       active_ids)
+
+    multiscale_cfg = aruco_cfg.get("multiscale", {})
+    if multiscale_cfg.get("enabled", False):
+        detector = MultiScaleMarkerDetector(detector,
+                                            multiscale_cfg["scale"],
+                                            multiscale_cfg["expected_count"],
+                                            multiscale_cfg["refine_window"],
+                                            multiscale_cfg["full_scan_interval"])
+
+    tracking_cfg = aruco_cfg.get("tracking", {})
+    if tracking_cfg.get("enabled", False):
+        # Crops are small already, so they are always detected at full resolution
+        detector = TrackingMarkerDetector(detector,
+                                          tracking_cfg["padding"],
+                                          tracking_cfg["full_scan_interval"],
+                                          roi_detector=base_detector)
+
+    if detection_cfg is not None and preprocess_mode(detection_cfg) == "adaptive":
+        # Outermost, so it only runs when the raw detection (with all of the above) missed markers
+        adaptive_cfg = detection_cfg["adaptive_preprocess"]
+        detector = AdaptivePreprocessDetector(detector,
+                                              adaptive_cfg["expected_count"],
+                                              adaptive_cfg["padding"],
+                                              forget_after=adaptive_cfg["forget_after"],
+                                              full_interval=adaptive_cfg["full_interval"],
+                                              roi_detector=base_detector)
+    return detector
+
+
+def prepare_frame(frame, undistorter, point_undistortion=False, preprocess=False, pool=None, preprocessor=None):
+    """
+    Returns the frame used for display and the frame detection runs on.
+    With point_undistortion, the full-frame remap is skipped and both stay distorted.
+    With a BufferPool (and a Preprocessor on it), both are written into preallocated buffers.
+    """
+    if not point_undistortion:
+        with REMAP_TIME.time():
+            dst = None if pool is None else pool.get("undistorted", undistorter.output_shape(frame), frame.dtype)
+            frame = undistorter.remap(frame, dst=dst)
+    if preprocess:
+        with PREPROCESS_TIME.time():
+            detection_frame = (preprocessor or Preprocessor(pool))(frame)
+    else:
+        detection_frame = frame
+    return frame, detection_frame
+
+
+def gate_frame(motion_gate, frame):
+    """Runs the motion gate on a raw frame. Returns its Change."""
+    with MOTION_TIME.time():
+        change = motion_gate.check(frame)
+    GATED_FRAMES["skipped" if change.skip else "full" if change.regions is None else "regional"].inc()
+    return change
+
+
+def detect_frame(detector, detection_frame, H, undistorter=None, motion_gate=None, change=None):
+    """
+    Returns the detected markers in projector space along with the cv corners (undistorted camera space) and ids.
+    If `undistorter` is given, detection_frame is the raw distorted frame and only the detected corners are undistorted.
+    With a motion gate, only the regions of `change` are detected.
+    """
+    with DETECT_TIME.time():
+        if motion_gate is not None:
+            corners, ids = motion_gate.detect(detector, detection_frame, change)
+        else:
+            corners, ids = detector.detect(detection_frame)
+    with TRANSFORM_TIME.time():
+        batch = MarkerBatch.from_cv(ids, corners)  # always send payload, even if empty
+        if undistorter is not None and len(batch):
+            batch.corners = undistorter.points(batch.corners)
+            corners, _ = batch.to_cv()
+        batch = batch.transform(H)
+    return batch, corners, ids
+
+
+def publish_frame(ws, markers, seq, t_capture, marker_filter=None):
+    """Filters (optionally) and broadcasts the markers of camera frame `seq`."""
+    if marker_filter is not None:
+        with FILTER_TIME.time():
+            markers = marker_filter.update(markers, t_capture)
+    with BROADCAST_TIME.time():
+        ws.broadcast(markers, seq, t_capture)
+    FRAME_LATENCY.observe(time.time() - t_capture)
+    FRAMES.inc()
+
+
+def run_service(detector, cap, ws, H, undistorter, preprocess=False, point_undistortion=False, marker_filter=None,
+                preview=None, motion_gate=None):
+    """
+    Detection loop. `preview` (WindowPreview, MjpegPreview or None for headless) gets every processed frame
+    and decides itself how often to render it. Stops with 'q' in the preview window or Ctrl+C.
+    With a `motion_gate`, frames without changes skip undistortion and detection and re-send the last result.
+    """
+    point_undistorter = undistorter if point_undistortion else None
+    pool = BufferPool(SEQUENTIAL_BUFFER_SLOTS)
+    preprocessor = Preprocessor(pool)
     try:
-        WINDOW_NAME = "MAIN"
-        cv.namedWindow(WINDOW_NAME, cv.WINDOW_AUTOSIZE)
+        if preview is not None:
+            preview.start()
 
+        seq = -1
+        last_frame = None
         while True:
-            ret, frame = cap.read()
+            with CAPTURE_TIME.time():
+                ret, frame = cap.read()
+            t_capture = capture_time(cap)
+            seq += 1
 
             if not ret:
                 print("No frame read")
                 break
 
-            # Undistortion
-            frame = cv.remap(
-                        frame,
-                        MAP_A,
-                        MAP_B,
-                        interpolation=cv.INTER_LINEAR
-                    )
-            
-            detection_frame = preprocess_img(frame) if preprocess else frame
-
-            markers = []  # always send payload 
-            corners, ids = detector.detect(detection_frame)
-            if corners is not None and ids is not None:
-                corners_tf = [cv.perspectiveTransform(c, H) for c in corners]
-                markers = Marker.from_cv_collection(ids, corners_tf)
-                frame = cv.aruco.drawDetectedMarkers(frame, corners, ids)
+            change = gate_frame(motion_gate, frame) if motion_gate is not None else None
+            if change is not None and change.skip:
+                frame = last_frame  # Looks the same, and is undistorted already for the preview
+            else:
+                # Undistortion
+                frame, detection_frame = prepare_frame(frame, undistorter, point_undistortion, preprocess,
+                                                       pool, preprocessor)
+
+                markers, corners, ids = detect_frame(detector, detection_frame, H, point_undistorter, motion_gate, change)
+                last_frame = frame
+
+            publish_frame(ws, markers, seq, t_capture, marker_filter)
 
-            cv.imshow(WINDOW_NAME, cv.resize(frame, None, fx=0.3, fy=0.3))
+            with PREVIEW_TIME.time():
+                if preview is not None and preview.show(frame, corners, ids):
+                    break
 
-            ws.broadcast(markers_payload(markers))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Shutting down...")
+        if cap is not None:
+            cap.release()
+        if hasattr(detector, "close"):
+            detector.close()
+        if preview is not None:
+            preview.stop()
+
+
+def run_service_pipelined(detector, cap, ws, H, undistorter, preprocess=False, point_undistortion=False,
+                          marker_filter=None, preview=None, motion_gate=None):
+    """
+    Same as run_service, but capture, undistortion and detection run in their own threads,
+    connected by latest-wins queues of size 1. A stage that is still busy when the next frame
+    arrives simply never sees the older frame, so latency stays at about one frame.
+    Broadcasting and the preview (an OpenCV window must be on the main thread) run on the calling thread.
+    """
+    point_undistorter = undistorter if point_undistortion else None
+    pool = BufferPool(PIPELINED_BUFFER_SLOTS)  # Only used by the undistort stage
+    preprocessor = Preprocessor(pool)
+    last = FramePacket(-1, 0.0, None)  # Last detected frame, re-sent for frames the motion gate skips
+
+    def undistort_stage(packet):
+        if packet.decode is not None:
+            with DECODE_TIME.time():
+                packet.frame = packet.decode(packet.frame)
+        if motion_gate is not None:
+            packet.change = gate_frame(motion_gate, packet.frame)
+            if packet.change.skip:
+                return packet
+        packet.frame, packet.detection_frame = prepare_frame(packet.frame, undistorter, point_undistortion, preprocess,
+                                                             pool, preprocessor)
+        return packet
+
+    def detect_stage(packet):
+        if packet.change is not None and packet.change.skip:
+            # Filled in here, as the detect stage sees every frame that was detected, in order
+            packet.frame, packet.markers, packet.corners, packet.ids = last.frame, last.markers, last.corners, last.ids
+            return packet
+        packet.markers, packet.corners, packet.ids = detect_frame(detector, packet.detection_frame, H, point_undistorter,
+                                                                  motion_gate, packet.change)
+        last.frame, last.markers, last.corners, last.ids = packet.frame, packet.markers, packet.corners, packet.ids
+        return packet
+
+    grabber = FrameGrabber(cap)
+    undistorted = LatestQueue()
+    detected = LatestQueue()
+    for name, queue in (("capture", grabber.frames), ("undistort", undistorted), ("detect", detected)):
+        METRICS.gauge("frames_dropped", "Frames dropped because the next stage was still busy", {"queue": name},
+                      fn=lambda queue=queue: queue.dropped)
+    stages = [
+        PipelineStage("undistort", undistort_stage, grabber.frames, undistorted),
+        PipelineStage("detect", detect_stage, undistorted, detected),
+    ]
+
+    try:
+        if preview is not None:
+            preview.start()
 
-            if cv.waitKey(1) & 0xFF == ord('q'):
+        grabber.start()
+        for stage in stages:
+            stage.start()
+
+        while True:
+            try:
+                packet = detected.get()
+            except QueueClosed:
+                # The capture ended or a stage failed - then the whole pipeline stops with its error
+                raise_stage_error(stages)
                 break
 
+            publish_frame(ws, packet.markers, packet.seq, packet.t_capture, marker_filter)
+
+            with PREVIEW_TIME.time():
+                if preview is not None and preview.show(packet.frame, packet.corners, packet.ids):
+                    break
+
+    except KeyboardInterrupt:
+        pass
     finally:
         print("Shutting down...")
+        grabber.stop()
+        grabber.frames.close()
+        for stage in stages:
+            stage.join(timeout=1)
+        grabber.join(timeout=1)
+        print(f"Dropped frames - capture: {grabber.dropped}, "
+              f"undistort: {undistorted.dropped}, detect: {detected.dropped}")
         if cap is not None:
             cap.release()
-        cv.destroyAllWindows()
+        if hasattr(detector, "close"):
+            detector.close()
+        if preview is not None:
+            preview.stop()
 
 
-if __name__ == "__main__":
-    CFG = load_config(r"service/config.json")
-    # Load calibration
-    ud = np.load(os.path.join('service/calibration', 'undistortion_args.npz'))
-    camMtx = ud["camMtx"]
-    distCoeffs = ud["distCoeff"]
-    camMtxNew = ud["camMtxNew"]
-    
-    # TODO: add to camera class
-    MAP_A, MAP_B = dist_to_map(camMtx,
-                               distCoeffs,
-                               camMtxNew,
-                               CFG["camera"]["width"],
-                               CFG["camera"]["height"])  
-
-    
-    detector = ArucoMarkerDetector(CFG["aruco_detection"]["physical_marker_dict"],
-                                   CFG["aruco_detection"]["detector_parameters"])
-
-    # Init camera
-    cap = init_video_capture(CFG["camera"]["index"],
-                             CFG["camera"]["width"],
-                             CFG["camera"]["height"],
-                             CFG["camera"]["fps"])
-
-    CALIBRATION_DIR = 'service/calibration'
-    BOUNDING_BOX_H = np.load(os.path.join(CALIBRATION_DIR, 'bounding_box_H.npy'))
-    CAM_TO_PROJ_H = np.load(os.path.join(CALIBRATION_DIR, 'cam_to_proj_H.npy'))
+def _test_point_undistortion(tolerance_px=1.5):  # TEMPORARY - add testing package at some point
+    """
+    Checks that point-space undistortion yields the same projector coordinates as the full-frame
+    remap path, within `tolerance_px` projector pixels per corner.
+    A distorted camera image is synthesized from a known undistorted scene using the real calibration.
+    """
+    calib_dir = 'service/calibration'
+    scene = cv.imread('text-test-4k.png')
+    h, w = scene.shape[:2]
+    undistorter = Undistorter.load(os.path.join(calib_dir, 'undistortion_args.npz'), w, h)
+    H = np.load(os.path.join(calib_dir, 'cam_to_proj_H.npy'))
+
+    dictionary = cv.aruco.getPredefinedDictionary(cv.aruco.DICT_4X4_250)
+    for marker_id in range(12):
+        marker = cv.aruco.generateImageMarker(dictionary, marker_id, 150)
+        marker = cv.copyMakeBorder(marker, 20, 20, 20, 20, cv.BORDER_CONSTANT, value=255)
+        x, y = 200 + (marker_id % 4) * 1000, 200 + (marker_id // 4) * 700
+        scene[y:y + 190, x:x + 190] = marker[..., np.newaxis]
+
+    # Every distorted pixel samples the scene at its undistorted location
+    xs, ys = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+    src = undistorter.points(np.stack([xs, ys], axis=-1))
+    distorted = cv.remap(scene, src[..., 0], src[..., 1], interpolation=cv.INTER_LINEAR)
+
+    detector = ArucoMarkerDetector("DICT_4X4_250")
+    markers_remap, _, _ = detect_frame(detector, undistorter.remap(distorted), H)
+    markers_points, _, _ = detect_frame(detector, distorted, H, undistorter)
+
+    assert len(markers_remap) == 12
+    assert sorted(markers_remap.ids) == sorted(markers_points.ids)
+
+    reference = dict(zip(markers_remap.ids.tolist(), markers_remap.corners))
+    err = max(np.abs(c - reference[i]).max() for i, c in zip(markers_points.ids.tolist(), markers_points.corners))
+    print(f"Max corner deviation in projector space: {err:.3f}px")
+    assert err < tolerance_px
+
+
+def run_camera(cfg, camera_cfg, ws, marker_filter=None, port_offset=0, window_name="MAIN"):
+    """
+    Sets up one camera (calibration from camera_cfg["calibration_dir"], detector, preview, motion gate)
+    and runs the detection loop on it until it stops, publishing to `ws` (already started).
+    The metrics and preview ports are shifted by `port_offset`, so several cameras can run side by side.
+    """
+    # Load calibration (remap tables are memory-mapped from the calibration bundle)
+    calibration = CalibrationBundle(camera_cfg["calibration_dir"])
+    undistorter = calibration.undistorter(camera_cfg["width"], camera_cfg["height"])
 
     # This homopgrahpy assumes that any image displayed on the projector has been transformed
     # using the bounding box homography.
-    H = CAM_TO_PROJ_H
+    H = calibration.homography('cam_to_proj_H')
+
+    # Init camera (or the replay of a recording)
+    cap = open_frame_source(camera_cfg)
+
+    if camera_cfg["capture_mode"] == "mjpeg_gray":
+        reduction = camera_cfg["decode_reduction"]
+        cap = MjpegGrayCapture(cap, camera_cfg["fps"], reduction)
+        if reduction > 1:
+            # Frames are decoded at reduced size: work in reduced pixel coordinates all the way
+            # and scale back up to full resolution camera coordinates as part of the homography
+            undistorter = undistorter.scaled(1 / reduction)
+            H = H @ np.diag([reduction, reduction, 1.0])
+
+    point_undistortion = cfg["detection"]["undistortion"] == "points"
+    if not point_undistortion:
+        undistorter.maps()  # Load the remap tables before the main loop starts
+
+    detector = build_detector(cfg["aruco_detection"], cfg["detection"])
+    preprocess = preprocess_mode(cfg["detection"]) == "always"
+
+    # Local HTTP endpoints (metrics, preview) - endpoints configured on the same address share a server
+    http_servers = {}
+    metrics_cfg = cfg["metrics"]
+    if metrics_cfg["enabled"]:
+        address = (metrics_cfg["host"], metrics_cfg["port"] + port_offset)
+        METRICS.serve(http_servers.setdefault(address, LocalHttpServer(*address)))
+
+    # Preview - "window" needs a display, "http" and "off" run headless
+    preview_cfg = cfg["preview"]
+    preview_undistorter = undistorter if point_undistortion else None
+    preview = None
+    if preview_cfg["mode"] == "window":
+        preview = WindowPreview(window_name, preview_cfg["fps"], preview_cfg["scale"], preview_undistorter)
+    elif preview_cfg["mode"] == "http":
+        address = (preview_cfg["host"], preview_cfg["port"] + port_offset)
+        preview = MjpegPreview(http_servers.setdefault(address, LocalHttpServer(*address)),
+                               preview_cfg["fps"], preview_cfg["scale"], preview_undistorter)
+
+    for http_server in http_servers.values():
+        http_server.start()
+
+    # Motion gate - regions are found in the raw frame, detection may run on the undistorted one
+    gate_cfg = cfg["detection"]["motion_gate"]
+    motion_gate = None
+    if gate_cfg["enabled"]:
+        motion_gate = MotionGate(gate_cfg["width"],
+                                 gate_cfg["pixel_threshold"],
+                                 gate_cfg["min_pixels"],
+                                 gate_cfg["max_regional"],
+                                 gate_cfg["padding_px"],
+                                 gate_cfg["refresh_interval"],
+                                 None if point_undistortion else undistorter.points,
+                                 ArucoMarkerDetector(cfg["aruco_detection"]["physical_marker_dict"],
+                                                     cfg["aruco_detection"]["detector_parameters"],
+                                                     cfg["aruco_detection"].get("active_ids")))
+
+    if cfg["detection"]["pipeline"] == "threaded":
+        run_service_pipelined(detector, cap, ws, H, undistorter, preprocess, point_undistortion,
+                              marker_filter, preview, motion_gate)
+    else:
+        run_service(detector, cap, ws, H, undistorter, preprocess, point_undistortion,
+                    marker_filter, preview, motion_gate)
+
+
+def build_marker_filter(filter_cfg):
+    if not filter_cfg["enabled"]:
+        return None
+    return MarkerFilter(filter_cfg["min_cutoff"],
+                        filter_cfg["beta"],
+                        filter_cfg["d_cutoff"],
+                        filter_cfg["predict"],
+                        filter_cfg["lead"],
+                        filter_cfg["max_coast"])
+
+
+if __name__ == "__main__":
+    CFG = load_config(r"service/config.json")
+    CAMERAS = camera_configs(CFG)
 
     # Init websocket
-    ws = WebSocketServer(port=5001)
+    if CFG["websocket"]["mode"] == "gateway":
+        # Clients are served by separate processes (python -m service.tasks.gateway)
+        ws = FramePublisher(CFG["websocket"]["gateway"]["ipc_address"])
+    else:
+        delta_cfg = CFG["websocket"]["delta"]
+        stream = DeltaStream(delta_cfg["threshold_px"], delta_cfg["keyframe_interval"]) if delta_cfg["enabled"] else None
+        ws = WebSocketServer(port=CFG["websocket"]["port"], stream=stream, slow_client_cfg=CFG["websocket"]["slow_client"],
+                             stats_interval=CFG["websocket"]["stats_interval"])
     ws.start()
-    
-    run_service(detector, cap, ws, H, True)
-    
+
+    marker_filter = build_marker_filter(CFG["detection"]["filter"])
+
+    if len(CAMERAS) > 1:
+        # One worker process per camera, their markers are merged here (see service/tasks/fusion.py)
+        from service.tasks.fusion import run_fusion
+        run_fusion(CFG, CAMERAS, ws, marker_filter)
+    else:
+        run_camera(CFG, CAMERAS[0], ws, marker_filter)
@@ -0,0 +1,138 @@
+from service.tasks.detection import run_camera, publish_frame
+from service.utils.calibration_bundle import CalibrationBundle
+from service.utils.metrics import METRICS
+from service.utils.http_server import LocalHttpServer
+from service.vision.aruco import MARKER_DTYPE
+from service.vision.fusion import MarkerFusion, marker_confidence
+from service.ws.ipc import FramePublisher, FrameSubscriber, LENGTH, FRAME_HEADER, encode_frame, decode_frame
+import multiprocessing
+import threading
+import cv2 as cv
+import numpy as np
+
+# Multi-camera mode: every camera runs the normal detection loop (run_camera) in its own worker process
+# and publishes its projector-space markers over the local IPC transport (see service/ws/ipc.py), with
+# one confidence per marker appended to every message (count x f32 after the marker records).
+# The service process merges the latest sets of all cameras (MarkerFusion) and broadcasts the result.
+CONFIDENCE_DTYPE = np.dtype("<f4")
+
+
+def encode_camera_frame(batch, seq: int, t_capture: float, confidence: np.ndarray) -> bytes:
+    message = bytearray(encode_frame(batch, seq, t_capture))
+    message += confidence.astype(CONFIDENCE_DTYPE).tobytes()
+    message[:LENGTH.size] = LENGTH.pack(len(message) - LENGTH.size)  # The length covers the confidences too
+    return bytes(message)
+
+
+def decode_camera_frame(payload: bytes) -> tuple:
+    """Returns (seq, t_capture, MarkerBatch, confidence) of a message without its length prefix."""
+    count = (len(payload) - FRAME_HEADER.size) // (MARKER_DTYPE.itemsize + CONFIDENCE_DTYPE.itemsize)
+    split = len(payload) - count * CONFIDENCE_DTYPE.itemsize
+    seq, t_capture, batch = decode_frame(payload[:split])
+    return seq, t_capture, batch, np.frombuffer(payload, CONFIDENCE_DTYPE, offset=split).astype(np.float32)
+
+
+class CameraPublisher(FramePublisher):
+    """
+    FramePublisher of a camera worker. Adds the confidence of every marker, computed from its corners
+    in the undistorted camera frame (w x h, full resolution) - mapped back through the inverse of the
+    camera-to-projector homography H, so the detection loop needs no changes.
+    """
+    PEER = "Fusion"
+
+    def __init__(self, address: str, H: np.ndarray, w: int, h: int) -> None:
+        super().__init__(address)
+        self.H_inv = np.linalg.inv(H)
+        self.w = w
+        self.h = h
+
+    def encode(self, batch, seq: int, t_capture: float) -> bytes:
+        confidence = np.empty(0, dtype=np.float32)
+        if len(batch):
+            corners = cv.perspectiveTransform(batch.corners.reshape(-1, 1, 2).astype(np.float64), self.H_inv)
+            confidence = marker_confidence(corners.reshape(-1, 4, 2), self.w, self.h)
+        return encode_camera_frame(batch, seq, t_capture, confidence)
+
+
+class CameraSubscriber(FrameSubscriber):
+    """Iterates over (seq, t_capture, MarkerBatch, confidence) published by a CameraPublisher."""
+    def decode(self, payload: bytes) -> tuple:
+        return decode_camera_frame(payload)
+
+
+def camera_address(fusion_cfg, index: int, camera_cfg) -> str:
+    return fusion_cfg["ipc_address"].format(index=index, name=camera_cfg["name"])
+
+
+def run_camera_worker(cfg, camera_cfg, address: str, port_offset: int) -> None:
+    """Entry point of a camera worker process."""
+    H = CalibrationBundle(camera_cfg["calibration_dir"]).homography("cam_to_proj_H")
+    publisher = CameraPublisher(address, H, camera_cfg["width"], camera_cfg["height"])
+    publisher.start()
+    # Filtering runs on the merged markers, a filter per camera would smooth across camera switches
+    run_camera(cfg, camera_cfg, publisher, None, port_offset, window_name=camera_cfg["name"])
+
+
+def run_fusion(cfg, cameras, ws, marker_filter=None) -> None:
+    """
+    Starts one worker process per camera and broadcasts the merged markers to `ws` whenever a camera
+    delivered a new set. The metrics and preview of camera i are served on the configured ports + i + 1.
+    """
+    if cfg["metrics"]["enabled"]:
+        http_server = LocalHttpServer(cfg["metrics"]["host"], cfg["metrics"]["port"])
+        METRICS.serve(http_server)
+        http_server.start()
+
+    fusion_cfg = cfg["fusion"]
+    fusion = MarkerFusion(len(cameras), fusion_cfg["max_missed_frames"], fusion_cfg["hysteresis"])
+    context = multiprocessing.get_context("spawn")  # Fork and OpenCV / threads do not mix
+    workers = []
+    for index, camera_cfg in enumerate(cameras):
+        address = camera_address(fusion_cfg, index, camera_cfg)
+        worker = context.Process(target=run_camera_worker, args=(cfg, camera_cfg, address, index + 1),
+                                 name=f"camera-{camera_cfg['name']}")
+        worker.start()
+        workers.append(worker)
+        print(f"Started camera {camera_cfg['name']} (pid {worker.pid}), markers on {address}")
+
+    cond = threading.Condition()
+    pending = [False]
+
+    def subscribe(index, camera_cfg):
+        frames = METRICS.counter("fusion_camera_frames_total", "Marker sets received per camera",
+                                 {"camera": camera_cfg["name"]})
+        for _, t_capture, batch, confidence in CameraSubscriber(camera_address(fusion_cfg, index, camera_cfg)):
+            frames.inc()
+            with cond:
+                fusion.update(index, t_capture, batch, confidence)
+                pending[0] = True
+                cond.notify()
+
+    for index, camera_cfg in enumerate(cameras):
+        threading.Thread(target=subscribe, args=(index, camera_cfg), name=f"fusion-{camera_cfg['name']}",
+                         daemon=True).start()
+
+    seq = -1
+    stopped = set()
+    try:
+        while len(stopped) < len(workers):
+            with cond:
+                # Sets arriving while the previous merge is broadcast are merged together
+                if not cond.wait_for(lambda: pending[0], timeout=1.0):
+                    for worker, camera_cfg in zip(workers, cameras):
+                        if not worker.is_alive() and worker.pid not in stopped:
+                            stopped.add(worker.pid)
+                            print(f"Camera {camera_cfg['name']} stopped (exit code {worker.exitcode})")
+                    continue
+                pending[0] = False
+                markers, t_capture = fusion.merge()
+            seq += 1
+            publish_frame(ws, markers, seq, t_capture, marker_filter)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Shutting down...")
+        for worker in workers:
+            worker.join(timeout=2)  # Workers got the Ctrl+C as well
+            if worker.is_alive():
+                worker.terminate()
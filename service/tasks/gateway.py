@@ -0,0 +1,28 @@
+from service.utils.file_utils import load_config
+from service.ws.ipc import FrameSubscriber
+from service.ws.server import WebSocketServer
+from service.ws.delta import DeltaStream
+
+
+def run_gateway(subscriber, ws):
+    """Serves the frames published by the detection process to the WebSocket clients."""
+    for seq, t_capture, batch in subscriber:
+        ws.broadcast(batch, seq, t_capture)
+
+
+if __name__ == "__main__":
+    # Several gateways can be started to spread many clients over processes/cores:
+    # they share the port (SO_REUSEPORT, Linux) and the kernel balances connections between them.
+    CFG = load_config(r"service/config.json")
+    WS_CFG = CFG["websocket"]
+
+    delta_cfg = WS_CFG["delta"]
+    stream = DeltaStream(delta_cfg["threshold_px"], delta_cfg["keyframe_interval"]) if delta_cfg["enabled"] else None
+    ws = WebSocketServer(port=WS_CFG["port"],
+                         stream=stream,
+                         slow_client_cfg=WS_CFG["slow_client"],
+                         reuse_port=WS_CFG["gateway"]["reuse_port"],
+                         stats_interval=WS_CFG["stats_interval"])
+    ws.start()
+
+    run_gateway(FrameSubscriber(WS_CFG["gateway"]["ipc_address"]), ws)
@@ -1,35 +1,168 @@
 from service.utils.platform_info import CURRENT_OS, OS
 from service.utils.file_utils import load_config
+from service.ws.codec import (BINARY_SUBPROTOCOL, BINARY_DELTA_SUBPROTOCOL, JSON_DELTA_SUBPROTOCOL,
+                              KIND_KEYFRAME, KIND_DELTA, decode_binary)
+import sys
 import json
+import time
 import asyncio
 import websockets
 import cv2 as cv
 import numpy as np
 
 SERVER_URI = "ws://localhost:5001"
+LATENCY_DURATION = 10  # seconds
+MARKER_KINDS = ("full", "keyframe", "delta")
 
-async def run(test_img):
+def parse_message(message):
+    """
+    Returns (kind, [(id, x, y), ...], removed ids) for a JSON or binary marker message.
+    For control messages (e.g. a clock_sync reply), kind is their "type".
+    """
+    if isinstance(message, bytes):
+        frame = decode_binary(message)
+        markers = frame["markers"]
+        kind = {KIND_KEYFRAME: "keyframe", KIND_DELTA: "delta"}.get(frame["kind"], "full")
+        points = list(zip(markers["id"].tolist(), markers["x"].tolist(), markers["y"].tolist()))
+        return kind, points, frame["removed"].tolist()
+
+    data = json.loads(message)
+    if "type" in data:
+        return data["type"], [], []
+    points = []
+    for marker in data.get("markers", []):
+        marker_data = marker.get("Data", {})
+        points.append((marker.get("Id"), marker_data.get("X", 0), marker_data.get("Y", 0)))
+    return data.get("kind", "full"), points, data.get("removed", [])
+
+
+def parse_timing(message):
+    """Returns (seq, t_capture, t_send) of a marker message (server clock)."""
+    if isinstance(message, bytes):
+        frame = decode_binary(message)
+        return frame["seq"], frame["t_capture"], frame["t_send"]
+    data = json.loads(message)
+    return data["seq"], data["t_capture"], data["t_send"]
+
+
+def parse_subscription(argv):
+    """
+    Subscription request from --ids 1,2,3 / --rect x0,y0,x1,y1 (repeatable) / --max-rate N; None without any.
+    """
+    request = {}
+    for flag, value in zip(argv, argv[1:]):
+        if flag == "--ids":
+            request["ids"] = [int(i) for i in value.split(",")]
+        elif flag == "--rect":
+            request.setdefault("rects", []).append([float(v) for v in value.split(",")])
+        elif flag == "--max-rate":
+            request["max_rate"] = float(value)
+    return {"type": "subscribe", **request} if request else None
+
+
+async def subscribe(websocket, subscription):
+    """Sends a subscription request and prints the server's confirmation (or error)."""
+    await websocket.send(json.dumps(subscription))
+    while True:
+        message = await websocket.recv()
+        if isinstance(message, str):
+            reply = json.loads(message)
+            if reply.get("type") in ("subscribed", "error"):
+                print(f"Subscription: {reply}")
+                return
+
+
+async def sync_clock(websocket, samples=8):
+    """
+    Clock-sync handshake: returns (round trip, offset) with offset = server clock - client clock,
+    estimated NTP-style from the sample with the shortest round trip.
+    """
+    best = None
+    for _ in range(samples):
+        t0 = time.time()
+        await websocket.send(json.dumps({"type": "clock_sync", "t0": t0}))
+        while True:
+            message = await websocket.recv()
+            t3 = time.time()
+            if isinstance(message, str):
+                reply = json.loads(message)
+                if reply.get("type") == "clock_sync" and reply.get("t0") == t0:
+                    break
+        rtt = (t3 - t0) - (reply["t2"] - reply["t1"])
+        offset = ((reply["t1"] - t0) + (reply["t2"] - t3)) / 2
+        if best is None or rtt < best[0]:
+            best = (rtt, offset)
+    return best
+
+
+async def measure_latency(binary=False, duration=LATENCY_DURATION, subscription=None):
+    """Receives the full marker stream for `duration` seconds and reports latency percentiles and sequence gaps."""
+    print(f"Connecting to {SERVER_URI}...")
+    async with websockets.connect(SERVER_URI, subprotocols=[BINARY_SUBPROTOCOL] if binary else None) as websocket:
+        if subscription is not None:
+            await subscribe(websocket, subscription)
+        rtt, offset = await sync_clock(websocket)
+        print(f"Clock offset (server - client): {offset * 1e3:.2f}ms, round trip: {rtt * 1e3:.2f}ms")
+        print(f"Measuring for {duration}s...")
+
+        capture_latency, send_latency = [], []
+        last_seq, gaps, missed = None, 0, 0
+        t_end = time.time() + duration
+        while time.time() < t_end:
+            try:
+                message = await asyncio.wait_for(websocket.recv(), max(t_end - time.time(), 0.01))
+            except asyncio.TimeoutError:
+                break
+            t_receive = time.time()
+            if parse_message(message)[0] not in MARKER_KINDS:
+                continue
+            seq, t_capture, t_send = parse_timing(message)
+            capture_latency.append(t_receive - (t_capture - offset))
+            send_latency.append(t_receive - (t_send - offset))
+            if last_seq is not None and seq > last_seq + 1:
+                gaps += 1
+                missed += seq - last_seq - 1
+            last_seq = seq
+
+    if not capture_latency:
+        print("No marker messages received")
+        return
+    print(f"Messages: {len(capture_latency)}, gaps: {gaps} ({missed} frames not received)")
+    for name, values in (("capture -> receive", capture_latency), ("send -> receive", send_latency)):
+        p50, p95, p99 = np.percentile(np.array(values) * 1e3, [50, 95, 99])
+        print(f"{name:<19} p50 {p50:7.2f}ms | p95 {p95:7.2f}ms | p99 {p99:7.2f}ms")
+
+
+async def run(test_img, binary=False, delta=False, subscription=None):
     print(f"Connecting to {SERVER_URI}...")
-    async with websockets.connect(SERVER_URI) as websocket:
-        print("Connected. Waiting for messages...\n")
+    if delta:
+        subprotocols = [BINARY_DELTA_SUBPROTOCOL if binary else JSON_DELTA_SUBPROTOCOL]
+    else:
+        subprotocols = [BINARY_SUBPROTOCOL] if binary else None
+    async with websockets.connect(SERVER_URI, subprotocols=subprotocols) as websocket:
+        print(f"Connected (subprotocol: {websocket.subprotocol or 'json'}). Waiting for messages...\n")
+        if subscription is not None:
+            await subscribe(websocket, subscription)
 
+        markers = {}  # id -> (x, y), accumulated for delta streams
         try:
             async for message in websocket:
-                print("Received:", message)
+                kind, points, removed = parse_message(message)
+                if kind not in MARKER_KINDS:
+                    continue
+                print(f"Received {kind}:", points, f"removed: {removed}" if removed else "")
 
-                # Parse JSON message
-                data = json.loads(message)
+                if kind != "delta":
+                    markers = {}
+                for marker_id in removed:
+                    markers.pop(marker_id, None)
+                markers.update({marker_id: (x, y) for marker_id, x, y in points})
 
                 # Clone base image so we redraw fresh every frame
                 frame = test_img.copy()
-                if "markers" in data:
-                    for marker in data["markers"]:
-                        marker_data = marker.get("Data", {})
-                        x = int(marker_data.get("X", 0))
-                        y = int(marker_data.get("Y", 0))
-
-                        # Draw red dot (BGR: 0,0,255)
-                        cv.circle(frame, (x, y), radius=10, color=(0, 0, 255), thickness=-1)
+                for x, y in markers.values():
+                    # Draw red dot (BGR: 0,0,255)
+                    cv.circle(frame, (int(x), int(y)), radius=10, color=(0, 0, 255), thickness=-1)
                 # Show updated image
                 cv.imshow("Markers", cv.resize(frame, None, fx=0.3, fy=0.3))
                 cv.waitKey(1)
@@ -38,6 +171,13 @@ async def run(test_img):
             print("Connection closed")
 
 if __name__ == "__main__":
+    # Optional subscription: [--ids 1,2,3] [--rect x0,y0,x1,y1] [--max-rate 10]
+    subscription = parse_subscription(sys.argv)
+    if "--latency" in sys.argv:
+        # Headless measurement mode: python -m service.test_client --latency [--binary]
+        asyncio.run(measure_latency(binary="--binary" in sys.argv, subscription=subscription))
+        sys.exit(0)
+
     CFG = load_config(r"service/config.json")
     test_img = cv.imread(r"C:\Users\ExploraVision\Src\ar_table_backend_service\text-test-4k.png")
     cam_to_proj_H = np.load(r"C:\Users\ExploraVision\Src\ar_table_backend_service\service\calibration\cam_to_proj_H.npy")
@@ -50,4 +190,4 @@ if __name__ == "__main__":
     cv.setWindowProperty(WNAME, cv.WND_PROP_FULLSCREEN, cv.WINDOW_FULLSCREEN)
     cv.imshow(WNAME, test_img)
     cv.waitKey(1)
-    asyncio.run(run(test_img))
+    asyncio.run(run(test_img, binary="--binary" in sys.argv, delta="--delta" in sys.argv, subscription=subscription))
@@ -0,0 +1,30 @@
+import numpy as np
+
+
+class BufferPool:
+    """
+    Preallocated output arrays for the detection hot loop, so that steady-state frames allocate no
+    large arrays. Pass the arrays as `dst=` to OpenCV calls.
+    `get` hands out the buffers of a name round-robin from a ring of `slots` arrays: a buffer is only
+    written again `slots` calls later, so whoever receives a frame may keep it for slots - 1 further
+    frames (pipeline queues, the preview thread, the last result re-sent for skipped frames).
+    Scratch buffers that never leave the function using them need only one slot.
+    Rings are reallocated when the requested shape or dtype changes. Not thread-safe: one pool per thread.
+    """
+    def __init__(self, slots: int = 2) -> None:
+        self.slots = slots
+        self._rings = {}  # name -> (list of arrays, index of the next one)
+
+    def get(self, name: str, shape, dtype=np.uint8, slots: int = None) -> np.ndarray:
+        shape = tuple(shape)
+        ring = self._rings.get(name)
+        if ring is None or ring[0][0].shape != shape or ring[0][0].dtype != dtype:
+            ring = ([np.empty(shape, dtype) for _ in range(slots or self.slots)], 0)
+        arrays, idx = ring
+        self._rings[name] = (arrays, (idx + 1) % len(arrays))
+        return arrays[idx]
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the pool."""
+        return sum(a.nbytes for arrays, _ in self._rings.values() for a in arrays)
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from service.utils.transform_utils import Undistorter
+
+# The calibration bundle is a directory next to the calibration files with everything the services
+# load at startup, in a form that needs no computation:
+#   manifest.json            - bundle version, hash of the camera calibration, the stored entries
+#   <name>.npy               - homographies (cam_to_proj_H, bounding_box_H)
+#   maps_<key>_a/b.npy       - fixed-point undistortion remap tables, memory-mapped when loaded
+# Remap tables are keyed by a hash of the camera matrices, resolution and scale, so every resolution
+# in use (decode reduction, preview scale) gets its own tables. The whole bundle is rebuilt when
+# undistortion_args.npz changes, homographies are re-imported when their .npy file changes.
+CALIBRATION_DIR = "service/calibration"
+UNDISTORTION_FILE = "undistortion_args.npz"
+BUNDLE_DIR = "bundle"
+MANIFEST_FILE = "manifest.json"
+BUNDLE_VERSION = 1
+
+
+def _hash(*arrays) -> str:
+    h = hashlib.sha256()
+    for a in arrays:
+        a = np.ascontiguousarray(a, dtype=np.float64)
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()[:16]
+
+
+class CalibrationBundle:
+    """
+    Loads the calibration from `calib_dir` through the bundle at `path` (default: <calib_dir>/bundle).
+    Missing or stale entries are computed from the calibration files once and stored.
+    """
+    def __init__(self, calib_dir: str = CALIBRATION_DIR, path: str = None) -> None:
+        self.calib_dir = calib_dir
+        self.path = path or os.path.join(calib_dir, BUNDLE_DIR)
+        ud = np.load(os.path.join(calib_dir, UNDISTORTION_FILE))
+        self.camMtx = ud["camMtx"]
+        self.distCoeffs = ud["distCoeff"]
+        self.camMtxNew = ud["camMtxNew"]
+        self.calibration = _hash([BUNDLE_VERSION], self.camMtx, self.distCoeffs, self.camMtxNew)
+
+        os.makedirs(self.path, exist_ok=True)
+        self.manifest = self._read_manifest()
+        if self.manifest.get("version") != BUNDLE_VERSION or self.manifest.get("calibration") != self.calibration:
+            if self.manifest:
+                print(f"Camera calibration changed, rebuilding calibration bundle {self.path}")
+            for name in os.listdir(self.path):
+                if name.endswith(".npy"):
+                    os.remove(os.path.join(self.path, name))
+            self.manifest = {"version": BUNDLE_VERSION, "calibration": self.calibration, "maps": {}, "homographies": {}}
+            self._write_manifest(self.manifest)
+
+    def undistorter(self, w: int, h: int) -> Undistorter:
+        """Undistorter for frames of w x h whose remap tables come from the bundle."""
+        return Undistorter(self.camMtx, self.distCoeffs, self.camMtxNew, w, h, cache=self)
+
+    def maps(self, undistorter: Undistorter, scale: float = 1.0) -> tuple:
+        """Remap tables of `undistorter` at `scale` (see Undistorter.maps): memory-mapped, or built and stored."""
+        key = _hash(undistorter.camMtx, undistorter.distCoeffs, undistorter.camMtxNew,
+                    [undistorter.w, undistorter.h, scale])
+        entry = self.manifest["maps"].get(key)
+        if entry is not None:
+            try:
+                return tuple(np.load(os.path.join(self.path, name), mmap_mode="r") for name in entry["files"])
+            except (OSError, ValueError):
+                pass  # Deleted or truncated - rebuild
+
+        t0 = time.perf_counter()
+        maps = undistorter.build_maps(scale)
+        files = [f"maps_{key}_a.npy", f"maps_{key}_b.npy"]
+        for name, array in zip(files, maps):
+            self._save(name, array)
+        w, h = maps[1].shape[::-1]
+        self._update("maps", key, {"files": files, "width": w, "height": h, "scale": scale})
+        print(f"Built undistortion maps for {w}x{h} in {time.perf_counter() - t0:.2f}s, stored in {self.path}")
+        return maps
+
+    def homography(self, name: str) -> np.ndarray:
+        """Homography `name` (e.g. "cam_to_proj_H"), re-imported from <calib_dir>/<name>.npy if that file changed."""
+        source = os.path.join(self.calib_dir, name + ".npy")
+        entry = self.manifest["homographies"].get(name)
+        if not os.path.exists(source) and entry is not None:
+            return np.load(os.path.join(self.path, entry["file"]))
+        stat = os.stat(source)
+        signature = [stat.st_mtime_ns, stat.st_size]
+        if entry is not None and entry["source"] == signature:
+            return np.load(os.path.join(self.path, entry["file"]))
+        H = np.load(source)
+        self._save(name + ".npy", H)
+        self._update("homographies", name, {"file": name + ".npy", "source": signature})
+        return H
+
+    def save_homography(self, name: str, H: np.ndarray) -> None:
+        """Stores a new homography in the calibration directory and the bundle."""
+        np.save(os.path.join(self.calib_dir, name + ".npy"), H)
+        self.homography(name)
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.path, MANIFEST_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_manifest(self, manifest: dict) -> None:
+        tmp = os.path.join(self.path, f"{MANIFEST_FILE}.{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp, os.path.join(self.path, MANIFEST_FILE))
+
+    def _update(self, section: str, key: str, entry: dict) -> None:
+        # Re-read first: other processes (gateways, other cameras) may have added entries meanwhile
+        manifest = self._read_manifest()
+        if manifest.get("calibration") != self.calibration:
+            manifest = self.manifest
+        manifest[section][key] = entry
+        self._write_manifest(manifest)
+        self.manifest = manifest
+
+    def _save(self, name: str, array: np.ndarray) -> None:
+        # Write and rename, so a concurrently starting process never maps a half-written file
+        tmp = os.path.join(self.path, f"{name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp, os.path.join(self.path, name))
+
+
+def _test_bundle_cache():  # TEMPORARY - add testing package at some point
+    """Checks that cached maps equal freshly computed ones and that calibration changes invalidate the bundle."""
+    import shutil
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in (UNDISTORTION_FILE, "cam_to_proj_H.npy"):
+            shutil.copy(os.path.join(CALIBRATION_DIR, name), tmp)
+
+        reference = Undistorter.load(os.path.join(tmp, UNDISTORTION_FILE), 640, 360)
+        built = CalibrationBundle(tmp).undistorter(640, 360).maps()
+        loaded = CalibrationBundle(tmp).undistorter(640, 360).maps()
+        assert isinstance(loaded[0], np.memmap)
+        for a, b, c in zip(reference.maps(), built, loaded):
+            assert np.array_equal(a, b) and np.array_equal(a, c)
+        assert CalibrationBundle(tmp).undistorter(1280, 720).scaled(0.5).maps()[0].shape == built[0].shape
+
+        bundle = CalibrationBundle(tmp)
+        H = bundle.homography("cam_to_proj_H")
+        bundle.save_homography("cam_to_proj_H", 2 * H)
+        assert np.array_equal(CalibrationBundle(tmp).homography("cam_to_proj_H"), 2 * H)
+
+        ud = dict(np.load(os.path.join(tmp, UNDISTORTION_FILE)))
+        ud["distCoeff"] = ud["distCoeff"] * 0.5
+        np.savez(os.path.join(tmp, UNDISTORTION_FILE), **ud)
+        bundle = CalibrationBundle(tmp)
+        assert not bundle.manifest["maps"]
+        changed = bundle.undistorter(640, 360).maps()
+        assert not np.array_equal(changed[0], built[0])
+
+
+if __name__ == "__main__":
+    # Builds the bundle of every configured camera, so the first service start is fast too
+    from service.utils.file_utils import load_config, camera_configs
+    CFG = load_config(r"service/config.json")
+    for camera_cfg in camera_configs(CFG):
+        t0 = time.perf_counter()
+        bundle = CalibrationBundle(camera_cfg["calibration_dir"])
+        undistorter = bundle.undistorter(camera_cfg["width"], camera_cfg["height"])
+        reduction = camera_cfg["decode_reduction"] if camera_cfg["capture_mode"] == "mjpeg_gray" else 1
+        if reduction > 1:
+            undistorter = undistorter.scaled(1 / reduction)
+        undistorter.maps()
+        undistorter.maps(CFG["preview"]["scale"])
+        for name in ("cam_to_proj_H", "bounding_box_H"):
+            bundle.homography(name)
+        print(f"Calibration bundle {bundle.path} ready in {time.perf_counter() - t0:.2f}s")
@@ -4,3 +4,22 @@ def load_config(pth):
     with open(pth, 'r') as f:
         return json.load(f)
 
+
+
+def camera_configs(cfg):
+    """
+    The configuration of every camera: each `cameras` entry overrides the keys of the `camera` block it
+    sets (default `calibration_dir`: service/calibration/<name>). Without `cameras` entries, just the `camera` block (named
+    "main", calibrated in service/calibration). Recordings of several cameras go to <path>_<name>.
+    """
+    base = {"name": "main", "calibration_dir": "service/calibration", **cfg["camera"]}
+    entries = cfg.get("cameras") or []
+    if not entries:
+        return [base]
+    cameras = []
+    for entry in entries:
+        camera_cfg = {**base, "calibration_dir": f"service/calibration/{entry['name']}", **entry}
+        camera_cfg["recording"] = {**base["recording"], "path": f"{base['recording']['path']}_{entry['name']}",
+                                   **entry.get("recording", {})}
+        cameras.append(camera_cfg)
+    return cameras
@@ -0,0 +1,46 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LocalHttpServer:
+    """
+    Minimal HTTP server for local debugging endpoints (preview, metrics).
+    Handlers are registered per path with `route` and are called with the request handler,
+    on one thread per request, so long-running responses (streams) do not block other requests.
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 8080) -> None:
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self._server = None
+
+    def route(self, path: str, handler) -> None:
+        self.routes[path] = handler
+
+    def start(self) -> None:
+        routes = self.routes
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                handler = routes.get(self.path.split("?", 1)[0])
+                if handler is None:
+                    self.send_error(404)
+                    return
+                try:
+                    handler(self)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # Client went away
+
+            def log_message(self, format, *args):
+                pass  # Keep the service log clean
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"HTTP server listening on http://{self.host}:{self.port} ({', '.join(sorted(routes))})")
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
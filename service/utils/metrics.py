@@ -0,0 +1,199 @@
+import threading
+import time
+import numpy as np
+
+# Lightweight, always-on metrics for the hot path. Recording a sample is a list assignment,
+# percentiles are only computed when the metrics are read (Prometheus scrape, stats message).
+PREFIX = "artable_"
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _label_str(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+def _fmt(value) -> str:
+    value = float(value)
+    return "NaN" if value != value else repr(value)
+
+
+class Histogram:
+    """Rolling window of the last `window` samples, plus the all-time count and sum."""
+    def __init__(self, window: int = 1024) -> None:
+        self.window = window
+        self.count = 0
+        self.sum = 0.0
+        self._samples = [0.0] * window
+
+    def observe(self, value: float) -> None:
+        self._samples[self.count % self.window] = value
+        self.count += 1
+        self.sum += value
+
+    def time(self):
+        """Context manager that observes the duration of its block in seconds."""
+        return _Timer(self)
+
+    def quantiles(self, quantiles=QUANTILES) -> list:
+        n = min(self.count, self.window)
+        if n == 0:
+            return [float("nan")] * len(quantiles)
+        return np.quantile(self._samples[:n], quantiles).tolist()
+
+
+class _Timer:
+    __slots__ = ("histogram", "t0")
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.t0)
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, n: int = 1) -> None:
+        self.value += n
+
+
+class Gauge:
+    """Either set explicitly, or read from `fn` when the metrics are collected."""
+    def __init__(self, fn=None) -> None:
+        self.fn = fn
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def get(self) -> float:
+        return self.fn() if self.fn is not None else self.value
+
+
+class MetricsRegistry:
+    """
+    Named metrics, optionally with labels (e.g. stage="detect"). Asking for the same name and labels
+    again returns the same metric, so modules can look their metrics up once and keep the reference.
+    Labeled families whose label values come and go (e.g. per client) can be provided by a collector
+    function returning {labels tuple: value}.
+    """
+    def __init__(self) -> None:
+        self._metrics = {}      # (name, labels tuple) -> metric
+        self._help = {}         # name -> (type, help)
+        self._collectors = {}   # name -> fn() returning {labels tuple: value}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, kind, name, help, labels, **kwargs):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            if key not in self._metrics:
+                self._metrics[key] = cls(**kwargs)
+                self._help.setdefault(name, (kind, help))
+            return self._metrics[key]
+
+    def histogram(self, name: str, help: str = "", labels: dict = None, window: int = 1024) -> Histogram:
+        return self._get(Histogram, "summary", name, help, labels, window=window)
+
+    def counter(self, name: str, help: str = "", labels: dict = None) -> Counter:
+        return self._get(Counter, "counter", name, help, labels)
+
+    def gauge(self, name: str, help: str = "", labels: dict = None, fn=None) -> Gauge:
+        gauge = self._get(Gauge, "gauge", name, help, labels)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def collector(self, name: str, help: str, fn) -> None:
+        with self._lock:
+            self._help[name] = ("gauge", help)
+            self._collectors[name] = fn
+
+    def _families(self):
+        """Yields (name, kind, help, [(labels dict, metric or value)]) sorted by name."""
+        with self._lock:
+            metrics = list(self._metrics.items())
+            collectors = list(self._collectors.items())
+            help = dict(self._help)
+        families = {}
+        for (name, labels), metric in metrics:
+            families.setdefault(name, []).append((dict(labels), metric))
+        for name, fn in collectors:
+            families.setdefault(name, []).extend((dict(labels), value) for labels, value in fn().items())
+        for name in sorted(families):
+            kind, text = help[name]
+            yield name, kind, text, families[name]
+
+    def prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, kind, text, members in self._families():
+            full = PREFIX + name
+            lines.append(f"# HELP {full} {text}")
+            lines.append(f"# TYPE {full} {kind}")
+            for labels, metric in members:
+                if isinstance(metric, Histogram):
+                    for q, v in zip(QUANTILES, metric.quantiles()):
+                        lines.append(f"{full}{_label_str({**labels, 'quantile': q})} {_fmt(v)}")
+                    lines.append(f"{full}_sum{_label_str(labels)} {_fmt(metric.sum)}")
+                    lines.append(f"{full}_count{_label_str(labels)} {metric.count}")
+                elif isinstance(metric, Counter):
+                    lines.append(f"{full}{_label_str(labels)} {metric.value}")
+                elif isinstance(metric, Gauge):
+                    lines.append(f"{full}{_label_str(labels)} {_fmt(metric.get())}")
+                else:
+                    lines.append(f"{full}{_label_str(labels)} {_fmt(metric)}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _value(metric):
+        if isinstance(metric, Histogram):
+            value = {f"p{int(q * 100)}_ms": round(v * 1e3, 3)
+                     for q, v in zip(QUANTILES, metric.quantiles()) if v == v}  # NaN: no samples yet
+            value["count"] = metric.count
+            return value
+        if isinstance(metric, Counter):
+            return metric.value
+        if isinstance(metric, Gauge):
+            return metric.get()
+        return metric
+
+    def snapshot(self) -> dict:
+        """
+        All metrics as a JSON-serializable dict (histograms as p50/p95/p99 in milliseconds).
+        Unlabeled metrics map to their value, labeled families to a list of {labels..., "value": value}.
+        """
+        out = {}
+        for name, _, _, members in self._families():
+            if len(members) == 1 and not members[0][0]:
+                out[name] = self._value(members[0][1])
+            else:
+                out[name] = [{**labels, "value": self._value(metric)} for labels, metric in members]
+        return out
+
+    def serve(self, http_server) -> None:
+        """Exposes the metrics on /metrics of a LocalHttpServer."""
+        def handler(request):
+            body = self.prometheus().encode()
+            request.send_response(200)
+            request.send_header("Content-Type", "text/plain; version=0.0.4")
+            request.send_header("Content-Length", str(len(body)))
+            request.end_headers()
+            request.wfile.write(body)
+        http_server.route("/metrics", handler)
+
+
+# Process-wide registry, like a logger: modules record into it without having it passed around
+METRICS = MetricsRegistry()
+
+
+def stage_histogram(stage: str) -> Histogram:
+    """Histogram of the per-frame duration of a pipeline stage."""
+    return METRICS.histogram("stage_seconds", "Duration of one pipeline stage per frame", {"stage": stage})
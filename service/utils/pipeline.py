@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import deque
+
+
+class QueueClosed(Exception):
+    """Raised by LatestQueue.get once the queue has been closed and drained."""
+
+
+class LatestQueue:
+    """
+    Bounded queue that never blocks the producer.
+    When full, the oldest item is dropped in favour of the new one (latest-wins),
+    so consumers always work on the most recent data and latency cannot pile up.
+    """
+    def __init__(self, maxsize: int = 1) -> None:
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, item) -> None:
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout: float = None):
+        """Blocks until an item is available. Raises QueueClosed once closed and empty."""
+        with self._cond:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._items:
+                if self._closed:
+                    raise QueueClosed()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            return self._items.popleft()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+
+class FramePacket:
+    """Data handed from one pipeline stage to the next."""
+    def __init__(self, seq: int, t_capture: float, frame) -> None:
+        self.seq = seq
+        self.t_capture = t_capture
+        self.frame = frame
+        self.decode = None  # Set if `frame` still holds the undecoded capture buffer
+        self.change = None  # Motion gate decision (see MotionGate.check)
+        self.detection_frame = None
+        self.corners = None
+        self.ids = None
+        self.markers = None  # MarkerBatch
+
+
+class PipelineStage(threading.Thread):
+    """
+    Worker thread that takes items from `inbox`, applies `fn` and pushes the result to `outbox`.
+    Returning None from `fn` drops the item. Closing the inbox stops the stage and closes the outbox.
+    If `fn` raises, the stage stops the same way and keeps the exception in `error`, for the thread
+    running the pipeline to re-raise (see raise_stage_error).
+    """
+    def __init__(self, name: str, fn, inbox: LatestQueue, outbox: LatestQueue) -> None:
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.error = None
+
+    def run(self) -> None:
+        try:
+            while True:
+                try:
+                    item = self.inbox.get()
+                except QueueClosed:
+                    break
+                out = self.fn(item)
+                if out is not None:
+                    self.outbox.put(out)
+        except Exception as e:
+            print(f"Pipeline stage {self.name} failed: {e!r}")
+            self.error = e
+            self.inbox.close()
+        finally:
+            self.outbox.close()
+
+
+def raise_stage_error(stages) -> None:
+    """Re-raises the exception of the first failed PipelineStage of `stages`, if any."""
+    for stage in stages:
+        if stage.error is not None:
+            raise RuntimeError(f"Pipeline stage {stage.name} failed") from stage.error
@@ -12,3 +12,71 @@ def dist_to_map(camMtx, distCoeffs, camMtxNew, w, h):
         cv.CV_16SC2
     )
     return map_a, map_b
+
+
+class Undistorter:
+    """
+    Holds the camera intrinsics from undistortion_args.npz. Undistorts either full frames
+    (via cached remap tables) or only individual points, which is much cheaper when only the
+    marker corners are needed downstream.
+    With a `cache` (CalibrationBundle), remap tables are loaded from disk instead of being computed.
+    """
+    def __init__(self, camMtx, distCoeffs, camMtxNew, w, h, cache=None):
+        self.camMtx = camMtx
+        self.distCoeffs = distCoeffs
+        self.camMtxNew = camMtxNew
+        self.w = w
+        self.h = h
+        self.cache = cache
+        self._maps = {}  # scale -> (map_a, map_b)
+
+    @staticmethod
+    def load(pth, w, h, cache=None):
+        ud = np.load(pth)
+        return Undistorter(ud["camMtx"], ud["distCoeff"], ud["camMtxNew"], w, h, cache)
+
+    def scaled(self, scale: float):
+        """Undistorter for frames captured at `scale` times the calibration resolution."""
+        S = np.diag([scale, scale, 1.0])
+        return Undistorter(S @ self.camMtx,
+                           self.distCoeffs,
+                           S @ self.camMtxNew,
+                           int(round(self.w * scale)),
+                           int(round(self.h * scale)),
+                           self.cache)
+
+    def maps(self, scale: float = 1.0):
+        """Remap tables producing an undistorted image resized by `scale`."""
+        if scale not in self._maps:
+            if self.cache is not None:
+                self._maps[scale] = self.cache.maps(self, scale)
+            else:
+                self._maps[scale] = self.build_maps(scale)
+        return self._maps[scale]
+
+    def build_maps(self, scale: float = 1.0):
+        """Computes the remap tables of `maps` (fixed-point, CV_16SC2 + CV_16UC1)."""
+        S = np.diag([scale, scale, 1.0])
+        return dist_to_map(self.camMtx,
+                           self.distCoeffs,
+                           S @ self.camMtxNew,
+                           int(round(self.w * scale)),
+                           int(round(self.h * scale)))
+
+    def remap(self, frame, scale: float = 1.0, dst=None):
+        """Undistorted `frame` resized by `scale`, written into `dst` if given (see `output_shape`)."""
+        map_a, map_b = self.maps(scale)
+        return cv.remap(frame, map_a, map_b, interpolation=cv.INTER_LINEAR, dst=dst)
+
+    def output_shape(self, frame, scale: float = 1.0) -> tuple:
+        """Shape of `remap(frame, scale)`."""
+        return (int(round(self.h * scale)), int(round(self.w * scale))) + frame.shape[2:]
+
+    def points(self, pts):
+        """Maps points from the raw (distorted) frame into the undistorted frame. Keeps the input shape."""
+        pts = np.asarray(pts, dtype=np.float32)
+        undistorted = cv.undistortPoints(pts.reshape(-1, 1, 2),
+                                         self.camMtx,
+                                         self.distCoeffs,
+                                         P=self.camMtxNew)
+        return undistorted.reshape(pts.shape)
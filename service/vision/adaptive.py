@@ -0,0 +1,133 @@
+from service.vision.aruco import ArucoMarkerDetector, padded_roi
+from service.vision.camera import Preprocessor
+from service.utils.buffers import BufferPool
+from service.utils.metrics import METRICS, stage_histogram
+import cv2 as cv
+import numpy as np
+
+ENHANCE_TIME = stage_histogram("enhance")
+CASCADE_FRAMES = {result: METRICS.counter("preprocess_cascade_frames_total",
+                                          "Frames by outcome of the adaptive preprocessing cascade", {"result": result})
+                  for result in ("raw", "recovered", "failed")}
+SEARCHED = METRICS.counter("preprocess_markers_searched_total", "Missing markers searched for on enhanced regions")
+RECOVERED = METRICS.counter("preprocess_markers_recovered_total", "Missing markers found on enhanced regions")
+
+
+class AdaptivePreprocessDetector:
+    """
+    Preprocessing cascade: detects on the raw frame first and only runs the preprocessing when markers are
+    missing - and only on crops around the positions where the missing markers were last seen.
+    Markers that have not been seen for `forget_after` frames are no longer searched for (they were removed).
+    With `expected_count`, fewer markers than that with no known position to search triggers an enhanced
+    full-frame detection, at most every `full_interval` frames.
+    The crops are detected with `roi_detector`, else with `detector` - an ArucoMarkerDetector (see
+    detect_roi) either way, e.g. the plain detector when `detector` is tiled.
+    Counters (see METRICS): frames by outcome raw / recovered / failed, markers searched and recovered,
+    and the "enhance" stage time, to tell whether preprocessing pays for itself.
+    """
+    def __init__(self, detector: ArucoMarkerDetector, expected_count: int = None, padding: float = 0.5,
+                 min_padding_px: int = 64, forget_after: int = 30, full_interval: int = 30,
+                 roi_detector: ArucoMarkerDetector = None) -> None:
+        self.detector = detector
+        self.roi_detector = detector if roi_detector is None else roi_detector
+        self.expected_count = expected_count
+        self.padding = padding
+        self.min_padding_px = min_padding_px
+        self.forget_after = forget_after
+        self.full_interval = full_interval
+        self.last_seen = {}  # id -> ((4, 2) corners, frames since seen)
+        self.frames_since_full = full_interval
+        self.preprocess_crop = Preprocessor()  # Crop sizes vary, buffers would be reallocated anyway
+        self.preprocess_full = Preprocessor(BufferPool(1))  # Detected before the next full-frame enhancement
+
+    def detect(self, img: np.ndarray, debug: bool = False) -> tuple:
+        """Same contract as ArucoMarkerDetector.detect."""
+        self.frames_since_full += 1
+        corners, ids = self.detector.detect(img, debug)
+        found = {} if ids is None else {int(i): c.reshape(4, 2) for c, i in zip(corners, ids.flatten())}
+
+        missing = [marker_id for marker_id in self.last_seen if marker_id not in found]
+        short = self.expected_count is not None and len(found) < self.expected_count
+        if not missing and not short:
+            CASCADE_FRAMES["raw"].inc()
+            return self._result(found)
+
+        count = len(found)
+        with ENHANCE_TIME.time():
+            for marker_id in missing:
+                if marker_id in found:  # Already recovered in a neighbouring crop
+                    continue
+                roi = padded_roi(self.last_seen[marker_id][0], img.shape, self.padding, self.min_padding_px)
+                crop_corners, crop_ids = self.roi_detector.detect_roi(img, roi, self.preprocess_crop)
+                if crop_ids is None:
+                    continue
+                for c, i in zip(crop_corners, crop_ids.flatten()):
+                    found.setdefault(int(i), c.reshape(4, 2))
+
+            short = self.expected_count is not None and len(found) < self.expected_count
+            if short and self.frames_since_full >= self.full_interval:
+                # Markers without a known position (never seen yet) can only be found on the full frame
+                self.frames_since_full = 0
+                full_corners, full_ids = self.detector.detect(self.preprocess_full(img))
+                if full_ids is not None:
+                    for c, i in zip(full_corners, full_ids.flatten()):
+                        found.setdefault(int(i), c.reshape(4, 2))
+
+        SEARCHED.inc(len(missing))
+        RECOVERED.inc(len(found) - count)
+        CASCADE_FRAMES["recovered" if len(found) > count else "failed"].inc()
+        return self._result(found)
+
+    def _result(self, found: dict) -> tuple:
+        for marker_id, (corners, age) in list(self.last_seen.items()):
+            if marker_id not in found:
+                if age + 1 >= self.forget_after:
+                    del self.last_seen[marker_id]
+                else:
+                    self.last_seen[marker_id] = (corners, age + 1)
+        for marker_id, corners in found.items():
+            self.last_seen[marker_id] = (corners, 0)
+
+        if not found:
+            return (), None
+        ids_cv = np.array(list(found.keys()), dtype=np.int32).reshape(-1, 1)
+        corners_cv = tuple(c.reshape(1, 4, 2).astype(np.float32) for c in found.values())
+        return corners_cv, ids_cv
+
+    def close(self) -> None:
+        """Closes the raw-frame detector, which may own a worker pool (tiled backend)."""
+        if hasattr(self.detector, "close"):
+            self.detector.close()
+
+
+def _test_adaptive_preprocess():  # TEMPORARY - add testing package at some point
+    """Checks that a marker lost on the raw frame is recovered on its enhanced region, and forgotten once removed."""
+    dictionary = cv.aruco.getPredefinedDictionary(cv.aruco.DICT_4X4_250)
+    img = np.full((720, 1280), 255, dtype=np.uint8)
+    for k, x in enumerate((100, 500, 900)):
+        img[300:360, x:x + 60] = cv.aruco.generateImageMarker(dictionary, k, 60)
+
+    # Marker 2 at very low contrast: only found after CLAHE / thresholding
+    low = img.copy()
+    low[200:460, 780:1080] = 120 + (low[200:460, 780:1080] > 0) * 9
+
+    detector = AdaptivePreprocessDetector(ArucoMarkerDetector("DICT_4X4_250"), forget_after=3)
+    raw = ArucoMarkerDetector("DICT_4X4_250")
+    assert sorted(detector.detect(img)[1].ravel().tolist()) == [0, 1, 2]
+    assert sorted(raw.detect(low)[1].ravel().tolist()) == [0, 1]
+
+    recovered = RECOVERED.value
+    corners, ids = detector.detect(low)
+    assert sorted(ids.ravel().tolist()) == [0, 1, 2]
+    assert RECOVERED.value == recovered + 1
+    c = dict(zip(ids.ravel().tolist(), corners))[2].reshape(4, 2)
+    assert np.abs(c.mean(axis=0) - (930, 330)).max() < 2
+
+    removed = img.copy()
+    removed[280:380, 880:980] = 255
+    for _ in range(3):
+        assert sorted(detector.detect(removed)[1].ravel().tolist()) == [0, 1]
+    assert 2 not in detector.last_seen
+    raw_frames = CASCADE_FRAMES["raw"].value
+    detector.detect(removed)
+    assert CASCADE_FRAMES["raw"].value == raw_frames + 1
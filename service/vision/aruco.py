@@ -98,25 +98,233 @@ class Marker:
         assert frame is not None
 
 
+MARKER_DTYPE = np.dtype([
+    ("id", np.int32),
+    ("corners", np.float32, (4, 2)),  # TL, TR, BR, BL
+    ("center", np.float32, (2,)),
+])
+
+
+class MarkerBatch:
+    """
+    All markers of one frame, held in a single structured NumPy array (see MARKER_DTYPE).
+    Cheaper than Marker/Coordinate objects: transforms and centers are computed for all markers at once.
+    """
+    MESSAGE_TYPE = "CONTROLHOVER"
+
+    def __init__(self, data: np.ndarray = None) -> None:
+        self.data = np.empty(0, dtype=MARKER_DTYPE) if data is None else data
+
+    @staticmethod
+    def from_cv(ids, corners):  # Input: (N, 1) ids, N-size tuple of (1, 4, 2) - cv format
+        if ids is None or len(ids) == 0:
+            return MarkerBatch()
+        data = np.empty(len(ids), dtype=MARKER_DTYPE)
+        data["id"] = np.asarray(ids).reshape(-1)
+        data["corners"] = np.asarray(corners, dtype=np.float32).reshape(-1, 4, 2)
+        data["center"] = data["corners"].mean(axis=1)
+        return MarkerBatch(data)
+
+    def to_cv(self):  # Output: (corners, ids) in cv format
+        corners = tuple(self.data["corners"].reshape(-1, 1, 4, 2))
+        return corners, self.data["id"].reshape(-1, 1).copy()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self.data["id"]
+
+    @property
+    def corners(self) -> np.ndarray:
+        return self.data["corners"]
+
+    @corners.setter
+    def corners(self, corners) -> None:
+        self.data["corners"] = corners
+        self.data["center"] = self.data["corners"].mean(axis=1)
+
+    @property
+    def centers(self) -> np.ndarray:
+        return self.data["center"]
+
+    def transform(self, H: np.ndarray):
+        """Returns a new batch with all corners transformed by the homography H in a single call."""
+        data = self.data.copy()
+        if len(data):
+            pts = cv.perspectiveTransform(data["corners"].reshape(-1, 1, 2), H)
+            data["corners"] = pts.reshape(-1, 4, 2)
+            data["center"] = data["corners"].mean(axis=1)
+        return MarkerBatch(data)
+
+    def to_payload(self) -> dict:
+        return {
+            "markers": [
+                {"Id": i, "MessageType": self.MESSAGE_TYPE, "Data": {"X": x, "Y": y}}
+                for i, (x, y) in zip(self.data["id"].tolist(), self.data["center"].tolist())
+            ]
+        }
+
+    def records_json(self) -> str:
+        """JSON list of the marker records, as used for the "markers" key."""
+        records = ", ".join(
+            f'{{"Id": {i}, "MessageType": "{self.MESSAGE_TYPE}", "Data": {{"X": {x!r}, "Y": {y!r}}}}}'
+            for i, (x, y) in zip(self.data["id"].tolist(), self.data["center"].tolist())
+        )
+        return f'[{records}]'
+
+    def to_json(self) -> str:
+        """Same as json.dumps(self.to_payload()), without building the intermediate dicts."""
+        return f'{{"markers": {self.records_json()}}}'
+
+    @staticmethod
+    def _test_marker_batch_class():  # TEMPORARY - add testing package at some point
+        import json
+
+        # --- Simulated OpenCV output ---
+        corners = (
+            np.array([[[0, 0], [1, 0], [1, 1], [0, 1]]], dtype=np.float32),
+            np.array([[[2, 2], [3, 2], [3, 3], [2, 3]]], dtype=np.float32),
+        )
+        ids = np.array([[9], [7]], dtype=np.int32)
+
+        batch = MarkerBatch.from_cv(ids, corners)
+
+        assert len(batch) == 2
+        assert batch.ids.tolist() == [9, 7]
+        assert batch.corners[0].tolist() == [[0, 0], [1, 0], [1, 1], [0, 1]]
+        assert batch.corners[1].tolist() == [[2, 2], [3, 2], [3, 3], [2, 3]]
+        assert batch.centers.tolist() == [[0.5, 0.5], [2.5, 2.5]]
+        assert len(MarkerBatch.from_cv(None, ())) == 0
+
+        # --- Must agree with the Marker objects ---
+        markers = Marker.from_cv_collection(ids, corners)
+        H = np.array([[2, 0, 10], [0, 3, 20], [0, 0, 1]], dtype=np.float64)
+        batch_tf = batch.transform(H)
+        for m, c, center in zip(markers, batch_tf.corners, batch_tf.centers):
+            m_tf = Marker(m.id, cv.perspectiveTransform(m.corners_cv, H))
+            assert np.allclose(m_tf.corners_cv.reshape(4, 2), c)
+            assert np.allclose((m_tf.center.X, m_tf.center.Y), center)
+
+        assert json.loads(batch_tf.to_json()) == batch_tf.to_payload()
+        assert batch_tf.to_json() == json.dumps(batch_tf.to_payload())
+        assert batch_tf.to_payload()["markers"][0] == {"Id": 9, "MessageType": "CONTROLHOVER", "Data": {"X": 11.0, "Y": 21.5}}
+
+        # --- Convert back to OpenCV format ---
+        corners_cv, ids_cv = batch.to_cv()
+
+        assert len(corners_cv) == 2
+        assert ids_cv.shape == (2, 1)
+
+        assert corners_cv[0].shape == (1, 4, 2)
+        assert corners_cv[1].shape == (1, 4, 2)
+
+        assert ids_cv[0, 0] == 9
+        assert ids_cv[1, 0] == 7
+
+        # --- Final OpenCV compatibility check ---
+        frame = np.zeros((1080, 1920, 3), dtype=np.uint8)
+        frame = cv.aruco.drawDetectedMarkers(frame, corners_cv, ids_cv)
+
+        assert frame is not None
+
+
+def _marker_batch_fixture(*markers, size: float = 10) -> MarkerBatch:  # TEMPORARY - add testing package at some point
+    """MarkerBatch for tests, from (id, (x, y)) pairs: axis-aligned size x size markers with top-left corner (x, y)."""
+    ids = np.array([[i] for i, _ in markers], dtype=np.int32)
+    corners = tuple(np.float32([[x, y], [x + size, y], [x + size, y + size], [x, y + size]]).reshape(1, 4, 2)
+                    for _, (x, y) in markers)
+    return MarkerBatch.from_cv(ids, corners)
+
+
+def build_dictionary(aruco_dict: str, active_ids=None):
+    """
+    The predefined dictionary `aruco_dict`, or a custom dictionary holding only its markers `active_ids`.
+    In the custom dictionary, marker active_ids[i] has index i. Candidates showing any other marker
+    fail to decode and are rejected, and every candidate is compared against fewer codes.
+    """
+    dictionary = cv.aruco.getPredefinedDictionary(getattr(cv.aruco, aruco_dict))
+    if not active_ids:
+        return dictionary
+    active_ids = np.asarray(active_ids, dtype=np.int32)
+    if active_ids.min() < 0 or active_ids.max() >= len(dictionary.bytesList):
+        raise ValueError(f"Active marker ids must be in 0..{len(dictionary.bytesList) - 1} for {aruco_dict}")
+    return cv.aruco.Dictionary(dictionary.bytesList[active_ids], dictionary.markerSize, dictionary.maxCorrectionBits)
+
+
+def build_detector_parameters(detector_params: dict = None, rate_scale: float = 1.0):
+    """
+    DetectorParameters set from `detector_params`, with the perimeter limits scaled by `rate_scale`.
+    The limits are relative to the image size, so a crop needs scaled rates to accept the same markers
+    as the full frame.
+    """
+    params = cv.aruco.DetectorParameters()
+    for key, value in (detector_params or {}).items():
+        setattr(params, key, value)
+    params.minMarkerPerimeterRate *= rate_scale
+    params.maxMarkerPerimeterRate *= rate_scale
+    return params
+
+
+def padded_roi(corners: np.ndarray, img_shape, padding: float, min_padding_px: int) -> tuple:
+    """
+    (x0, y0, x1, y1) crop around a marker's (4, 2) `corners`, padded by `padding` times its size
+    (at least `min_padding_px`) and clipped to the image.
+    """
+    h, w = img_shape[:2]
+    (x0, y0), (x1, y1) = corners.min(axis=0), corners.max(axis=0)
+    pad = max(min_padding_px, padding * max(x1 - x0, y1 - y0))
+    return (int(max(0, np.floor(x0 - pad))), int(max(0, np.floor(y0 - pad))),
+            int(min(w, np.ceil(x1 + pad))), int(min(h, np.ceil(y1 + pad))))
+
+
 class ArucoMarkerDetector:
-    """Class for detecting ArUco markers in images using specific parameters."""
-    def __init__(self, aruco_dict: str, detector_params: dict = None) -> None:
-        self.aruco_dict = cv.aruco.getPredefinedDictionary(getattr(cv.aruco, aruco_dict))
+    """
+    Class for detecting ArUco markers in images using specific parameters.
+    With `active_ids`, only these markers of the dictionary are detected (see build_dictionary).
+    """
+    def __init__(self, aruco_dict: str, detector_params: dict = None, active_ids=None) -> None:
+        self.aruco_dict = build_dictionary(aruco_dict, active_ids)
+        self.id_map = np.asarray(active_ids, dtype=np.int32) if active_ids else None  # Index -> marker id
+        self.params = detector_params
         
         # setup marker detector
         if detector_params is None:
             self.detector = cv.aruco.ArucoDetector(self.aruco_dict)
         else:
-            self.detector_params = cv.aruco.DetectorParameters()
-            for key, value in detector_params.items():
-                setattr(self.detector_params, key, value)
+            self.detector_params = build_detector_parameters(detector_params)
             self.detector = cv.aruco.ArucoDetector(self.aruco_dict, self.detector_params)
+        self._roi_detector = cv.aruco.ArucoDetector(self.aruco_dict)  # Perimeter limits set per crop
+
+    def detect_roi(self, img: np.ndarray, roi, preprocess=None) -> tuple:
+        """
+        Detects the markers in the crop roi = (x0, y0, x1, y1) of `img` and returns them like `detect`,
+        in `img` coordinates. The perimeter limits are scaled to the crop, so it accepts the same markers
+        as a detection on all of `img`. `preprocess` is applied to the crop first if given.
+        """
+        x0, y0, x1, y1 = roi
+        h, w = img.shape[:2]
+        crop = img[y0:y1, x0:x1]
+        if preprocess is not None:
+            crop = preprocess(crop)
+        self._roi_detector.setDetectorParameters(
+            build_detector_parameters(self.params, max(w, h) / max(x1 - x0, y1 - y0)))
+        corners, ids, _ = self._roi_detector.detectMarkers(crop)
+        if ids is None:
+            return (), None
+        if self.id_map is not None:
+            ids = self.id_map[ids]
+        offset = np.float32([x0, y0])
+        return tuple(np.asarray(c, dtype=np.float32) + offset for c in corners), ids
 
     def detect(self, img: np.ndarray, debug: bool = False) -> tuple:
         """Detects ArUco markers in the given image and returns their corners and IDs."""
         # corners shape: N-sized tuple of (1, 4, 2) entries
         # ids shape: (N, 1)
         corners, ids, _ = self.detector.detectMarkers(img)
+        if ids is not None and self.id_map is not None:
+            ids = self.id_map[ids]
         if debug:
             debug_img = img.copy()
             if ids is not None:
@@ -125,4 +333,19 @@ class ArucoMarkerDetector:
             print("Displaying debug window. To continue, select the debug window and then press any key.")
             cv.waitKey(0)
             cv.destroyWindow("Detected ArUco Markers")        
-        return corners, ids
\ No newline at end of file
+        return corners, ids
+
+def _test_active_ids():  # TEMPORARY - add testing package at some point
+    """Checks that a subset dictionary reports the original ids and ignores markers outside the subset."""
+    dictionary = cv.aruco.getPredefinedDictionary(cv.aruco.DICT_4X4_250)
+    scene = np.full((400, 1400), 255, dtype=np.uint8)
+    for k, marker_id in enumerate((3, 17, 42, 99, 200)):
+        scene[100:300, 50 + k * 270:250 + k * 270] = cv.aruco.generateImageMarker(dictionary, marker_id, 200)
+
+    _, ids = ArucoMarkerDetector("DICT_4X4_250").detect(scene)
+    assert sorted(ids.ravel().tolist()) == [3, 17, 42, 99, 200]
+    corners, ids = ArucoMarkerDetector("DICT_4X4_250", active_ids=[200, 17, 3]).detect(scene)
+    assert sorted(ids.ravel().tolist()) == [3, 17, 200]
+    assert ids.shape == (3, 1)
+    for c, marker_id in zip(corners, ids.ravel()):
+        assert abs(c[0, :, 0].mean() - (150 + (3, 17, 42, 99, 200).index(marker_id) * 270)) < 2
@@ -1,8 +1,17 @@
 from service.utils.platform_info import CURRENT_OS, OS
+from service.utils.pipeline import LatestQueue, FramePacket
+from service.utils.metrics import METRICS, stage_histogram
+from service.utils.buffers import BufferPool
 from enum import Enum, auto
+import threading
+import time
 import cv2 as cv
 import numpy as np
 
+CAPTURE_TIME = stage_histogram("capture")
+STALE_FRAMES = METRICS.counter("stale_frames_skipped_total", "Buffered camera frames skipped without decoding")
+
+
 def init_video_capture(cam_idx, width, height, fps):
     if CURRENT_OS is OS.LINUX:
         vid_api = cv.CAP_V4L2
@@ -32,30 +41,169 @@ def init_video_capture(cam_idx, width, height, fps):
     return cap
 
 
-def preprocess_img(img: np.ndarray) -> np.ndarray:
-    """
-    Preprocess the captured image to improve marker detection for cases where markers are not being recognized reliably.
-    """
-    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
-    clahe = cv.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    clahe_img = clahe.apply(gray)
-
-    clahe_img = cv.GaussianBlur(clahe_img, (5, 5), 0)
+def capture_time(cap) -> float:
+    """Capture time of the frame `cap` returned last; the current time for captures without timestamps."""
+    timestamp = getattr(cap, "timestamp", None)
+    return time.time() if timestamp is None else timestamp
 
-    adaptive = cv.adaptiveThreshold(clahe_img, 255, cv.ADAPTIVE_THRESH_GAUSSIAN_C, cv.THRESH_BINARY, 65, 2)
-    _, otsu = cv.threshold(adaptive, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
-    combined = cv.bitwise_and(otsu, adaptive)
 
-    kernel = cv.getStructuringElement(cv.MORPH_RECT, (3, 3))
+class MjpegGrayCapture:
+    """
+    Wraps a cv.VideoCapture running in MJPG mode and hands out single-channel frames.
+    OpenCV's own BGR conversion is disabled, so `retrieve_raw` returns the undecoded JPEG bytes and
+    frames are decoded straight to grayscale (optionally at 1/2, 1/4 or 1/8 size) - and only when needed.
+    Backends that cannot deliver raw MJPEG still work, their BGR frames are converted instead.
+    """
+    REDUCED_FLAGS = {
+        1: cv.IMREAD_GRAYSCALE,
+        2: cv.IMREAD_REDUCED_GRAYSCALE_2,
+        4: cv.IMREAD_REDUCED_GRAYSCALE_4,
+        8: cv.IMREAD_REDUCED_GRAYSCALE_8,
+    }
+
+    def __init__(self, cap, fps: float, reduction: int = 1, max_drain: int = 4) -> None:
+        if reduction not in self.REDUCED_FLAGS:
+            raise ValueError(f"Unsupported decode reduction {reduction}, use one of {list(self.REDUCED_FLAGS)}")
+        self.cap = cap
+        self.reduction = reduction
+        self.max_drain = max_drain
+        self.min_grab_time = 0.5 / fps
+        self.cap.set(cv.CAP_PROP_CONVERT_RGB, 0)
+
+    @property
+    def timestamp(self):
+        return getattr(self.cap, "timestamp", None)
+
+    def decode(self, buf: np.ndarray) -> np.ndarray:
+        if buf.ndim == 3:  # Backend ignored CONVERT_RGB and already decoded to BGR
+            gray = cv.cvtColor(buf, cv.COLOR_BGR2GRAY)
+            if self.reduction > 1:
+                gray = cv.resize(gray, None, fx=1 / self.reduction, fy=1 / self.reduction, interpolation=cv.INTER_AREA)
+            return gray
+        return cv.imdecode(buf.reshape(-1), self.REDUCED_FLAGS[self.reduction])
+
+    def grab(self) -> bool:
+        return self.cap.grab()
+
+    def retrieve_raw(self) -> tuple:
+        return self.cap.retrieve()
+
+    def retrieve(self) -> tuple:
+        ret, buf = self.cap.retrieve()
+        if not ret or buf is None:
+            return False, None
+        return True, self.decode(buf)
+
+    def read(self) -> tuple:
+        # Drain frames the driver buffered while we were busy: a grab that returns much faster than
+        # the frame interval came from the buffer and is stale. Only the last grabbed frame is decoded.
+        # Replays have no such buffer - every frame is read.
+        for i in range(self.max_drain if getattr(self.cap, "buffered", True) else 1):
+            if i:
+                STALE_FRAMES.inc()  # The previous grab is skipped
+            t = time.perf_counter()
+            if not self.cap.grab():
+                return False, None
+            if time.perf_counter() - t > self.min_grab_time:
+                break
+        return self.retrieve()
+
+    def get(self, prop_id):
+        return self.cap.get(prop_id)
+
+    def set(self, prop_id, value):
+        return self.cap.set(prop_id, value)
+
+    def release(self) -> None:
+        self.cap.release()
+
+
+class FrameGrabber(threading.Thread):
+    """
+    Dedicated capture thread that reads frames as fast as the camera delivers them
+    and only keeps the newest one. Older, unconsumed frames are dropped (see `dropped`).
+    For captures that can hand out undecoded frames (MjpegGrayCapture), packets carry the raw
+    buffer plus `decode`, so frames that get dropped are never decoded.
+    """
+    def __init__(self, cap, maxsize: int = 1) -> None:
+        super().__init__(name="capture", daemon=True)
+        self.cap = cap
+        self.frames = LatestQueue(maxsize)
+        self._stop_event = threading.Event()
+
+    @property
+    def dropped(self) -> int:
+        return self.frames.dropped
+
+    def run(self) -> None:
+        seq = 0
+        lazy_decode = hasattr(self.cap, "retrieve_raw")
+        try:
+            while not self._stop_event.is_set():
+                t0 = time.perf_counter()
+                if lazy_decode:
+                    ret = self.cap.grab()
+                    t_capture = capture_time(self.cap)
+                    ret, frame = self.cap.retrieve_raw() if ret else (False, None)
+                else:
+                    ret, frame = self.cap.read()
+                    t_capture = capture_time(self.cap)
+                CAPTURE_TIME.observe(time.perf_counter() - t0)
+                if not ret:
+                    print("No frame read")
+                    break
+                packet = FramePacket(seq, t_capture, frame)
+                if lazy_decode:
+                    packet.decode = self.cap.decode
+                self.frames.put(packet)
+                seq += 1
+        finally:
+            self.frames.close()
+
+    def stop(self) -> None:
+        self._stop_event.set()
 
-    cleaned = cv.morphologyEx(combined, cv.MORPH_CLOSE, kernel)
-    cleaned = cv.morphologyEx(cleaned, cv.MORPH_OPEN, kernel)
 
-    cleaned = cv.cvtColor(cleaned, cv.COLOR_GRAY2BGR)
+def preprocess_img(img: np.ndarray) -> np.ndarray:
+    """
+    Preprocess the captured image to improve marker detection for cases where markers are not being recognized reliably.
+    Accepts BGR or grayscale images and always returns a single-channel image (the detector works on grayscale anyway).
+    """
+    return Preprocessor()(img)
 
-    # return clahe_img
-    return cleaned
 
+class Preprocessor:
+    """
+    preprocess_img with the CLAHE and morphology objects created once. Given a BufferPool, every
+    intermediate image is written into a scratch buffer and the result into a ring buffer of the pool,
+    so repeated calls on frames of the same size allocate nothing (the result stays valid for
+    pool.slots - 1 further calls). Without a pool every call allocates, like preprocess_img.
+    """
+    def __init__(self, pool: BufferPool = None) -> None:
+        self.pool = pool
+        self.clahe = cv.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        self.kernel = cv.getStructuringElement(cv.MORPH_RECT, (3, 3))
+
+    def _buffer(self, name: str, shape, scratch: bool = True):
+        if self.pool is None:
+            return None
+        return self.pool.get(name, shape, slots=1 if scratch else None)
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        shape = img.shape[:2]
+        gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY, dst=self._buffer("preprocess_gray", shape)) if img.ndim == 3 else img
+        clahe_img = self.clahe.apply(gray, dst=self._buffer("preprocess_clahe", shape))
+
+        clahe_img = cv.GaussianBlur(clahe_img, (5, 5), 0, dst=self._buffer("preprocess_blur", shape))
+
+        adaptive = cv.adaptiveThreshold(clahe_img, 255, cv.ADAPTIVE_THRESH_GAUSSIAN_C, cv.THRESH_BINARY, 65, 2,
+                                        dst=self._buffer("preprocess_adaptive", shape))
+        _, otsu = cv.threshold(adaptive, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU,
+                               dst=self._buffer("preprocess_otsu", shape))
+        combined = cv.bitwise_and(otsu, adaptive, dst=self._buffer("preprocess_combined", shape))
+
+        cleaned = cv.morphologyEx(combined, cv.MORPH_CLOSE, self.kernel, dst=self._buffer("preprocess_closed", shape))
+        return cv.morphologyEx(cleaned, cv.MORPH_OPEN, self.kernel, dst=self._buffer("preprocessed", shape, False))
 
 
 if __name__ == "__main__":
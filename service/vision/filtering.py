@@ -0,0 +1,107 @@
+from service.vision.aruco import MarkerBatch, MARKER_DTYPE
+import time
+import numpy as np
+
+
+class MarkerFilter:
+    """
+    Per-ID One-Euro filter on the marker centers (projector space), with latency-compensated prediction.
+
+    The One-Euro filter smooths heavily while a marker rests (removes jitter) and follows quickly once
+    it moves (`min_cutoff` in Hz, `beta` raises the cutoff with speed). The filtered velocity is used to
+    predict the position at the time the frame is sent - plus `lead` seconds of downstream latency
+    (e.g. projector) - instead of the time it was captured.
+    Markers that drop out of the detection coast along their velocity for up to `max_coast` seconds.
+
+    All state is held in arrays indexed by marker ID, so the cost is independent of the number of markers.
+    """
+    def __init__(self, min_cutoff: float = 1.0, beta: float = 0.01, d_cutoff: float = 1.0,
+                 predict: bool = True, lead: float = 0.0, max_coast: float = 0.2) -> None:
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.predict = predict
+        self.lead = lead
+        self.max_coast = max_coast
+        self.x = np.zeros((0, 2), dtype=np.float64)            # Filtered center
+        self.dx = np.zeros((0, 2), dtype=np.float64)           # Filtered velocity (px/s)
+        self.offsets = np.zeros((0, 4, 2), dtype=np.float32)   # Corners relative to the center
+        self.t_last = np.zeros(0, dtype=np.float64)            # Capture time of the last detection
+        self.active = np.zeros(0, dtype=bool)
+        self._grow(256)
+
+    def _grow(self, capacity: int) -> None:
+        for name in ("x", "dx", "offsets", "t_last", "active"):
+            arr = getattr(self, name)
+            grown = np.zeros((capacity,) + arr.shape[1:], dtype=arr.dtype)
+            grown[:len(arr)] = arr
+            setattr(self, name, grown)
+
+    @staticmethod
+    def _alpha(dt: np.ndarray, cutoff) -> np.ndarray:
+        tau = 1.0 / (2 * np.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    def update(self, batch: MarkerBatch, t_capture: float, t_now: float = None) -> MarkerBatch:
+        """Filters the detection of a frame captured at `t_capture` (time.time()) and returns the predicted markers."""
+        t_now = time.time() if t_now is None else t_now
+
+        _, first = np.unique(batch.ids, return_index=True)
+        data = batch.data[np.sort(first)]
+        ids = data["id"]
+        if len(ids) and ids.max() >= len(self.active):
+            self._grow(int(ids.max()) + 1)
+
+        z = data["center"].astype(np.float64)
+        new = ~self.active[ids]
+        dt = np.maximum(t_capture - self.t_last[ids], 1e-3)[:, np.newaxis]
+
+        # One-Euro update for markers that already have a state
+        dx = self.dx[ids] + self._alpha(dt, self.d_cutoff) * ((z - self.x[ids]) / dt - self.dx[ids])
+        cutoff = self.min_cutoff + self.beta * np.linalg.norm(dx, axis=1, keepdims=True)
+        x = self.x[ids] + self._alpha(dt, cutoff) * (z - self.x[ids])
+
+        x[new] = z[new]
+        dx[new] = 0
+        self.x[ids] = x
+        self.dx[ids] = dx
+        self.offsets[ids] = data["corners"] - data["center"][:, np.newaxis, :]
+        self.t_last[ids] = t_capture
+        self.active[ids] = True
+
+        # Drop markers missing from the frames of the last `max_coast` seconds, the rest coasts. Measured
+        # in capture time: a late frame (t_now well after t_capture) must not drop the markers it contains
+        self.active &= t_capture - self.t_last <= self.max_coast
+        out_ids = np.flatnonzero(self.active)
+
+        centers = self.x[out_ids]
+        if self.predict:
+            elapsed = (t_now - self.t_last[out_ids] + self.lead)[:, np.newaxis]
+            centers = centers + self.dx[out_ids] * elapsed
+
+        out = np.empty(len(out_ids), dtype=MARKER_DTYPE)
+        out["id"] = out_ids
+        out["center"] = centers
+        out["corners"] = self.offsets[out_ids] + out["center"][:, np.newaxis, :]
+        return MarkerBatch(out)
+
+
+def _test_marker_filter():  # TEMPORARY - add testing package at some point
+    """Checks prediction, coasting and dropping, also for frames sent long after their capture."""
+    from service.vision.aruco import _marker_batch_fixture as batch
+
+    marker_filter = MarkerFilter(min_cutoff=1e3, d_cutoff=1e3, max_coast=0.2)  # Barely any smoothing
+    for i in range(10):
+        out = marker_filter.update(batch((1, (100 * i / 30, 0)), (2, (0, 0))), i / 30, i / 30)
+    assert out.ids.tolist() == [1, 2]
+
+    # Sent 0.5 s after capture (> max_coast): nothing is dropped, marker 1 is predicted along its velocity
+    out = marker_filter.update(batch((1, (100 / 3, 0)), (2, (0, 0))), 10 / 30, 10 / 30 + 0.5)
+    assert out.ids.tolist() == [1, 2]
+    assert abs(out.centers[0][0] - (100 / 3 + 5 + 50)) < 2
+
+    # Marker 2 drops out: it coasts for max_coast seconds of capture time, then it is dropped
+    out = marker_filter.update(batch((1, (110 / 3, 0))), 11 / 30, 11 / 30)
+    assert out.ids.tolist() == [1, 2]
+    out = marker_filter.update(batch((1, (100 / 3 + 10, 0))), 10 / 30 + 0.3, 10 / 30 + 0.3)
+    assert out.ids.tolist() == [1]
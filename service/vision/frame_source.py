@@ -0,0 +1,300 @@
+import json
+import os
+import queue
+import threading
+import time
+import cv2 as cv
+import numpy as np
+from service.vision.camera import init_video_capture, capture_time
+
+# A recording is a directory with
+#   frames.bin  - the encoded frames back to back (raw MJPEG as delivered by the camera, or PNG/JPEG)
+#   index.csv   - one line per frame: byte offset, byte length, capture time (time.time())
+#   meta.json   - width, height and fps of the recorded source
+FRAMES_FILE = "frames.bin"
+INDEX_FILE = "index.csv"
+META_FILE = "meta.json"
+
+
+class FrameSource:
+    """
+    Interface of everything the services read frames from. It is a subset of cv.VideoCapture
+    (grab / retrieve / read / get / set / release), so a plain VideoCapture can still be used anywhere.
+    `timestamp` is the capture time (time.time()) of the last grabbed frame. `buffered` tells whether
+    frames can pile up while nobody reads (a camera driver buffer) and may have to be skipped.
+    """
+    timestamp = None
+    buffered = False
+
+    def grab(self) -> bool:
+        raise NotImplementedError
+
+    def retrieve(self) -> tuple:
+        raise NotImplementedError
+
+    def read(self) -> tuple:
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def get(self, prop_id) -> float:
+        return 0.0
+
+    def set(self, prop_id, value) -> bool:
+        return False
+
+    def release(self) -> None:
+        pass
+
+
+class LiveSource(FrameSource):
+    """Live camera (cv.VideoCapture), timestamped when a frame is grabbed."""
+    buffered = True
+
+    def __init__(self, cap) -> None:
+        self.cap = cap
+
+    def grab(self) -> bool:
+        ret = self.cap.grab()
+        self.timestamp = time.time()
+        return ret
+
+    def retrieve(self) -> tuple:
+        return self.cap.retrieve()
+
+    def read(self) -> tuple:
+        ret, frame = self.cap.read()
+        self.timestamp = time.time()
+        return ret, frame
+
+    def get(self, prop_id) -> float:
+        return self.cap.get(prop_id)
+
+    def set(self, prop_id, value) -> bool:
+        return self.cap.set(prop_id, value)
+
+    def release(self) -> None:
+        self.cap.release()
+
+
+class RecordingSource(FrameSource):
+    """
+    Passes frames of `source` through and appends every retrieved frame to the recording at `path`.
+    Undecoded frames (raw MJPEG, see MjpegGrayCapture) are stored as they are, decoded frames are
+    encoded with `image_format`. Writing happens on a background thread so the capture loop is not slowed
+    down; no frame is dropped, the remaining frames are written on `release`.
+    """
+    def __init__(self, source, path: str, image_format: str = ".png") -> None:
+        self.source = source
+        self.buffered = getattr(source, "buffered", True)
+        self.path = path
+        self.image_format = image_format
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, META_FILE)
+        if not os.path.exists(meta_path):
+            with open(meta_path, "w") as f:
+                json.dump({"width": source.get(cv.CAP_PROP_FRAME_WIDTH),
+                           "height": source.get(cv.CAP_PROP_FRAME_HEIGHT),
+                           "fps": source.get(cv.CAP_PROP_FPS)}, f, indent=4)
+        self.recorded = 0
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="recorder", daemon=True)
+        self._writer.start()
+        print(f"Recording frames to {path}")
+
+    def _write_loop(self) -> None:
+        with open(os.path.join(self.path, FRAMES_FILE), "ab") as frames, \
+                open(os.path.join(self.path, INDEX_FILE), "a") as index:
+            offset = frames.tell()
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                timestamp, frame = item
+                if frame.ndim == 1 or (frame.ndim == 2 and frame.shape[0] == 1 and frame.dtype == np.uint8):
+                    # Raw (encoded) buffer, as with CAP_PROP_CONVERT_RGB = 0 - OpenCV returns it as 1 x N
+                    data = frame.reshape(-1).tobytes()
+                else:
+                    ok, data = cv.imencode(self.image_format, frame)
+                    if not ok:
+                        continue
+                    data = data.tobytes()
+                frames.write(data)
+                index.write(f"{offset},{len(data)},{timestamp:.6f}\n")
+                offset += len(data)
+                self.recorded += 1
+
+    def grab(self) -> bool:
+        ret = self.source.grab()
+        self.timestamp = capture_time(self.source)
+        return ret
+
+    def retrieve(self) -> tuple:
+        ret, frame = self.source.retrieve()
+        if ret and frame is not None:
+            self._queue.put((self.timestamp, frame))
+        return ret, frame
+
+    def get(self, prop_id) -> float:
+        return self.source.get(prop_id)
+
+    def set(self, prop_id, value) -> bool:
+        return self.source.set(prop_id, value)
+
+    def release(self) -> None:
+        self.source.release()
+        self._queue.put(None)
+        self._writer.join()
+        print(f"Recorded {self.recorded} frames to {self.path}")
+
+
+class ReplaySource(FrameSource):
+    """
+    Plays back a recording made by RecordingSource.
+    With `realtime`, frames are delivered at their original timing, otherwise as fast as they are read.
+    Timestamps keep the original frame intervals, shifted to the start of the replay.
+    Like a VideoCapture, frames are decoded to BGR unless CAP_PROP_CONVERT_RGB is set to 0,
+    in which case the stored (encoded) bytes are returned, so MjpegGrayCapture works on replays too.
+    """
+    def __init__(self, path: str, realtime: bool = True, loop: bool = False) -> None:
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.convert_rgb = True
+        index = np.loadtxt(os.path.join(path, INDEX_FILE), delimiter=",", ndmin=2)
+        if len(index) == 0:
+            raise RuntimeError(f"Recording {path} contains no frames")
+        self.offsets = index[:, 0].astype(np.int64)
+        self.lengths = index[:, 1].astype(np.int64)
+        self.timestamps = index[:, 2]
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self._frames = np.memmap(os.path.join(path, FRAMES_FILE), dtype=np.uint8, mode="r")
+        self._pos = -1
+        self._start()
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def _start(self) -> None:
+        self._pos = -1
+        self._shift = None  # Set on the first grab, so setup time before it does not count
+
+    def grab(self) -> bool:
+        self._pos += 1
+        if self._pos >= len(self):
+            if not self.loop:
+                return False
+            self._start()
+            self._pos = 0
+        if self._shift is None:
+            self._shift = time.time() - self.timestamps[self._pos]
+        self.timestamp = self.timestamps[self._pos] + self._shift
+        if self.realtime:
+            delay = self.timestamp - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return True
+
+    def retrieve(self) -> tuple:
+        if not 0 <= self._pos < len(self):
+            return False, None
+        start = self.offsets[self._pos]
+        data = np.array(self._frames[start:start + self.lengths[self._pos]])
+        if not self.convert_rgb:
+            return True, data
+        frame = cv.imdecode(data, cv.IMREAD_COLOR)
+        return frame is not None, frame
+
+    def get(self, prop_id) -> float:
+        props = {cv.CAP_PROP_FRAME_WIDTH: "width", cv.CAP_PROP_FRAME_HEIGHT: "height", cv.CAP_PROP_FPS: "fps"}
+        if prop_id == cv.CAP_PROP_FRAME_COUNT:
+            return float(len(self))
+        if prop_id == cv.CAP_PROP_POS_FRAMES:
+            return float(self._pos + 1)
+        return float(self.meta.get(props.get(prop_id), 0.0) or 0.0)
+
+    def set(self, prop_id, value) -> bool:
+        if prop_id == cv.CAP_PROP_CONVERT_RGB:
+            self.convert_rgb = bool(value)
+            return True
+        return False
+
+    def release(self) -> None:
+        self._frames = None
+
+
+def open_frame_source(camera_cfg: dict) -> FrameSource:
+    """Opens the frame source configured in the "camera" section: the live camera (optionally recorded) or a replay."""
+    recording_cfg = camera_cfg["recording"]
+    if camera_cfg["source"] == "replay":
+        print(f"Replaying {recording_cfg['path']} ({'realtime' if recording_cfg['realtime'] else 'as fast as possible'})")
+        return ReplaySource(recording_cfg["path"], recording_cfg["realtime"], recording_cfg["loop"])
+
+    source = LiveSource(init_video_capture(camera_cfg["index"],
+                                           camera_cfg["width"],
+                                           camera_cfg["height"],
+                                           camera_cfg["fps"]))
+    if recording_cfg["record"]:
+        source = RecordingSource(source, recording_cfg["path"], recording_cfg["image_format"])
+    return source
+
+
+def _test_record_and_replay():  # TEMPORARY - add testing package at some point
+    """Records synthetic frames (decoded and raw JPEG) and checks that replay returns them in order with their timing."""
+    import tempfile
+
+    class FakeCapture(FrameSource):
+        def __init__(self, frames, raw=False):
+            self.frames = frames
+            self.raw = raw
+            self.pos = -1
+
+        def grab(self):
+            self.pos += 1
+            self.timestamp = 1000.0 + 0.05 * self.pos
+            return self.pos < len(self.frames)
+
+        def retrieve(self):
+            frame = self.frames[self.pos]
+            return True, cv.imencode(".jpg", frame)[1].reshape(1, -1) if self.raw else frame  # 1 x N, as OpenCV
+
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 255, (48, 64, 3), dtype=np.uint8) for _ in range(5)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for raw in (False, True):
+            path = os.path.join(tmp, "raw" if raw else "png")
+            recorder = RecordingSource(FakeCapture(frames, raw), path)
+            while recorder.read()[0]:
+                pass
+            recorder.release()
+
+            replay = ReplaySource(path, realtime=False)
+            assert len(replay) == len(frames)
+            t0 = time.time()
+            timestamps = []
+            for frame in frames:
+                ret, replayed = replay.read()
+                assert ret
+                timestamps.append(replay.timestamp)
+                if raw:
+                    assert replayed.shape == frame.shape  # lossy - only check decoding
+                else:
+                    assert np.array_equal(replayed, frame)
+            assert not replay.read()[0]
+            assert time.time() - t0 < 0.2  # not paced
+            assert np.allclose(np.diff(timestamps), 0.05)
+
+            replay.set(cv.CAP_PROP_CONVERT_RGB, 0)
+            replay._start()
+            ret, data = replay.read()
+            assert ret and data.ndim == 1
+            if raw:
+                assert np.array_equal(data, cv.imencode(".jpg", frames[0])[1].reshape(-1))  # Stored unchanged
+
+            replay = ReplaySource(path, realtime=True)
+            t0 = time.time()
+            while replay.read()[0]:
+                pass
+            assert time.time() - t0 >= 0.19  # 4 intervals of 50ms
@@ -0,0 +1,121 @@
+from service.vision.aruco import MarkerBatch
+from service.utils.metrics import METRICS
+import numpy as np
+
+DUPLICATES = METRICS.counter("fusion_duplicates_total", "Markers seen by more than one camera, resolved by confidence")
+STALE_CAMERAS = METRICS.counter("fusion_stale_cameras_total", "Camera marker sets left out of a merge for being too old")
+
+
+def marker_confidence(corners: np.ndarray, width: int, height: int) -> np.ndarray:
+    """
+    Confidence of markers at `corners` ((N, 4, 2) undistorted camera pixels) in a width x height frame:
+    the marker side length in pixels (more pixels, more precise corners), scaled down for markers closer
+    to the frame border than one side length (cut off, or where the lens distortion is strongest).
+    """
+    corners = np.asarray(corners, dtype=np.float32).reshape(-1, 4, 2)
+    x, y = corners[..., 0], corners[..., 1]
+    area = 0.5 * np.abs((x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y).sum(axis=1))
+    side = np.sqrt(area)
+    margin = np.minimum(np.minimum(x, width - x), np.minimum(y, height - y)).min(axis=1)
+    return (side * np.clip(margin / np.maximum(side, 1e-6), 0.0, 1.0)).astype(np.float32)
+
+
+class MarkerFusion:
+    """
+    Merges the latest projector-space marker sets of several cameras into one. The set of a camera is
+    left out once the camera has missed `max_missed_frames` frames, measured against its own frame
+    interval - cameras running at different rates do not flicker, those of a stalled camera disappear.
+    A marker seen by several cameras (overlap zones) is taken from the camera with the highest confidence
+    (see marker_confidence). The camera that delivered a marker last time keeps it unless another one is
+    more than `hysteresis` (relative) more confident, so markers do not jump between two slightly
+    different calibrations on every frame.
+    """
+    def __init__(self, cameras: int, max_missed_frames: float = 3, hysteresis: float = 0.1) -> None:
+        self.max_missed_frames = max_missed_frames
+        self.hysteresis = hysteresis
+        self.latest = [None] * cameras  # Per camera: (t_capture, MarkerBatch, confidence)
+        self.interval = np.zeros(cameras)  # Per camera: smoothed frame interval, 0 until known
+        self.owner = {}  # id -> camera that delivered it last time
+
+    def update(self, camera: int, t_capture: float, batch: MarkerBatch, confidence: np.ndarray) -> None:
+        previous = self.latest[camera]
+        if previous is not None and t_capture > previous[0]:
+            dt = t_capture - previous[0]
+            self.interval[camera] = dt if self.interval[camera] == 0 else 0.9 * self.interval[camera] + 0.1 * dt
+        self.latest[camera] = (t_capture, batch, confidence)
+
+    def merge(self) -> tuple:
+        """Returns (MarkerBatch, capture time of the newest camera set)."""
+        sets = [(camera, entry) for camera, entry in enumerate(self.latest) if entry is not None]
+        if not sets:
+            return MarkerBatch(), 0.0
+        newest = max(t_capture for _, (t_capture, _, _) in sets)
+        # A camera that delivered only one set so far is measured against the slowest known interval
+        interval = np.where(self.interval > 0, self.interval, self.interval.max())
+        fresh = [(camera, entry) for camera, entry in sets
+                 if interval[camera] == 0 or newest - entry[0] <= self.max_missed_frames * interval[camera]]
+        STALE_CAMERAS.inc(len(sets) - len(fresh))
+
+        data = np.concatenate([batch.data for _, (_, batch, _) in fresh])
+        if len(data) == 0:
+            self.owner = {}
+            return MarkerBatch(data), newest
+        confidence = np.concatenate([conf for _, (_, _, conf) in fresh]).astype(np.float64)
+        cameras = np.concatenate([np.full(len(batch), camera) for camera, (_, batch, _) in fresh])
+        ids = data["id"]
+
+        owned = np.array([self.owner.get(i) == c for i, c in zip(ids.tolist(), cameras.tolist())], dtype=bool)
+        score = confidence * np.where(owned, 1.0 + self.hysteresis, 1.0)
+        order = np.lexsort((-score, ids))  # By id, the best first
+        _, first = np.unique(ids[order], return_index=True)
+        picked = order[first]
+        DUPLICATES.inc(len(ids) - len(picked))
+
+        self.owner = dict(zip(ids[picked].tolist(), cameras[picked].tolist()))
+        return MarkerBatch(data[picked]), newest
+
+
+def _test_marker_fusion():  # TEMPORARY - add testing package at some point
+    """Checks duplicate resolution by confidence, the hysteresis and that stale cameras are left out."""
+    from service.vision.aruco import _marker_batch_fixture as batch
+
+    assert np.allclose(marker_confidence(np.float32([[[100, 100], [140, 100], [140, 140], [100, 140]]]), 1920, 1080), 40)
+    assert marker_confidence(np.float32([[[10, 100], [50, 100], [50, 140], [10, 140]]]), 1920, 1080)[0] == 10
+
+    fusion = MarkerFusion(2, max_missed_frames=3, hysteresis=0.1)
+    fusion.update(0, 1.00, batch((1, (0, 0)), (2, (100, 0))), np.float32([20, 20]))
+    fusion.update(1, 1.02, batch((2, (101, 0)), (3, (200, 0))), np.float32([30, 20]))
+    merged, t_capture = fusion.merge()
+    assert t_capture == 1.02
+    assert sorted(merged.ids.tolist()) == [1, 2, 3]
+    assert merged.centers[merged.ids == 2][0][0] == 106  # Camera 1 is more confident
+    assert fusion.owner == {1: 0, 2: 1, 3: 1}
+
+    # Slightly more confident now, but not by more than the hysteresis: camera 1 keeps marker 2
+    fusion.update(0, 1.03, batch((1, (0, 0)), (2, (100, 0))), np.float32([20, 32]))
+    merged, _ = fusion.merge()
+    assert merged.centers[merged.ids == 2][0][0] == 106
+    fusion.update(0, 1.04, batch((1, (0, 0)), (2, (100, 0))), np.float32([20, 40]))
+    merged, _ = fusion.merge()
+    assert merged.centers[merged.ids == 2][0][0] == 105
+
+    # Camera 1 stalls: only camera 0 is merged
+    fusion.update(0, 1.50, batch((1, (0, 0))), np.float32([20]))
+    merged, _ = fusion.merge()
+    assert merged.ids.tolist() == [1]
+
+    # Cameras at 60 and 8 fps, merged on every frame: the markers of the slow camera never drop out,
+    # although its sets are up to 125ms older than the newest one
+    fusion = MarkerFusion(2, max_missed_frames=3)
+    frames = sorted([(t, 0) for t in np.arange(0, 2, 1 / 60)] + [(t, 1) for t in np.arange(0, 2, 1 / 8)])
+    merges = []
+    for t, camera in frames:
+        fusion.update(camera, t, batch((camera, (100 * camera, 0))), np.float32([20]))
+        merges.append(fusion.merge()[0].ids.tolist())
+    assert all(ids == [0, 1] for ids in merges[frames.index((1 / 8, 1)):])
+
+    # The slow camera stalls: dropped after missing 3 of its frames, not after 3 frames of the fast one
+    t_last = max(t for t, camera in frames if camera == 1)
+    for t, expected in ((t_last + 0.3, [0, 1]), (t_last + 0.4, [0])):
+        fusion.update(0, t, batch((0, (0, 0))), np.float32([20]))
+        assert fusion.merge()[0].ids.tolist() == expected
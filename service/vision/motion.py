@@ -0,0 +1,189 @@
+import cv2 as cv
+import numpy as np
+
+
+class Change:
+    """Result of MotionGate.check for one frame."""
+    def __init__(self, skip: bool, regions, small: np.ndarray) -> None:
+        self.skip = skip        # Nothing changed: reuse the previous detection result
+        self.regions = regions  # None: detect the full frame, else [(x0, y0, x1, y1)] in detection frame pixels
+        self.small = small      # Downsampled frame, becomes the reference once detection ran on it
+
+
+class MotionGate:
+    """
+    Cheap change detector for a mostly static table. Every raw frame is downsampled to a tiny blurred
+    grayscale copy (`width` pixels wide) and compared with the copy of the last frame detection ran on:
+      * fewer than `min_pixels` pixels differ by more than `pixel_threshold`: the frame is skipped and
+        the previous result is re-sent (no remap, preprocessing or detection)
+      * changes cover at most `max_regional` of the frame: detection only runs on the changed regions
+        (padded by `padding_px`, which must exceed the marker size), the rest of the result is reused
+      * otherwise, or when `refresh_interval` frames passed since the last full detection: full frame
+    `region_map` maps raw frame points to detection frame points (e.g. Undistorter.points when
+    detection runs on the undistorted frame). The regions are detected with `region_detector`, else with
+    the detector passed to `detect` - an ArucoMarkerDetector (see detect_roi) either way, as stateful
+    detectors (tracking) must only see full frames.
+    """
+    def __init__(self, width: int = 160, pixel_threshold: int = 12, min_pixels: int = 3,
+                 max_regional: float = 0.25, padding_px: int = 120, refresh_interval: int = 30,
+                 region_map=None, region_detector=None) -> None:
+        self.width = width
+        self.pixel_threshold = pixel_threshold
+        self.min_pixels = min_pixels
+        self.max_regional = max_regional
+        self.padding_px = padding_px
+        self.refresh_interval = refresh_interval
+        self.region_map = region_map
+        self.region_detector = region_detector
+        self.frames_since_refresh = 0
+        self._reference = None
+        self._corners = np.empty((0, 4, 2), dtype=np.float32)  # Last result (detection frame pixels)
+        self._ids = np.empty(0, dtype=np.int32)
+
+    def _small(self, frame: np.ndarray) -> np.ndarray:
+        h, w = frame.shape[:2]
+        small = cv.resize(frame, (self.width, max(1, round(h * self.width / w))), interpolation=cv.INTER_AREA)
+        if small.ndim == 3:
+            small = cv.cvtColor(small, cv.COLOR_BGR2GRAY)
+        return cv.GaussianBlur(small, (3, 3), 0)
+
+    def check(self, frame: np.ndarray) -> Change:
+        """Decides how much of the raw `frame` has to be detected."""
+        small = self._small(frame)
+        self.frames_since_refresh += 1
+        reference = self._reference
+        if reference is None or reference.shape != small.shape or self.frames_since_refresh >= self.refresh_interval:
+            self.frames_since_refresh = 0
+            return Change(False, None, small)
+
+        mask = (cv.absdiff(small, reference) > self.pixel_threshold).astype(np.uint8)
+        changed = cv.countNonZero(mask)
+        if changed < self.min_pixels:
+            return Change(True, None, small)
+        if changed > self.max_regional * mask.size:
+            self.frames_since_refresh = 0
+            return Change(False, None, small)
+
+        # One region per blob of changed pixels (blobs closer than a few pixels are merged)
+        mask = cv.dilate(mask, np.ones((3, 3), np.uint8), iterations=2)
+        n, _, stats, _ = cv.connectedComponentsWithStats(mask)
+        scale = frame.shape[1] / self.width
+        regions = []
+        for x, y, w, h, _ in stats[1:n]:
+            x0, y0, x1, y1 = x * scale, y * scale, (x + w) * scale, (y + h) * scale
+            if self.region_map is not None:
+                # Edges bend under undistortion, so map corners and edge midpoints
+                xm, ym = (x0 + x1) / 2, (y0 + y1) / 2
+                pts = self.region_map(np.float32([[x0, y0], [xm, y0], [x1, y0], [x1, ym],
+                                                  [x1, y1], [xm, y1], [x0, y1], [x0, ym]]))
+                (x0, y0), (x1, y1) = pts.min(axis=0), pts.max(axis=0)
+            regions.append((x0, y0, x1, y1))
+        return Change(False, regions, small)
+
+    def detect(self, detector, img: np.ndarray, change: Change) -> tuple:
+        """
+        Runs `detector` on `img` (the detection frame of `change`) and returns corners and ids like
+        ArucoMarkerDetector.detect. With regions, markers found in them replace the previous result there.
+        """
+        if change.regions is None:
+            corners, ids = detector.detect(img)
+            if ids is None:
+                self._corners, self._ids = np.empty((0, 4, 2), dtype=np.float32), np.empty(0, dtype=np.int32)
+            else:
+                self._corners = np.asarray(corners, dtype=np.float32).reshape(-1, 4, 2)
+                self._ids = ids.reshape(-1).astype(np.int32)
+        else:
+            self._detect_regions(self.region_detector or detector, img, change.regions)
+        self._reference = change.small
+
+        if len(self._ids) == 0:
+            return (), None
+        return tuple(self._corners.reshape(-1, 1, 4, 2)), self._ids.reshape(-1, 1).copy()
+
+    def _detect_regions(self, detector, img: np.ndarray, regions) -> None:
+        h, w = img.shape[:2]
+        pad = self.padding_px
+        keep = np.ones(len(self._ids), dtype=bool)
+        corners, ids = [], []
+        centers = self._corners.mean(axis=1)
+        for x0, y0, x1, y1 in regions:
+            # A marker belongs to a region if its center lies in the region padded by half the padding.
+            # The crop is padded by the full padding, so such markers always lie completely inside it.
+            inner = (x0 - pad / 2, y0 - pad / 2, x1 + pad / 2, y1 + pad / 2)
+            keep &= ~((centers[:, 0] >= inner[0]) & (centers[:, 0] < inner[2]) &
+                      (centers[:, 1] >= inner[1]) & (centers[:, 1] < inner[3]))
+            cx0, cy0 = int(max(0, np.floor(x0 - pad))), int(max(0, np.floor(y0 - pad)))
+            cx1, cy1 = int(min(w, np.ceil(x1 + pad))), int(min(h, np.ceil(y1 + pad)))
+            if cx1 <= cx0 or cy1 <= cy0:
+                continue
+            # Perimeter limits scaled to the crop, so regions accept the same markers as the full frame
+            found, found_ids = detector.detect_roi(img, (cx0, cy0, cx1, cy1))
+            if found_ids is None:
+                continue
+            found = np.asarray(found, dtype=np.float32).reshape(-1, 4, 2)
+            center = found.mean(axis=1)
+            inside = ((center[:, 0] >= inner[0]) & (center[:, 0] < inner[2]) &
+                      (center[:, 1] >= inner[1]) & (center[:, 1] < inner[3]))
+            corners.append(found[inside])
+            ids.append(found_ids.reshape(-1)[inside])
+
+        corners = np.concatenate([self._corners[keep]] + corners)
+        ids = np.concatenate([self._ids[keep]] + ids).astype(np.int32)
+        # Overlapping regions can report the same marker twice
+        centers = corners.mean(axis=1)
+        unique = []
+        for k in range(len(ids)):
+            if not any(ids[j] == ids[k] and np.linalg.norm(centers[j] - centers[k]) < 8 for j in unique):
+                unique.append(k)
+        self._corners, self._ids = corners[unique], ids[unique]
+
+
+def _test_motion_gate():  # TEMPORARY - add testing package at some point
+    """Checks skipping of static frames, regional re-detection of a moved marker and the forced refresh."""
+    from service.vision.aruco import ArucoMarkerDetector
+
+    dictionary = cv.aruco.getPredefinedDictionary(cv.aruco.DICT_4X4_250)
+    rng = np.random.default_rng(0)
+
+    def scene(positions):
+        img = np.full((1080, 1920), 200, dtype=np.uint8)
+        for marker_id, (x, y) in positions.items():
+            img[y - 20:y + 140, x - 20:x + 140] = 255
+            img[y:y + 120, x:x + 120] = cv.aruco.generateImageMarker(dictionary, marker_id, 120)
+        # A 12px marker: below the minimum perimeter of the full frame, but not of a small crop
+        img[796:824, 1036:1064] = 255
+        img[800:812, 1040:1052] = cv.aruco.generateImageMarker(dictionary, 190, 12)
+        noise = rng.normal(0, 2, img.shape)
+        return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+    positions = {1: (100, 100), 2: (1500, 200), 3: (800, 800)}
+    detector = ArucoMarkerDetector("DICT_4X4_250")
+    gate = MotionGate(refresh_interval=5)
+
+    def run(frame):
+        change = gate.check(frame)
+        if change.skip:
+            return change, None
+        corners, ids = gate.detect(detector, frame, change)
+        return change, dict(zip(ids.ravel().tolist(), np.asarray(corners).reshape(-1, 4, 2).mean(axis=1)))
+
+    change, found = run(scene(positions))
+    assert change.regions is None and sorted(found) == [1, 2, 3]
+    change, _ = run(scene(positions))
+    assert change.skip
+
+    positions[3] = (860, 780)
+    change, found = run(scene(positions))
+    assert not change.skip and len(change.regions) == 1
+    x0, y0, x1, y1 = change.regions[0]
+    assert x0 < 860 and x1 > 980 and x1 - x0 < 400
+    assert sorted(found) == [1, 2, 3] and np.allclose(found[3], (920, 840), atol=2)  # Not 190 either
+
+    del positions[2]
+    change, found = run(scene(positions))
+    assert change.regions is not None and sorted(found) == [1, 3]
+
+    assert run(scene(positions))[0].skip
+    change, found = run(scene(positions))
+    assert change.regions is None and not change.skip  # 5th frame since the last full detection
+    assert sorted(found) == [1, 3]
@@ -0,0 +1,71 @@
+from service.vision.aruco import ArucoMarkerDetector
+import cv2 as cv
+import numpy as np
+
+
+class MultiScaleMarkerDetector:
+    """
+    Coarse-to-fine detection for high resolution cameras. Candidates are detected on a downscaled
+    copy of the frame, then each corner is refined to sub-pixel accuracy inside a small window of
+    the full resolution frame.
+    Falls back to full resolution detection when fewer markers than expected are found. Without a
+    configured `expected_count`, the number of markers of the previous frame is expected. Markers only
+    found at full resolution are picked up by a full resolution scan every `full_scan_interval` frames,
+    so an empty table costs no more than the coarse pass.
+    """
+    SUBPIX_CRITERIA = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+
+    def __init__(self, detector: ArucoMarkerDetector, scale: float = 0.5,
+                 expected_count: int = None, refine_window: int = 5, full_scan_interval: int = 30) -> None:
+        self.detector = detector
+        self.scale = scale
+        self.expected_count = expected_count
+        self.refine_window = refine_window
+        self.full_scan_interval = full_scan_interval
+        self.last_count = 0
+        self.fallbacks = 0
+        self.frames_since_full_scan = 0
+
+    def _refine(self, img: np.ndarray, corners: np.ndarray) -> np.ndarray:
+        """Refines the (4, 2) full resolution corners of one marker inside a crop of `img`."""
+        h, w = img.shape[:2]
+        margin = self.refine_window + 2
+        x0, y0 = np.maximum(np.floor(corners.min(axis=0)).astype(int) - margin, 0)
+        x1, y1 = np.minimum(np.ceil(corners.max(axis=0)).astype(int) + margin, (w, h))
+        crop = img[y0:y1, x0:x1]
+        if crop.ndim == 3:
+            crop = cv.cvtColor(crop, cv.COLOR_BGR2GRAY)
+
+        offset = np.array([x0, y0], dtype=np.float32)
+        pts = (corners - offset).reshape(-1, 1, 2).astype(np.float32)
+        pts = cv.cornerSubPix(crop, pts, (self.refine_window, self.refine_window), (-1, -1), self.SUBPIX_CRITERIA)
+        return pts.reshape(4, 2) + offset
+
+    def detect(self, img: np.ndarray, debug: bool = False) -> tuple:
+        """Same contract as ArucoMarkerDetector.detect."""
+        small = cv.resize(img, None, fx=self.scale, fy=self.scale, interpolation=cv.INTER_AREA)
+        corners, ids = self.detector.detect(small)
+
+        count = 0 if ids is None else len(ids)
+        expected = self.last_count if self.expected_count is None else self.expected_count
+        self.frames_since_full_scan += 1
+        if count < expected or self.frames_since_full_scan >= self.full_scan_interval:
+            if count < expected:
+                self.fallbacks += 1
+            self.frames_since_full_scan = 0
+            corners, ids = self.detector.detect(img, debug)
+            self.last_count = 0 if ids is None else len(ids)
+            return corners, ids
+
+        self.last_count = count
+        # Pixel centers: a coarse pixel at c covers full resolution pixels around (c + 0.5) / scale - 0.5
+        refined = tuple(
+            self._refine(img, (c.reshape(4, 2) + 0.5) / self.scale - 0.5).reshape(1, 4, 2).astype(np.float32)
+            for c in corners
+        )
+        return refined, ids
+
+    def close(self) -> None:
+        """Closes the detector running the coarse and the fallback pass (e.g. its tiled worker pool)."""
+        if hasattr(self.detector, "close"):
+            self.detector.close()
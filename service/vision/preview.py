@@ -0,0 +1,154 @@
+import threading
+import time
+import cv2 as cv
+from service.utils.pipeline import LatestQueue, QueueClosed
+from service.utils.buffers import BufferPool
+
+
+def render_preview(frame, corners, ids, scale, undistorter=None, pool=None):
+    """
+    Returns a downscaled BGR preview with the detected markers drawn. If `undistorter` is given,
+    `frame` is still distorted and is undistorted straight to preview size.
+    With a BufferPool, the preview is rendered into its buffers instead of newly allocated images.
+    """
+    def buffer(name, shape):
+        return None if pool is None else pool.get(name, shape)
+
+    if undistorter is not None:
+        preview = undistorter.remap(frame, scale, dst=buffer("preview_remap", undistorter.output_shape(frame, scale)))
+    else:
+        size = (int(round(frame.shape[1] * scale)), int(round(frame.shape[0] * scale)))
+        preview = cv.resize(frame, size, dst=buffer("preview_resize", size[::-1] + frame.shape[2:]))
+    if preview.ndim == 2:
+        preview = cv.cvtColor(preview, cv.COLOR_GRAY2BGR, dst=buffer("preview_bgr", preview.shape + (3,)))
+    if ids is not None:
+        preview = cv.aruco.drawDetectedMarkers(preview, tuple(c * scale for c in corners), ids)
+    return preview
+
+
+class WindowPreview:
+    """
+    Preview in an OpenCV window. GUI calls must run on the main thread, so `show` renders inline,
+    but only `fps` times per second. Returns True if the user pressed 'q'.
+    """
+    def __init__(self, window_name: str = "MAIN", fps: float = 10, scale: float = 0.3, undistorter=None) -> None:
+        self.window_name = window_name
+        self.interval = 1.0 / fps
+        self.scale = scale
+        self.undistorter = undistorter
+        self._last = 0.0
+        self._pool = BufferPool(1)  # Shown before the next render
+
+    def start(self) -> None:
+        cv.namedWindow(self.window_name, cv.WINDOW_AUTOSIZE)
+
+    def show(self, frame, corners, ids) -> bool:
+        now = time.monotonic()
+        if now - self._last < self.interval:
+            return False
+        self._last = now
+        cv.imshow(self.window_name, render_preview(frame, corners, ids, self.scale, self.undistorter, self._pool))
+        return cv.waitKey(1) & 0xFF == ord('q')
+
+    def stop(self) -> None:
+        cv.destroyAllWindows()
+
+
+class MjpegPreview:
+    """
+    Headless preview served as MJPEG over HTTP (open http://<host>:<port>/preview.mjpg in a browser).
+    `show` only hands the latest frame to a background thread, which renders and JPEG-encodes it at
+    most `fps` times per second. Nothing is rendered while no viewer is connected.
+    """
+    BOUNDARY = "frame"
+
+    def __init__(self, http_server, fps: float = 10, scale: float = 0.3, undistorter=None, quality: int = 70) -> None:
+        self.http_server = http_server
+        self.interval = 1.0 / fps
+        self.scale = scale
+        self.undistorter = undistorter
+        self.quality = quality
+        self.viewers = 0
+        self._frames = LatestQueue()
+        self._jpeg = None
+        self._jpeg_seq = 0
+        self._cond = threading.Condition()
+        self._last = 0.0
+        self._pool = BufferPool(1)  # Encoded before the next render
+        http_server.route("/preview.mjpg", self._serve_stream)
+        http_server.route("/preview.jpg", self._serve_snapshot)
+
+    def start(self) -> None:
+        threading.Thread(target=self._render_loop, name="preview", daemon=True).start()
+
+    def show(self, frame, corners, ids) -> bool:
+        now = time.monotonic()
+        if self.viewers == 0 or now - self._last < self.interval:
+            return False
+        self._last = now
+        self._frames.put((frame, corners, ids))
+        return False
+
+    def stop(self) -> None:
+        self._frames.close()
+
+    def _render_loop(self) -> None:
+        while True:
+            try:
+                frame, corners, ids = self._frames.get()
+            except QueueClosed:
+                return
+            preview = render_preview(frame, corners, ids, self.scale, self.undistorter, self._pool)
+            ok, jpeg = cv.imencode(".jpg", preview, [cv.IMWRITE_JPEG_QUALITY, self.quality])
+            if not ok:
+                continue
+            with self._cond:
+                self._jpeg = jpeg.tobytes()
+                self._jpeg_seq += 1
+                self._cond.notify_all()
+
+    def _next_jpeg(self, seq: int, timeout: float = 5.0):
+        """Waits for a JPEG newer than `seq`. Returns (seq, jpeg) or (seq, None) on timeout."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._jpeg_seq > seq, timeout)
+            if self._jpeg_seq > seq:
+                return self._jpeg_seq, self._jpeg
+            return seq, None
+
+    def _serve_stream(self, request) -> None:
+        request.send_response(200)
+        request.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={self.BOUNDARY}")
+        request.send_header("Cache-Control", "no-cache")
+        request.end_headers()
+        with self._cond:
+            self.viewers += 1
+        try:
+            seq = 0
+            while True:
+                seq, jpeg = self._next_jpeg(seq)
+                if jpeg is None:
+                    continue
+                request.wfile.write(f"--{self.BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                                    f"Content-Length: {len(jpeg)}\r\n\r\n".encode())
+                request.wfile.write(jpeg)
+                request.wfile.write(b"\r\n")
+        finally:
+            with self._cond:
+                self.viewers -= 1
+
+    def _serve_snapshot(self, request) -> None:
+        with self._cond:
+            self.viewers += 1
+        try:
+            _, jpeg = self._next_jpeg(self._jpeg_seq)
+        finally:
+            with self._cond:
+                self.viewers -= 1
+        if jpeg is None:
+            request.send_error(503, "No frame available")
+            return
+        request.send_response(200)
+        request.send_header("Content-Type", "image/jpeg")
+        request.send_header("Content-Length", str(len(jpeg)))
+        request.end_headers()
+        request.wfile.write(jpeg)
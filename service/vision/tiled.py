@@ -0,0 +1,180 @@
+from multiprocessing import Pool, shared_memory, resource_tracker
+import os
+import cv2 as cv
+import numpy as np
+from service.vision.aruco import build_dictionary, build_detector_parameters
+
+# Per worker process state, set up by _init_worker
+_worker = {}
+
+
+def _make_detector(aruco_dict: str, detector_params: dict, rate_scale: float = 1.0, active_ids=None):
+    """ArucoDetector for tiles, with the perimeter limits scaled by `rate_scale` (see build_detector_parameters)."""
+    return cv.aruco.ArucoDetector(build_dictionary(aruco_dict, active_ids),
+                                  build_detector_parameters(detector_params, rate_scale))
+
+
+def _init_worker(aruco_dict: str, detector_params: dict, active_ids) -> None:
+    cv.setNumThreads(1)  # Parallelism comes from the pool
+    _worker["aruco_dict"] = aruco_dict
+    _worker["detector_params"] = detector_params
+    _worker["active_ids"] = active_ids
+    _worker["id_map"] = np.asarray(active_ids, dtype=np.int32) if active_ids else None
+    _worker["detectors"] = {}  # rate_scale -> detector
+    _worker["shm"] = None
+
+
+def _attach(shm_name: str):
+    shm = _worker["shm"]
+    if shm is None or shm.name != shm_name:
+        if shm is not None:
+            shm.close()
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker["shm"] = shm
+    return shm
+
+
+def _detect_tile(task) -> tuple:
+    shm_name, shape, (x0, y0, x1, y1), rate_scale = task
+    frame = np.ndarray(shape, dtype=np.uint8, buffer=_attach(shm_name).buf)
+
+    detectors = _worker["detectors"]
+    if rate_scale not in detectors:
+        detectors[rate_scale] = _make_detector(_worker["aruco_dict"], _worker["detector_params"], rate_scale,
+                                               _worker["active_ids"])
+
+    corners, ids, _ = detectors[rate_scale].detectMarkers(frame[y0:y1, x0:x1])
+    if ids is None:
+        return np.empty((0, 4, 2), dtype=np.float32), np.empty(0, dtype=np.int32)
+    corners = np.asarray(corners, dtype=np.float32).reshape(-1, 4, 2) + np.array([x0, y0], dtype=np.float32)
+    ids = ids.reshape(-1)
+    if _worker["id_map"] is not None:
+        ids = _worker["id_map"][ids]
+    return corners, ids
+
+
+class TiledMarkerDetector:
+    """
+    Detector backend that splits the frame into overlapping tiles and detects them in parallel in a
+    persistent process pool. The (grayscale) frame is shared with the workers through shared memory,
+    so only the tile coordinates are sent per task.
+    `overlap_px` must be larger than the biggest marker (in pixels), so every marker lies completely
+    inside at least one tile. Markers found in several tiles are merged by ID, keeping the detection
+    furthest away from its tile border.
+    """
+    def __init__(self, aruco_dict: str, detector_params: dict = None, tiles=(2, 2),
+                 overlap_px: int = 200, workers: int = None, active_ids=None) -> None:
+        self.tiles = tuple(tiles)
+        self.overlap_px = overlap_px
+        self.workers = workers or min(os.cpu_count(), self.tiles[0] * self.tiles[1])
+        # Start the resource tracker before the workers, so they share it instead of starting their own
+        # (which would unlink the shared frame when a worker exits)
+        resource_tracker.ensure_running()
+        self.pool = Pool(self.workers, initializer=_init_worker, initargs=(aruco_dict, detector_params, active_ids))
+        self._shm = None
+        self._frame = None
+        self._tasks = None
+        self._rects = None
+
+    def _setup(self, shape) -> None:
+        """(Re)allocates the shared frame and the tile layout for frames of `shape`."""
+        self.close_shm()
+        h, w = shape
+        self._shm = shared_memory.SharedMemory(create=True, size=h * w)
+        self._frame = np.ndarray(shape, dtype=np.uint8, buffer=self._shm.buf)
+
+        cols, rows = self.tiles
+        xs = np.linspace(0, w, cols + 1).astype(int)
+        ys = np.linspace(0, h, rows + 1).astype(int)
+        self._tasks = []
+        self._rects = []
+        for r in range(rows):
+            for c in range(cols):
+                x0, x1 = max(0, xs[c] - self.overlap_px // 2), min(w, xs[c + 1] + self.overlap_px // 2)
+                y0, y1 = max(0, ys[r] - self.overlap_px // 2), min(h, ys[r + 1] + self.overlap_px // 2)
+                rate_scale = max(w, h) / max(x1 - x0, y1 - y0)
+                self._tasks.append((self._shm.name, shape, (x0, y0, x1, y1), rate_scale))
+                self._rects.append((x0, y0, x1, y1))
+
+    def detect(self, img: np.ndarray, debug: bool = False) -> tuple:
+        """Same contract as ArucoMarkerDetector.detect (`debug` is not supported)."""
+        if self._frame is None or self._frame.shape != img.shape[:2]:
+            self._setup(img.shape[:2])
+        if img.ndim == 3:
+            cv.cvtColor(img, cv.COLOR_BGR2GRAY, dst=self._frame)
+        else:
+            np.copyto(self._frame, img)
+
+        results = self.pool.map(_detect_tile, self._tasks)
+        return self._merge(results)
+
+    def _merge(self, results) -> tuple:
+        corners = np.concatenate([c for c, _ in results])
+        ids = np.concatenate([i for _, i in results])
+        if len(ids) == 0:
+            return (), None
+
+        # Distance of every detection to the border of the tile it was found in
+        rects = np.concatenate([np.repeat([rect], len(i), axis=0) for rect, (_, i) in zip(self._rects, results)])
+        lo, hi = corners.min(axis=1), corners.max(axis=1)
+        margin = np.minimum(lo - rects[:, :2], rects[:, 2:] - hi).min(axis=1)
+
+        # Same ID and overlapping position = the same marker seen by two tiles
+        centers = corners.mean(axis=1)
+        sizes = (hi - lo).max(axis=1)
+        keep = []
+        for idx in np.argsort(-margin):
+            if not any(ids[k] == ids[idx] and np.linalg.norm(centers[k] - centers[idx]) < sizes[k] for k in keep):
+                keep.append(idx)
+        keep.sort()
+
+        corners_cv = tuple(corners[k].reshape(1, 4, 2) for k in keep)
+        return corners_cv, ids[keep].reshape(-1, 1).astype(np.int32)
+
+    def close_shm(self) -> None:
+        if self._shm is not None:
+            self._frame = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def close(self) -> None:
+        self.pool.terminate()
+        self.close_shm()
+
+
+def _synthetic_scene(count: int = 20, size: int = 140, seed: int = 0) -> np.ndarray:
+    """4K test scene with `count` DICT_4X4_250 markers at random positions."""
+    scene = cv.imread('text-test-4k.png')
+    dictionary = cv.aruco.getPredefinedDictionary(cv.aruco.DICT_4X4_250)
+    rng = np.random.default_rng(seed)
+    h, w = scene.shape[:2]
+    cell = size + 60
+    positions = rng.permutation([(x, y) for y in range(0, h - cell, cell) for x in range(0, w - cell, cell)])[:count]
+    for marker_id, (x, y) in enumerate(positions):
+        marker = cv.aruco.generateImageMarker(dictionary, marker_id, size)
+        marker = cv.copyMakeBorder(marker, 20, 20, 20, 20, cv.BORDER_CONSTANT, value=255)
+        scene[y:y + size + 40, x:x + size + 40] = marker[..., np.newaxis]
+    return scene
+
+
+def _test_tiled_equivalence(tolerance_px: float = 0.01):  # TEMPORARY - add testing package at some point
+    """Checks that the tiled backend finds the same markers at the same corners as ArucoMarkerDetector."""
+    from service.vision.aruco import ArucoMarkerDetector
+
+    scene = _synthetic_scene()
+    corners, ids = ArucoMarkerDetector("DICT_4X4_250").detect(scene)
+    reference = dict(zip(ids.flatten().tolist(), corners))
+    assert len(reference) == 20
+
+    for tiles in ((2, 2), (3, 2), (4, 3)):
+        detector = TiledMarkerDetector("DICT_4X4_250", tiles=tiles, overlap_px=220)
+        try:
+            corners, ids = detector.detect(scene)
+        finally:
+            detector.close()
+        found = dict(zip(ids.flatten().tolist(), corners))
+        assert sorted(found) == sorted(reference), f"{tiles}: {sorted(found)} != {sorted(reference)}"
+        err = max(np.abs(found[i] - reference[i]).max() for i in reference)
+        print(f"Tiles {tiles}: max corner deviation {err:.4f}px")
+        assert err < tolerance_px
@@ -0,0 +1,63 @@
+from service.vision.aruco import ArucoMarkerDetector, padded_roi
+import numpy as np
+
+
+class TrackingMarkerDetector:
+    """
+    Wraps an ArucoMarkerDetector and exploits that markers on the table barely move between frames.
+    Known markers are re-detected only inside a padded crop around their last position. A full-frame
+    scan runs every `full_scan_interval` frames, or immediately when a tracked marker is lost.
+    New markers are therefore picked up with a delay of at most `full_scan_interval` frames.
+    The crops are detected with `roi_detector`, else with `detector` - an ArucoMarkerDetector (see
+    detect_roi) either way, e.g. the plain detector when `detector` is multi-scale.
+    """
+    def __init__(self, detector: ArucoMarkerDetector, padding: float = 0.5,
+                 full_scan_interval: int = 15, min_padding_px: int = 32,
+                 roi_detector: ArucoMarkerDetector = None) -> None:
+        self.detector = detector
+        self.roi_detector = detector if roi_detector is None else roi_detector
+        self.padding = padding
+        self.full_scan_interval = full_scan_interval
+        self.min_padding_px = min_padding_px
+        self.tracks = {}  # id -> (4, 2) corners of the last detection
+        self.frames_since_full_scan = 0
+
+    def _full_scan(self, img: np.ndarray, debug: bool) -> tuple:
+        self.frames_since_full_scan = 0
+        corners, ids = self.detector.detect(img, debug)
+        self.tracks = {}
+        if ids is not None:
+            for c, i in zip(corners, ids.flatten()):
+                self.tracks[int(i)] = c.reshape(4, 2)
+        return corners, ids
+
+    def detect(self, img: np.ndarray, debug: bool = False) -> tuple:
+        """Same contract as ArucoMarkerDetector.detect."""
+        self.frames_since_full_scan += 1
+        if not self.tracks or self.frames_since_full_scan >= self.full_scan_interval:
+            return self._full_scan(img, debug)
+
+        found = {}
+        for marker_id, last_corners in self.tracks.items():
+            if marker_id in found:  # Already re-detected in a neighbouring crop
+                continue
+            roi = padded_roi(last_corners, img.shape, self.padding, self.min_padding_px)
+            corners, ids = self.roi_detector.detect_roi(img, roi)  # Accepts the same markers as a full scan
+            if ids is None:
+                continue
+            for c, i in zip(corners, ids.flatten()):
+                found.setdefault(int(i), c.reshape(4, 2))
+
+        if any(marker_id not in found for marker_id in self.tracks):
+            # Track lost - the marker was removed or moved too fast for its crop
+            return self._full_scan(img, debug)
+
+        self.tracks = found
+        ids_cv = np.array(list(found.keys()), dtype=np.int32).reshape(-1, 1)
+        corners_cv = tuple(c.reshape(1, 4, 2).astype(np.float32) for c in found.values())
+        return corners_cv, ids_cv
+
+    def close(self) -> None:
+        """Closes the detector used for full scans."""
+        if hasattr(self.detector, "close"):
+            self.detector.close()
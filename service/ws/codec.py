@@ -0,0 +1,83 @@
+import json
+import struct
+import numpy as np
+
+# Clients that do not negotiate a subprotocol receive the JSON format (see README).
+# Clients that request BINARY_SUBPROTOCOL receive binary frames:
+#
+#   header  (24 bytes) : version u8 | kind u8 | count u16 | seq u32 | t_capture f64 | t_send f64
+#   records (count x 10 bytes): id u16 | x f32 | y f32
+#   removed (DELTA only): count u16 | count x id u16
+#
+# All values are little-endian, x/y are marker centers in projector space. seq is the camera frame
+# number, t_capture / t_send the server's wall clock (time.time()) at capture and at broadcast.
+#
+# The *_DELTA_SUBPROTOCOLs opt into the delta stream (see service/ws/delta.py): keyframes carry
+# the complete marker set, deltas only markers that appeared or moved plus the removed ids.
+BINARY_SUBPROTOCOL = "artable.markers.bin.v2"
+JSON_DELTA_SUBPROTOCOL = "artable.markers.delta.v1"
+BINARY_DELTA_SUBPROTOCOL = "artable.markers.bin.delta.v2"
+SUBPROTOCOLS = [BINARY_SUBPROTOCOL]
+DELTA_SUBPROTOCOLS = [BINARY_DELTA_SUBPROTOCOL, JSON_DELTA_SUBPROTOCOL]
+
+BINARY_VERSION = 2
+KIND_FULL = 0
+KIND_KEYFRAME = 1
+KIND_DELTA = 2
+JSON_KINDS = {KIND_KEYFRAME: "keyframe", KIND_DELTA: "delta"}
+
+HEADER = struct.Struct("<BBHIdd")
+REMOVED_COUNT = struct.Struct("<H")
+RECORD_DTYPE = np.dtype([("id", "<u2"), ("x", "<f4"), ("y", "<f4")])
+
+
+def encode_binary(batch, seq: int, kind: int = KIND_FULL, removed=None,
+                  t_capture: float = 0.0, t_send: float = 0.0) -> bytes:
+    """Encodes a MarkerBatch as a binary frame."""
+    records = np.empty(len(batch), dtype=RECORD_DTYPE)
+    records["id"] = batch.ids
+    records["x"] = batch.centers[:, 0]
+    records["y"] = batch.centers[:, 1]
+    buf = HEADER.pack(BINARY_VERSION, kind, len(records), seq & 0xFFFFFFFF, t_capture, t_send) + records.tobytes()
+    if kind == KIND_DELTA:
+        removed = np.asarray(removed, dtype="<u2")
+        buf += REMOVED_COUNT.pack(len(removed)) + removed.tobytes()
+    return buf
+
+
+def decode_binary(buf: bytes) -> dict:
+    """
+    Reference decoder for binary frames.
+    Returns a dict with `seq`, `t_capture`, `t_send`, `kind`, `markers` (structured array with fields
+    id, x and y) and `removed` (array of ids, empty unless kind is KIND_DELTA).
+    """
+    version, kind, count, seq, t_capture, t_send = HEADER.unpack_from(buf, 0)
+    if version != BINARY_VERSION:
+        raise ValueError(f"Unsupported binary marker frame version {version}")
+    markers = np.frombuffer(buf, dtype=RECORD_DTYPE, count=count, offset=HEADER.size)
+    removed = np.empty(0, dtype="<u2")
+    if kind == KIND_DELTA:
+        offset = HEADER.size + markers.nbytes
+        (n_removed,) = REMOVED_COUNT.unpack_from(buf, offset)
+        removed = np.frombuffer(buf, dtype="<u2", count=n_removed, offset=offset + REMOVED_COUNT.size)
+    return {"seq": seq, "t_capture": t_capture, "t_send": t_send, "kind": kind, "markers": markers, "removed": removed}
+
+
+def _json_timing(seq: int, t_capture: float, t_send: float) -> str:
+    return f'"seq": {seq}, "t_capture": {t_capture!r}, "t_send": {t_send!r}'
+
+
+def encode(batch, subprotocol, seq: int, t_capture: float = 0.0, t_send: float = 0.0):
+    """Encodes a MarkerBatch for a client that negotiated `subprotocol` (None = JSON)."""
+    if subprotocol == BINARY_SUBPROTOCOL:
+        return encode_binary(batch, seq, t_capture=t_capture, t_send=t_send)
+    return f'{{"markers": {batch.records_json()}, {_json_timing(seq, t_capture, t_send)}}}'
+
+
+def encode_update(update, subprotocol, seq: int, t_capture: float = 0.0, t_send: float = 0.0):
+    """Encodes a StreamUpdate for a client that negotiated one of the DELTA_SUBPROTOCOLS."""
+    kind = KIND_KEYFRAME if update.keyframe else KIND_DELTA
+    if subprotocol == BINARY_DELTA_SUBPROTOCOL:
+        return encode_binary(update.markers, seq, kind, update.removed, t_capture, t_send)
+    return (f'{{"kind": "{JSON_KINDS[kind]}", "markers": {update.markers.records_json()}, '
+            f'"removed": {json.dumps(update.removed.tolist())}, {_json_timing(seq, t_capture, t_send)}}}')
@@ -0,0 +1,64 @@
+from service.vision.aruco import MarkerBatch
+import numpy as np
+
+
+class StreamUpdate:
+    """
+    One message of a delta stream. A keyframe carries the complete marker set in `markers`;
+    a delta only the markers that appeared or moved, plus the ids of the ones that disappeared.
+    """
+    def __init__(self, keyframe: bool, markers: MarkerBatch, removed: np.ndarray) -> None:
+        self.keyframe = keyframe
+        self.markers = markers
+        self.removed = removed
+
+    def is_empty(self) -> bool:
+        return not self.keyframe and len(self.markers) == 0 and len(self.removed) == 0
+
+
+class DeltaStream:
+    """
+    Turns the per-frame marker batches into a delta/keyframe stream.
+    The state is the marker set as the clients know it: a marker is only re-sent once it moved more than
+    `threshold_px` (projector space) from its last sent position. Every `keyframe_interval` frames a
+    keyframe resets the state to the current detection. Marker ids are assumed to be unique per frame.
+    """
+    def __init__(self, threshold_px: float = 2.0, keyframe_interval: int = 30) -> None:
+        self.threshold_px = threshold_px
+        self.keyframe_interval = keyframe_interval
+        self.state = MarkerBatch()
+        self.frames_since_keyframe = 0
+
+    def keyframe(self) -> StreamUpdate:
+        """Keyframe of the current state, e.g. for clients that (re)join the stream."""
+        return StreamUpdate(True, self.state, np.empty(0, dtype=np.int32))
+
+    def update(self, batch: MarkerBatch) -> StreamUpdate:
+        _, first = np.unique(batch.ids, return_index=True)
+        if len(first) != len(batch):
+            batch = MarkerBatch(batch.data[np.sort(first)])
+
+        self.frames_since_keyframe += 1
+        if self.frames_since_keyframe >= self.keyframe_interval:
+            self.frames_since_keyframe = 0
+            self.state = batch
+            return self.keyframe()
+
+        prev = self.state.data
+        order = np.argsort(prev["id"])
+        pos = np.clip(np.searchsorted(prev["id"], batch.ids, sorter=order), 0, max(len(prev) - 1, 0))
+        prev_idx = order[pos] if len(prev) else pos
+        found = prev["id"][prev_idx] == batch.ids if len(prev) else np.zeros(len(batch), dtype=bool)
+
+        changed = ~found
+        if found.any():
+            dist = np.linalg.norm(batch.centers[found] - prev["center"][prev_idx[found]], axis=1)
+            changed[found] = dist > self.threshold_px
+
+        removed = prev["id"][~np.isin(prev["id"], batch.ids)]
+
+        # Unchanged markers keep the position the clients know about
+        state = batch.data.copy()
+        state[~changed] = prev[prev_idx[~changed]]
+        self.state = MarkerBatch(state)
+        return StreamUpdate(False, MarkerBatch(batch.data[changed]), removed)
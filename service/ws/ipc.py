@@ -0,0 +1,146 @@
+import os
+import socket
+import struct
+import threading
+import time
+import numpy as np
+from service.utils.pipeline import LatestQueue, QueueClosed
+from service.vision.aruco import MarkerBatch, MARKER_DTYPE
+
+# Local transport between the detection process and the WebSocket gateway processes.
+# Addresses are either "unix:///path/to/socket" or "tcp://host:port" (for platforms without AF_UNIX).
+# Every message is length-prefixed: length u32 | seq u64 | t_capture f64 | count x MARKER_DTYPE records (little-endian).
+LENGTH = struct.Struct("<I")
+FRAME_HEADER = struct.Struct("<Qd")
+
+
+def _socket_for(address: str):
+    """Returns (socket, address to bind/connect) for a unix:// or tcp:// address."""
+    if address.startswith("unix://"):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), address[len("unix://"):]
+    if address.startswith("tcp://"):
+        host, port = address[len("tcp://"):].rsplit(":", 1)
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM), (host, int(port))
+    raise ValueError(f"Unsupported IPC address {address}, use unix://<path> or tcp://<host>:<port>")
+
+
+def encode_frame(batch: MarkerBatch, seq: int, t_capture: float) -> bytes:
+    payload = FRAME_HEADER.pack(seq, t_capture) + batch.data.astype(MARKER_DTYPE.newbyteorder("<"), copy=False).tobytes()
+    return LENGTH.pack(len(payload)) + payload
+
+
+def decode_frame(payload: bytes) -> tuple:
+    """Returns (seq, t_capture, MarkerBatch) of a message without its length prefix."""
+    seq, t_capture = FRAME_HEADER.unpack_from(payload, 0)
+    data = np.frombuffer(payload, dtype=MARKER_DTYPE.newbyteorder("<"), offset=FRAME_HEADER.size)
+    return seq, t_capture, MarkerBatch(data.astype(MARKER_DTYPE))
+
+
+class _Subscriber(threading.Thread):
+    """Sends to one subscriber connection. Only the newest frame is kept if the subscriber falls behind."""
+    def __init__(self, conn, on_close) -> None:
+        super().__init__(name="ipc-subscriber", daemon=True)
+        self.conn = conn
+        self.on_close = on_close
+        self.frames = LatestQueue()
+
+    def run(self) -> None:
+        try:
+            while True:
+                self.conn.sendall(self.frames.get())
+        except (QueueClosed, OSError):
+            pass
+        finally:
+            self.frames.close()
+            self.conn.close()
+            self.on_close(self)
+
+
+class FramePublisher:
+    """
+    Drop-in replacement for WebSocketServer in the detection process: every frame is encoded once
+    and published to the local gateway processes (see service/tasks/gateway.py), which serve the
+    WebSocket clients. Detection never waits for a gateway.
+    """
+    PEER = "Gateway"  # Who subscribes, for the log
+
+    def __init__(self, address: str) -> None:
+        self.address = address
+        self.seq = 0
+        self.subscribers = set()
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        sock, bind_address = _socket_for(self.address)
+        if sock.family == getattr(socket, "AF_UNIX", None) and os.path.exists(bind_address):
+            os.remove(bind_address)  # Stale socket of a previous run
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(bind_address)
+        sock.listen()
+        print(f"Publishing marker frames on {self.address}")
+        threading.Thread(target=self._accept_loop, args=(sock,), daemon=True).start()
+
+    def _accept_loop(self, sock) -> None:
+        while True:
+            conn, _ = sock.accept()
+            print(f"{self.PEER} connected")
+            subscriber = _Subscriber(conn, self._remove)
+            with self._lock:
+                self.subscribers.add(subscriber)
+            subscriber.start()
+
+    def _remove(self, subscriber) -> None:
+        with self._lock:
+            self.subscribers.discard(subscriber)
+        print(f"{self.PEER} disconnected")
+
+    def encode(self, batch: MarkerBatch, seq: int, t_capture: float) -> bytes:
+        return encode_frame(batch, seq, t_capture)
+
+    def broadcast(self, payload: MarkerBatch, seq: int = None, t_capture: float = None) -> None:
+        self.seq = self.seq + 1 if seq is None else seq
+        t_capture = time.time() if t_capture is None else t_capture
+        with self._lock:
+            subscribers = list(self.subscribers)
+        if not subscribers:
+            return
+        message = self.encode(payload, self.seq, t_capture)
+        for subscriber in subscribers:
+            subscriber.frames.put(message)
+
+
+class FrameSubscriber:
+    """Iterates over (seq, t_capture, MarkerBatch) published by a FramePublisher. Reconnects if the publisher goes away."""
+    def __init__(self, address: str, retry_interval: float = 1.0) -> None:
+        self.address = address
+        self.retry_interval = retry_interval
+
+    def decode(self, payload: bytes) -> tuple:
+        return decode_frame(payload)
+
+    @staticmethod
+    def _recv_exactly(conn, n: int) -> bytes:
+        buf = bytearray(n)
+        view = memoryview(buf)
+        while n:
+            received = conn.recv_into(view[len(buf) - n:], n)
+            if not received:
+                raise ConnectionError("Publisher closed the connection")
+            n -= received
+        return bytes(buf)
+
+    def __iter__(self):
+        while True:
+            sock, connect_address = _socket_for(self.address)
+            try:
+                sock.connect(connect_address)
+                print(f"Subscribed to marker frames on {self.address}")
+                while True:
+                    (length,) = LENGTH.unpack(self._recv_exactly(sock, LENGTH.size))
+                    yield self.decode(self._recv_exactly(sock, length))
+            except OSError as e:
+                print(f"No connection to {self.address} ({e}), retrying...")
+                time.sleep(self.retry_interval)
+            finally:
+                sock.close()
@@ -1,28 +1,146 @@
 import asyncio
 import threading
 import json
+import time
 import websockets
+from websockets.asyncio.server import serve
 from typing import Set
+from service.ws.codec import SUBPROTOCOLS, DELTA_SUBPROTOCOLS, encode, encode_update
+from service.ws.session import ClientSession
+from service.ws.subscription import Subscription, SubscriptionGroup
+from service.ws.delta import DeltaStream
+from service.utils.metrics import METRICS
+
+ENCODE_TIME = METRICS.histogram("ws_encode_seconds", "Time to encode one frame for all subprotocols")
+FANOUT_TIME = METRICS.histogram("ws_fanout_seconds", "Time from broadcast until the frame is queued for every client")
+THROTTLED = METRICS.counter("ws_messages_throttled_total", "Messages not sent to clients because of their max_rate")
+
+STATS_PATH = "/stats"
 
 
 class WebSocketServer:
-    def __init__(self, host="0.0.0.0", port=5001):
+    """
+    Broadcasts the detected markers to all connected clients.
+    Every client has its own latest-wins send queue and sender task (see ClientSession),
+    so fan-out latency does not depend on the slowest client.
+    If a DeltaStream is given, clients can opt into the delta stream via the delta subprotocols.
+    Clients can subscribe to a subset of the markers and limit their update rate (see Subscription);
+    clients with the same subscription form a SubscriptionGroup and share the encoded messages.
+    Clients connecting to the STATS_PATH instead receive the metrics every `stats_interval` seconds (0 = disabled).
+    """
+    def __init__(self, host="0.0.0.0", port=5001, stream=None, slow_client_cfg: dict = None, reuse_port=False,
+                 stats_interval: float = 0):
         self.host = host
         self.port = port
-        self.clients: Set[websockets.WebSocketServerProtocol] = set()
+        self.reuse_port = reuse_port  # Lets several gateway processes share the port
+        self.clients: Set[ClientSession] = set()
         self.loop = None
+        self.seq = 0
+        self.stream = stream
+        self.subprotocols = SUBPROTOCOLS + (DELTA_SUBPROTOCOLS if stream is not None else [])
+        self.slow_client_cfg = slow_client_cfg or {}
+        self.stats_interval = stats_interval
+        self._groups = {}  # Subscription.key -> SubscriptionGroup, for the subscriptions of connected clients
+        self._lock = threading.Lock()
+        METRICS.gauge("ws_clients", "Connected WebSocket clients", fn=lambda: len(self.clients))
+        METRICS.gauge("ws_subscription_groups", "Distinct client subscriptions", fn=lambda: len(self._groups))
+        METRICS.collector("ws_client_queue_depth", "Messages waiting to be sent, per client",
+                          self._queue_depths)
+
+    def _select_subprotocol(self, connection, subprotocols):
+        # Unlike the websockets default, accept clients that offer no (or no supported) subprotocol - they get JSON
+        for subprotocol in self.subprotocols:
+            if subprotocol in subprotocols:
+                return subprotocol
+        return None
+
+    async def _stats_handler(self, websocket):
+        if not self.stats_interval:
+            await websocket.close(1008, "stats are disabled")
+            return
+        while True:
+            await websocket.send(json.dumps({"type": "stats", "time": time.time(), "metrics": METRICS.snapshot()}))
+            await asyncio.sleep(self.stats_interval)
+
+    async def _on_message(self, session, message):
+        """
+        Handles a control message sent by a client (JSON with a "type"). Unknown messages are ignored.
+        "clock_sync" ({"type": "clock_sync", "t0": <client time>}) is answered right away with the server's
+        receive (t1) and send (t2) time, so the client can estimate the clock offset NTP-style.
+        "subscribe" replaces the client's subscription (see Subscription) and is confirmed with a
+        "subscribed" message echoing it, or answered with an "error" message if invalid.
+        """
+        t1 = time.time()
+        try:
+            request = json.loads(message)
+        except ValueError:
+            return
+        if not isinstance(request, dict):
+            return
+        if request.get("type") == "clock_sync":
+            reply = {"type": "clock_sync", "t0": request.get("t0"), "t1": t1, "t2": time.time()}
+            await session.ws.send(json.dumps(reply))
+        elif request.get("type") == "subscribe":
+            try:
+                subscription = Subscription.parse(request)
+            except ValueError as e:
+                await session.ws.send(json.dumps({"type": "error", "request": "subscribe", "message": str(e)}))
+                return
+            session.subscription = subscription
+            # The markers known to a delta client no longer match what it will receive
+            session.needs_keyframe = session.subprotocol in DELTA_SUBPROTOCOLS
+            reply = {"ids": None, "rects": None, "max_rate": None} if subscription is None else subscription.to_dict()
+            await session.ws.send(json.dumps({"type": "subscribed", **reply}))
 
     async def _handler(self, websocket):
-        print("WebSocket client connected")
-        self.clients.add(websocket)
+        if websocket.request.path == STATS_PATH:
+            try:
+                await self._stats_handler(websocket)
+            except websockets.ConnectionClosed:
+                pass
+            return
+        print(f"WebSocket client connected (subprotocol: {websocket.subprotocol or 'json'})")
+        session = ClientSession(websocket, **self.slow_client_cfg)
+        session.needs_keyframe = websocket.subprotocol in DELTA_SUBPROTOCOLS
+        session.start()
+        with self._lock:
+            self.clients.add(session)
         try:
-            await websocket.wait_closed()
+            async for message in websocket:
+                await self._on_message(session, message)
+        except websockets.ConnectionClosed:
+            pass
         finally:
-            self.clients.remove(websocket)
-            print("WebSocket client disconnected")
+            with self._lock:
+                self.clients.remove(session)
+            session.stop()
+            print(f"WebSocket client disconnected (sent: {session.sent}, dropped: {session.dropped})")
+
+    def _queue_depths(self) -> dict:
+        return {(("client", "%s:%s" % session.ws.remote_address[:2]),): session.queue_depth
+                for session in list(self.clients)}
+
+    def client_stats(self) -> list:
+        """Per-client send counters, e.g. for monitoring."""
+        return [
+            {
+                "address": session.ws.remote_address,
+                "subprotocol": session.subprotocol,
+                "sent": session.sent,
+                "dropped": session.dropped,
+                "queue_depth": session.queue_depth,
+                "slow": session.slow,
+                "subscription": None if session.subscription is None else session.subscription.to_dict(),
+            }
+            for session in list(self.clients)
+        ]
 
     async def _run(self):
-        async with websockets.serve(self._handler, self.host, self.port):
+        # The new asyncio implementation - in websockets 13, websockets.serve is still the legacy one
+        async with serve(self._handler, self.host, self.port,
+                         subprotocols=self.subprotocols,
+                         select_subprotocol=self._select_subprotocol,
+                         reuse_port=self.reuse_port or None):
             print(f"WebSocket server listening on ws://{self.host}:{self.port}")
             await asyncio.Future()  # run forever
 
@@ -34,20 +152,108 @@ class WebSocketServer:
 
         threading.Thread(target=runner, daemon=True).start()
 
-    def broadcast(self, payload: dict):
-        if not self.loop or not self.clients:
-            return
+    def _encode_messages(self, batch, clients, update, t_capture, t_send, stream=None):
+        """
+        Encodes `batch` once per required (subprotocol, kind) and returns one (message, kind) per client.
+        Delta clients with nothing to receive get (None, None). `update` / `stream` are the delta stream
+        of these clients (default: the server's).
+        """
+        stream = self.stream if stream is None else stream
+        encoded = {}
+        messages = []
+        for session in clients:
+            protocol = session.subprotocol
+            if protocol not in DELTA_SUBPROTOCOLS:
+                kind = "full"
+            elif update.keyframe or session.needs_keyframe:
+                session.needs_keyframe = False
+                kind = "keyframe"
+            elif update.is_empty():
+                messages.append((None, None))  # Nothing changed - nothing to send
+                continue
+            else:
+                kind = "delta"
+
+            key = (protocol, kind)
+            if key not in encoded:
+                if kind == "full":
+                    encoded[key] = encode(batch, protocol, self.seq, t_capture, t_send)
+                elif kind == "keyframe":
+                    # Only for this client: the others still get the delta
+                    keyframe = update if update.keyframe else stream.keyframe()
+                    encoded[key] = encode_update(keyframe, protocol, self.seq, t_capture, t_send)
+                else:
+                    encoded[key] = encode_update(update, protocol, self.seq, t_capture, t_send)
+            messages.append((encoded[key], kind))
+        return messages
+
+    def _encode_subscriptions(self, batch, clients, update, t_capture, t_send):
+        """
+        Splits `clients` by subscription and encodes every group that is due (see SubscriptionGroup)
+        with its own markers. Returns the clients to send to and one (message, kind) per client.
+        """
+        members = {}
+        for session in clients:
+            members.setdefault(None if session.subscription is None else session.subscription.key, []).append(session)
+        self._groups = {key: self._groups.get(key) or self._new_group(sessions[0].subscription)
+                        for key, sessions in members.items() if key is not None}
+
+        out_clients, messages = [], []
+        now = time.monotonic()
+        for key, sessions in members.items():
+            if key is None:
+                out_clients += sessions
+                messages += self._encode_messages(batch, sessions, update, t_capture, t_send)
+                continue
+            group = self._groups[key]
+            if not group.due(now):
+                THROTTLED.inc(len(sessions))
+                continue
+            group_batch = group.subscription.filter(batch)
+            group_update = None
+            if group.stream is not None and any(s.subprotocol in DELTA_SUBPROTOCOLS for s in sessions):
+                group_update = group.stream.update(group_batch)
+            out_clients += sessions
+            messages += self._encode_messages(group_batch, sessions, group_update, t_capture, t_send, group.stream)
+        return out_clients, messages
+
+    def _new_group(self, subscription) -> SubscriptionGroup:
+        stream = None
+        if self.stream is not None:
+            stream = DeltaStream(self.stream.threshold_px, self.stream.keyframe_interval)
+        return SubscriptionGroup(subscription, stream)
 
-        message = json.dumps(payload)
+    def _dispatch(self, clients, messages, t_broadcast):
+        for session, (message, kind) in zip(clients, messages):
+            if message is not None:
+                session.offer(message, kind)
+        FANOUT_TIME.observe(time.perf_counter() - t_broadcast)
 
-        async def _send():
-            dead = []
-            for ws in self.clients:
-                try:
-                    await ws.send(message)
-                except Exception:
-                    dead.append(ws)
-            for ws in dead:
-                self.clients.discard(ws)
+    def broadcast(self, payload, seq: int = None, t_capture: float = None):
+        """
+        Queues `payload` for all clients; never blocks on slow clients. A MarkerBatch is encoded once
+        per negotiated subprotocol, along with the frame's `seq`, capture time and send time (now);
+        a dict or an already serialized JSON string is sent as is to every client.
+        `seq` overrides the frame counter, e.g. with the camera frame number.
+        """
+        t0 = time.perf_counter()
+        t_send = time.time()
+        t_capture = t_send if t_capture is None else t_capture
+        self.seq = self.seq + 1 if seq is None else seq
+        if isinstance(payload, (str, dict)):
+            if not self.loop or not self.clients:
+                return
+            clients = list(self.clients)
+            message = payload if isinstance(payload, str) else json.dumps(payload)
+            messages = [(message, "full")] * len(clients)
+        else:
+            with self._lock:
+                # The stream is updated even without clients, so joining clients get the current state
+                update = self.stream.update(payload) if self.stream is not None else None
+                clients = list(self.clients)
+            if not self.loop or not clients:
+                return
+            clients, messages = self._encode_subscriptions(payload, clients, update, t_capture, t_send)
+            ENCODE_TIME.observe(time.perf_counter() - t0)
 
-        asyncio.run_coroutine_threadsafe(_send(), self.loop)
\ No newline at end of file
+        self.loop.call_soon_threadsafe(self._dispatch, clients, messages, t0)
@@ -0,0 +1,106 @@
+import asyncio
+import time
+from service.utils.metrics import METRICS
+
+SEND_TIME = METRICS.histogram("ws_send_seconds", "Time to hand one message to a client connection")
+SENT = METRICS.counter("ws_messages_sent_total", "Messages sent to WebSocket clients")
+DROPPED = METRICS.counter("ws_messages_dropped_total", "Messages dropped because a client had not received the previous one yet")
+
+
+class ClientSession:
+    """
+    Outbound side of one WebSocket client: a single-slot, latest-wins queue drained by the
+    client's own sender task, so a slow client never delays the others.
+
+    Messages that are still pending when a newer one arrives are dropped. Since a delta stream
+    client cannot skip a delta, both are discarded in that case and `needs_keyframe` is set instead.
+    A client that keeps dropping `max_consecutive_drops` messages in a row, or whose send stalls for
+    `send_timeout` seconds, is considered slow. With the "disconnect" policy it gets disconnected,
+    with the "drop" policy it stays connected and simply receives fewer updates.
+    """
+    POLICIES = ("drop", "disconnect")
+
+    def __init__(self, ws, policy: str = "drop", max_consecutive_drops: int = 30, send_timeout: float = 2.0) -> None:
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown slow client policy {policy}, use one of {self.POLICIES}")
+        self.ws = ws
+        self.policy = policy
+        self.max_consecutive_drops = max_consecutive_drops
+        self.send_timeout = send_timeout
+        self.needs_keyframe = False
+        self.subscription = None  # Subscription set by the client, None: every marker at the full rate
+        self.sent = 0
+        self.dropped = 0
+        self.consecutive_drops = 0
+        self.slow = False
+        self._pending = None
+        self._closing = False
+        self._event = asyncio.Event()
+        self._task = None
+
+    @property
+    def subprotocol(self):
+        return self.ws.subprotocol
+
+    @property
+    def queue_depth(self) -> int:
+        return 0 if self._pending is None else 1
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    def offer(self, message, kind: str) -> None:
+        """Queues `message` (kind: "full", "keyframe" or "delta"). Must be called on the event loop."""
+        if self._pending is not None:
+            self.dropped += 1
+            DROPPED.inc()
+            self.consecutive_drops += 1
+            if self.consecutive_drops >= self.max_consecutive_drops:
+                self._on_slow(f"dropped {self.consecutive_drops} messages in a row")
+            if kind == "delta":
+                # The pending update would be lost - discard both and resync with a keyframe
+                self._pending = None
+                self.needs_keyframe = True
+                return
+        else:
+            self.consecutive_drops = 0
+        self._pending = message
+        self._event.set()
+
+    def _on_slow(self, reason: str) -> None:
+        if not self.slow:
+            print(f"WebSocket client {self.ws.remote_address} is slow ({reason}), policy: {self.policy}")
+        self.slow = True
+        if self.policy == "disconnect" and not self._closing:
+            self._closing = True
+            asyncio.ensure_future(self._disconnect())
+
+    async def _disconnect(self) -> None:
+        try:
+            await asyncio.wait_for(self.ws.close(1013, "client too slow"), self.send_timeout)
+        except asyncio.TimeoutError:
+            self.ws.transport.abort()  # The close frame is stuck behind the unsent data
+
+    async def _run(self) -> None:
+        while True:
+            await self._event.wait()
+            self._event.clear()
+            message, self._pending = self._pending, None
+            if message is None:
+                continue
+            try:
+                t0 = time.perf_counter()
+                await asyncio.wait_for(self.ws.send(message), self.send_timeout)
+                SEND_TIME.observe(time.perf_counter() - t0)
+                self.sent += 1
+                SENT.inc()
+                self.slow = False
+            except asyncio.TimeoutError:
+                self.needs_keyframe = True
+                self._on_slow(f"send stalled for {self.send_timeout}s")
+            except Exception:
+                return  # Connection closed - the handler cleans up
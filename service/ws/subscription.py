@@ -0,0 +1,137 @@
+from service.vision.aruco import MarkerBatch
+import numpy as np
+
+
+class Subscription:
+    """
+    What one client wants to receive, set with a control message (see WebSocketServer._on_message):
+
+        {"type": "subscribe", "ids": [3, 7], "rects": [[x0, y0, x1, y1], ...], "max_rate": 10}
+
+    A marker is delivered if its id is in `ids` and its center (projector space) lies in one of `rects`;
+    a filter that is left out (or null) matches every marker. `max_rate` limits the updates per second.
+    Clients with equal subscriptions share their encoded messages (see `key`).
+    """
+    def __init__(self, ids=None, rects=None, max_rate: float = None) -> None:
+        self.ids = None if ids is None else np.unique(np.asarray(ids, dtype=np.int32))
+        self.rects = None if rects is None else np.asarray(rects, dtype=np.float32).reshape(-1, 4)
+        self.max_rate = max_rate
+        self.interval = 0.0 if max_rate is None else 1.0 / max_rate
+        self.key = (None if ids is None else tuple(self.ids.tolist()),
+                    None if rects is None else tuple(map(tuple, self.rects.tolist())),
+                    max_rate)
+
+    @staticmethod
+    def parse(request: dict):
+        """Subscription of a "subscribe" request; None if it subscribes to everything. Raises ValueError if invalid."""
+        ids, rects, max_rate = request.get("ids"), request.get("rects"), request.get("max_rate")
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+                raise ValueError("ids must be a list of integers")
+        if rects is not None:
+            if not isinstance(rects, list) or not all(
+                    isinstance(r, list) and len(r) == 4 and all(isinstance(v, (int, float)) for v in r) for r in rects):
+                raise ValueError("rects must be a list of [x0, y0, x1, y1]")
+            if any(r[0] > r[2] or r[1] > r[3] for r in rects):
+                raise ValueError("rects must have x0 <= x1 and y0 <= y1")
+        if max_rate is not None:
+            if not isinstance(max_rate, (int, float)) or isinstance(max_rate, bool) or max_rate <= 0:
+                raise ValueError("max_rate must be a positive number")
+            max_rate = float(max_rate)
+        if ids is None and rects is None and max_rate is None:
+            return None
+        return Subscription(ids, rects, max_rate)
+
+    def to_dict(self) -> dict:
+        ids, rects, max_rate = self.key
+        return {"ids": None if ids is None else list(ids),
+                "rects": None if rects is None else [list(r) for r in rects],
+                "max_rate": max_rate}
+
+    def filter(self, batch: MarkerBatch) -> MarkerBatch:
+        keep = np.ones(len(batch), dtype=bool)
+        if self.ids is not None:
+            keep &= np.isin(batch.ids, self.ids)
+        if self.rects is not None:
+            x, y = batch.centers[:, 0:1], batch.centers[:, 1:2]
+            r = self.rects
+            keep &= ((x >= r[:, 0]) & (x <= r[:, 2]) & (y >= r[:, 1]) & (y <= r[:, 3])).any(axis=1)
+        if keep.all():
+            return batch
+        return MarkerBatch(batch.data[keep])
+
+
+class SubscriptionGroup:
+    """
+    The clients sharing one subscription. They are throttled together (`due`), and for delta clients
+    the group keeps its own DeltaStream of the filtered markers, as ids leaving the subscription must
+    show up as removed.
+    """
+    def __init__(self, subscription: Subscription, stream=None) -> None:
+        self.subscription = subscription
+        self.stream = stream
+        self.next_send = 0.0
+        self.last_frame = None
+        self.frame_interval = 0.0  # Smoothed time between frames (calls of `due`)
+
+    def due(self, now: float) -> bool:
+        """
+        True (and the group counts as sent) if the group may be sent to at `now`, called once per frame.
+        Sends follow a fixed schedule of 1 / max_rate slots, each taking the frame nearest to it, so the
+        rate never exceeds max_rate and a single gap is at most one frame interval short of the slot.
+        """
+        interval = self.subscription.interval
+        if self.last_frame is not None and now - self.last_frame < interval:  # Pauses are no frame interval
+            dt = now - self.last_frame
+            self.frame_interval = dt if self.frame_interval == 0 else 0.9 * self.frame_interval + 0.1 * dt
+        self.last_frame = now
+        if now < self.next_send - self.frame_interval / 2:
+            return False
+        # While on schedule, the next slot follows the previous one rather than `now`, so frame timing
+        # jitter does not lower the rate (10/s of a 30 fps camera must not become every 4th frame).
+        # Off schedule (the first send, no frames for a while), it restarts a full interval from now.
+        if abs(now - self.next_send) < interval / 2:
+            self.next_send += interval
+        else:
+            self.next_send = now + interval
+        return True
+
+
+def _test_subscription():  # TEMPORARY - add testing package at some point
+    """Checks request validation, id / rectangle filtering and throttling."""
+    from service.vision.aruco import _marker_batch_fixture
+    batch = _marker_batch_fixture((1, (0, 0)), (2, (100, 0)), (3, (200, 0)))
+
+    assert Subscription.parse({"type": "subscribe"}) is None
+    for bad in ({"ids": [1, "2"]}, {"rects": [[0, 0, 10]]}, {"rects": [[10, 0, 0, 10]]}, {"max_rate": 0}):
+        try:
+            Subscription.parse(bad)
+            assert False, bad
+        except ValueError:
+            pass
+
+    assert Subscription.parse({"ids": [3, 1]}).filter(batch).ids.tolist() == [1, 3]
+    assert Subscription.parse({"rects": [[90, -5, 150, 20], [500, 0, 600, 10]]}).filter(batch).ids.tolist() == [2]
+    assert Subscription.parse({"ids": [1, 2], "rects": [[90, -5, 250, 20]]}).filter(batch).ids.tolist() == [2]
+    assert Subscription.parse({"ids": [2, 1]}).key == Subscription.parse({"ids": [1, 2, 2]}).key
+    assert Subscription.parse({"ids": [1]}).to_dict() == {"ids": [1], "rects": None, "max_rate": None}
+
+    # 30 fps with jitter: every 3rd / 6th frame, no gap shorter than the interval (up to the jitter)
+    rng = np.random.default_rng(0)
+    for max_rate, sends in ((10, 100), (5, 50)):
+        group = SubscriptionGroup(Subscription.parse({"max_rate": max_rate}))
+        frames = 1.0 + np.arange(300) / 30 + rng.normal(0, 0.002, 300)
+        sent = frames[[group.due(t) for t in frames]]
+        assert len(sent) == sends
+        assert np.diff(sent).min() > 1 / max_rate - 0.01
+
+    # A rate that does not divide the frame rate: a gap is at most one frame short, the rate is kept
+    group = SubscriptionGroup(Subscription.parse({"max_rate": 12}))
+    frames = np.arange(300) / 30
+    sent = frames[[group.due(t) for t in frames]]
+    assert len(sent) <= 12 * 10 + 1 and np.diff(sent).min() > 1 / 12 - 1 / 30 - 1e-6
+
+    # Restarting after a pause: the first gap is a full interval as well
+    group = SubscriptionGroup(Subscription.parse({"max_rate": 5}))
+    sent = [t for t in np.arange(60) / 30 for t in [t + 5.0 * (t >= 1)] if group.due(t)]
+    assert np.diff(sent).min() >= 0.2 - 1e-9